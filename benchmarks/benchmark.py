@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Mide el rendimiento del despachante con un conjunto de politicas sinteticas.
+
+Llena las tablas con una cantidad configurable de politicas, clases de trafico,
+redes, puertos, mac-address y rangos horarios, y mide cada etapa del despacho:
+
+* obtener_politicas: consulta y precarga de las politicas activas.
+* flags: generacion de los flags de las reglas de cada politica.
+* construccion: representacion intermedia de las reglas.
+* emision: traduccion de las reglas al script (antes, el render del template),
+  recorriendo las lineas sin guardarlas.
+* escribir: generacion y escritura del script y de los archivos de tc -batch.
+* aplicar: ejecucion de los archivos con un ejecutor falso, que solo cuenta los
+  comandos.
+* despacho: despacho completo con el ejecutor falso.
+
+De cada etapa se registra el tiempo, la cantidad de consultas a la base de
+datos y el pico de memoria, ademas de la cantidad de reglas y el tamanio del
+script. Los resultados se agregan a un archivo JSON para comparar versiones.
+
+Por defecto utiliza una base SQLite en memoria. Con `--base postgres` utiliza
+la base pasada con `--nombre` en el servidor del archivo de configuracion. Las
+tablas se crean al comenzar y se eliminan al terminar, por lo que no debe ser
+la base de produccion.
+
+Ejemplo:
+
+```sh
+$ python benchmarks/benchmark.py --politicas 1000 --salida benchmark.json
+```
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, time as hora
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from netcop.despachante import models, config, reglas, Despachante  # noqa
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 no permite medir la memoria de cada etapa
+    tracemalloc = None
+
+MODELOS = [
+    models.ClaseTrafico,
+    models.CIDR,
+    models.Puerto,
+    models.ClaseCIDR,
+    models.ClasePuerto,
+    models.Politica,
+    models.Objetivo,
+    models.RangoHorario,
+]
+
+# Opciones del despachante que se pueden habilitar en la medicion
+OPCIONES = ('iptables_restore', 'tc_batch', 'ipset', 'multiport',
+            'incremental', 'cadenas', 'horario_kernel', 'nftables',
+            'agregacion', 'directo', 'paralelo', 'connmark')
+
+# Cantidad de filas por sentencia INSERT
+LOTE = 100
+
+
+class Generador:
+    '''
+    Genera politicas sinteticas al azar. Con la misma semilla se generan
+    siempre los mismos datos.
+    '''
+
+    def __init__(self, politicas=100, clases=50, redes=5, puertos=5, macs=1,
+                 horarios=2, objetivos=2, temporales=0.2, semilla=0):
+        '''
+        Recibe la cantidad total de politicas y clases de trafico, y la
+        cantidad de redes y puertos por clase, y de mac-address, rangos
+        horarios y objetivos con clase de trafico por politica.
+
+        Solo la proporcion `temporales` de las politicas tiene rangos
+        horarios, el resto esta siempre activa.
+        '''
+        self.politicas = politicas
+        self.clases = clases
+        self.redes = redes
+        self.puertos = puertos
+        self.macs = macs
+        self.horarios = horarios
+        self.objetivos = objetivos
+        self.temporales = temporales
+        self.azar = random.Random(semilla)
+
+    def parametros(self):
+        '''
+        Devuelve las cantidades con las que se generan los datos.
+        '''
+        return OrderedDict((nombre, getattr(self, nombre)) for nombre in (
+            'politicas', 'clases', 'redes', 'puertos', 'macs', 'horarios',
+            'objetivos', 'temporales'))
+
+    def red(self):
+        '''
+        Devuelve una red al azar dentro de 10.0.0.0/8.
+        '''
+        prefijo = self.azar.choice((16, 24, 24, 28, 32, 32))
+        direccion = self.azar.getrandbits(24) >> (32 - prefijo) << \
+            (32 - prefijo)
+        return {
+            'direccion': '10.%d.%d.%d' % (direccion >> 16,
+                                          (direccion >> 8) & 0xff,
+                                          direccion & 0xff),
+            'prefijo': prefijo,
+        }
+
+    def mac(self):
+        '''
+        Devuelve una mac-address al azar.
+        '''
+        return ':'.join('%02x' % self.azar.getrandbits(8) for _ in range(6))
+
+    def rango(self):
+        '''
+        Devuelve un rango horario al azar de al menos una hora.
+        '''
+        inicio = self.azar.randrange(0, 23)
+        fin = self.azar.randrange(inicio + 1, 24)
+        return {
+            'dia': self.azar.randrange(0, 7),
+            'hora_inicial': hora(inicio),
+            'hora_fin': hora(fin),
+        }
+
+    def filas(self):
+        '''
+        Devuelve un diccionario con las filas de cada modelo.
+        '''
+        filas = OrderedDict((modelo, list()) for modelo in MODELOS)
+        id_cidr = id_puerto = 0
+        for id_clase in range(1, self.clases + 1):
+            filas[models.ClaseTrafico].append({
+                'id_clase': id_clase,
+                'nombre': 'clase %d' % id_clase,
+            })
+            for _ in range(self.redes):
+                id_cidr += 1
+                filas[models.CIDR].append(dict(self.red(), id_cidr=id_cidr))
+                filas[models.ClaseCIDR].append({
+                    'clase': id_clase,
+                    'cidr': id_cidr,
+                    'grupo': self.azar.choice((models.INSIDE,
+                                               models.OUTSIDE)),
+                })
+            for _ in range(self.puertos):
+                id_puerto += 1
+                filas[models.Puerto].append({
+                    'id_puerto': id_puerto,
+                    'numero': self.azar.randrange(1, 65536),
+                    'protocolo': self.azar.choice((0, models.Protocolo.TCP,
+                                                   models.Protocolo.UDP)),
+                })
+                filas[models.ClasePuerto].append({
+                    'clase': id_clase,
+                    'puerto': id_puerto,
+                    'grupo': self.azar.choice((models.INSIDE,
+                                               models.OUTSIDE)),
+                })
+        id_objetivo = id_rango = 0
+        for id_politica in range(1, self.politicas + 1):
+            # un tercio de prioridades, un tercio de limitaciones y un tercio
+            # de restricciones
+            tipo = id_politica % 3
+            filas[models.Politica].append({
+                'id_politica': id_politica,
+                'nombre': 'politica %d' % id_politica,
+                'prioridad': (self.azar.choice((models.Politica.PRIO_ALTA,
+                                                models.Politica.PRIO_NORMAL,
+                                                models.Politica.PRIO_BAJA))
+                              if tipo == 0 else None),
+                'velocidad_bajada': (self.azar.randrange(1, 1024)
+                                     if tipo == 1 else None),
+                'velocidad_subida': (self.azar.randrange(1, 1024)
+                                     if tipo == 1 else None),
+            })
+            for _ in range(self.objetivos if self.clases else 0):
+                id_objetivo += 1
+                filas[models.Objetivo].append({
+                    'id_objetivo': id_objetivo,
+                    'politica': id_politica,
+                    'clase': self.azar.randrange(1, self.clases + 1),
+                    'tipo': self.azar.choice((models.Objetivo.ORIGEN,
+                                              models.Objetivo.DESTINO)),
+                })
+            for _ in range(self.macs):
+                id_objetivo += 1
+                filas[models.Objetivo].append({
+                    'id_objetivo': id_objetivo,
+                    'politica': id_politica,
+                    'tipo': models.Objetivo.ORIGEN,
+                    'direccion_fisica': self.mac(),
+                })
+            if self.azar.random() >= self.temporales:
+                continue
+            for _ in range(self.horarios):
+                id_rango += 1
+                filas[models.RangoHorario].append(dict(
+                    self.rango(),
+                    id_rango_horario=id_rango,
+                    politica=id_politica,
+                ))
+        return filas
+
+    def llenar(self, db):
+        '''
+        Inserta los datos generados en la base de datos.
+        '''
+        with db.atomic():
+            for modelo, filas in self.filas().items():
+                for i in range(0, len(filas), LOTE):
+                    modelo.insert_many(filas[i:i + LOTE]).execute()
+
+
+def enlazar(db):
+    '''
+    Utiliza la base de datos pasada por parametro en todos los modelos.
+    '''
+    for modelo in MODELOS:
+        modelo._meta.database = db
+    models.db = db
+
+
+class Contador:
+    '''
+    Cuenta las consultas que se ejecutan en la base de datos.
+    '''
+
+    def __init__(self, db):
+        self.consultas = 0
+        execute_sql = db.execute_sql
+
+        def contar(*args, **kwargs):
+            self.consultas += 1
+            return execute_sql(*args, **kwargs)
+        db.execute_sql = contar
+
+
+class EjecutorFalso:
+    '''
+    Reemplaza la ejecucion de comandos del despachante. Registra los comandos
+    y la cantidad de lineas de los archivos que se hubieran ejecutado. Los
+    comandos que no leen un archivo ni su entrada no suman lineas.
+    '''
+
+    def __init__(self):
+        self.comandos = list()
+        self.lineas = 0
+
+    def ejecutar(self, comando, lineas=None):
+        self.comandos.append(comando)
+        if lineas is not None:
+            self.contar(lineas)
+        elif os.path.isfile(comando[-1]):
+            with open(comando[-1]) as f:
+                self.contar(f)
+        return 0, ''
+
+    def contar(self, lineas):
+        self.lineas += sum(1 for linea in lineas
+                           if linea.strip() and not linea.startswith('#'))
+
+
+class DespachanteSimulado(Despachante):
+    '''
+    Despachante que escribe sus archivos en una carpeta temporal y ejecuta los
+    comandos con un ejecutor falso.
+    '''
+
+    def __init__(self, carpeta, ejecutor, **opciones):
+        Despachante.__init__(self, **opciones)
+        self.ejecutor = ejecutor
+        self.SCRIPT_FILE = os.path.join(carpeta, 'script')
+        self.TC_BATCH_FILE = os.path.join(carpeta, 'tc-%s')
+        self.ESTADO_FILE = os.path.join(carpeta, 'estado.json')
+        self.NUMEROS_FILE = os.path.join(carpeta, 'numeros.json')
+        self.HUELLA_FILE = os.path.join(carpeta, 'huella')
+        self.BUENO_FILE = os.path.join(carpeta, 'bueno.json')
+        self.VERSION_FILE = os.path.join(carpeta, 'version')
+        self.CERROJO_FILE = os.path.join(carpeta, 'cerrojo')
+
+
+class Benchmark:
+    '''
+    Mide las etapas del despacho.
+    '''
+
+    def __init__(self, despachante, contador, fecha=None):
+        self.despachante = despachante
+        self.contador = contador
+        self.fecha = datetime.now() if fecha is None else fecha
+        self.etapas = OrderedDict()
+
+    @contextmanager
+    def medir(self, nombre):
+        '''
+        Mide el tiempo, las consultas y el pico de memoria de una etapa.
+        Devuelve el diccionario de resultados de la etapa, en el que se pueden
+        agregar otras medidas.
+        '''
+        resultado = OrderedDict()
+        consultas = self.contador.consultas
+        if tracemalloc is not None:
+            tracemalloc.start()
+        inicio = time.time()
+        try:
+            yield resultado
+        finally:
+            segundos = time.time() - inicio
+            pico = None
+            if tracemalloc is not None:
+                pico = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            resultado['segundos'] = round(segundos, 6)
+            resultado['consultas'] = self.contador.consultas - consultas
+            resultado['memoria'] = pico
+            self.etapas[nombre] = resultado
+
+    def ejecutar(self):
+        '''
+        Ejecuta todas las etapas y devuelve sus resultados.
+        '''
+        despachante = self.despachante
+        with self.medir('obtener_politicas') as resultado:
+            politicas = despachante.obtener_politicas(self.fecha)
+        resultado['politicas'] = len(politicas)
+        with self.medir('flags') as resultado:
+            despachante.contexto(politicas)
+            cantidad = 0
+            for politica in politicas:
+                for flags in politica.iter_flags():
+                    cantidad += 1
+        resultado['reglas'] = cantidad
+        with self.medir('construccion') as resultado:
+            configuracion = despachante.configuracion(politicas)
+            objetos = list(configuracion.objetos())
+        resultado['objetos'] = len(objetos)
+        resultado['reglas'] = len([o for o in objetos
+                                   if isinstance(o, reglas.Regla)])
+        with self.medir('emision') as resultado:
+            lineas, batch = despachante.emitir(configuracion.operaciones(),
+                                               configuracion.conjuntos())
+            cantidad = sum(1 for linea in lineas)
+        resultado['lineas'] = cantidad
+        with self.medir('escribir') as resultado:
+            lineas, batch = despachante.emitir(configuracion.operaciones(),
+                                               configuracion.conjuntos())
+            despachante.volcar(despachante.secciones(lineas, batch, True))
+            archivos = [despachante.SCRIPT_FILE]
+            if batch is not None:
+                archivos[:0] = [despachante.TC_BATCH_FILE % interfaz
+                                for interfaz in batch.interfaces]
+        resultado['bytes'] = sum(os.path.getsize(a) for a in archivos)
+        ejecutor = EjecutorFalso()
+        with self.medir('aplicar') as resultado:
+            for archivo in archivos:
+                ejecutor.ejecutar(['/bin/sh', archivo])
+        resultado['comandos'] = ejecutor.lineas
+        despachante.ejecutor = ejecutor = EjecutorFalso()
+        with self.medir('despacho') as resultado:
+            despachante.despachar()
+        resultado['comandos'] = ejecutor.lineas
+        return self.etapas
+
+
+def version():
+    '''
+    Devuelve la version del repositorio segun git, o None si no se puede
+    obtener.
+    '''
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def guardar(archivo, resultado):
+    '''
+    Agrega el resultado al archivo JSON con las mediciones anteriores.
+    Devuelve la medicion anterior con los mismos parametros, o None.
+    '''
+    historial = list()
+    if os.path.exists(archivo):
+        with open(archivo) as f:
+            historial = json.load(f)
+    anteriores = [item for item in historial
+                  if item['parametros'] == resultado['parametros'] and
+                  item['opciones'] == resultado['opciones'] and
+                  item['base'] == resultado['base']]
+    historial.append(resultado)
+    with open(archivo, 'w') as f:
+        json.dump(historial, f, indent=2)
+    return anteriores[-1] if anteriores else None
+
+
+def mostrar(resultado, anterior=None):
+    '''
+    Muestra los resultados de cada etapa y la variacion de tiempo respecto de
+    la medicion anterior.
+    '''
+    print("%-18s %10s %9s %12s %10s" % ('etapa', 'segundos', 'consultas',
+                                        'memoria', 'variacion'))
+    for nombre, etapa in resultado['etapas'].items():
+        variacion = ''
+        if anterior is not None and nombre in anterior['etapas']:
+            previo = anterior['etapas'][nombre]['segundos']
+            if previo:
+                variacion = '%+.1f%%' % ((etapa['segundos'] - previo) * 100 /
+                                         previo)
+        print("%-18s %10.4f %9d %12s %10s" % (
+            nombre, etapa['segundos'], etapa['consultas'],
+            etapa['memoria'] if etapa['memoria'] is not None else '-',
+            variacion))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--politicas", type=int, default=100,
+                        help="Cantidad de politicas.")
+    parser.add_argument("--clases", type=int, default=50,
+                        help="Cantidad de clases de trafico.")
+    parser.add_argument("--redes", type=int, default=5,
+                        help="Cantidad de redes por clase de trafico.")
+    parser.add_argument("--puertos", type=int, default=5,
+                        help="Cantidad de puertos por clase de trafico.")
+    parser.add_argument("--macs", type=int, default=1,
+                        help="Cantidad de mac-address por politica.")
+    parser.add_argument("--horarios", type=int, default=2,
+                        help="Cantidad de rangos horarios de cada politica "
+                             "temporal.")
+    parser.add_argument("--objetivos", type=int, default=2,
+                        help="Cantidad de objetivos con clase de trafico por "
+                             "politica.")
+    parser.add_argument("--temporales", type=float, default=0.2,
+                        help="Proporcion de politicas con rangos horarios.")
+    parser.add_argument("--semilla", type=int, default=0,
+                        help="Semilla de los datos generados al azar.")
+    parser.add_argument("--opcion", action="append", default=[],
+                        choices=OPCIONES,
+                        help="Habilita una opcion del despachante. Se puede "
+                             "repetir.")
+    parser.add_argument("--base", choices=('sqlite', 'postgres'),
+                        default='sqlite',
+                        help="Motor de base de datos.")
+    parser.add_argument("--nombre", default='netcop_benchmark',
+                        help="Nombre de la base de datos de PostgreSQL.")
+    parser.add_argument("--salida",
+                        help="Archivo JSON donde se agregan los resultados.")
+    args = parser.parse_args()
+
+    if args.base == 'postgres':
+        db = peewee.PostgresqlDatabase(args.nombre,
+                                       host=config.DATABASE['host'],
+                                       user=config.DATABASE['user'],
+                                       password=config.DATABASE['password'])
+    else:
+        db = peewee.SqliteDatabase(':memory:')
+    enlazar(db)
+    db.connect()
+    db.create_tables(MODELOS, safe=True)
+    if models.Politica.select().exists():
+        db.close()
+        parser.error("La base de datos %s ya tiene politicas" % args.nombre)
+    carpeta = tempfile.mkdtemp(prefix='netcop-benchmark-')
+    try:
+        generador = Generador(args.politicas, args.clases, args.redes,
+                              args.puertos, args.macs, args.horarios,
+                              args.objetivos, args.temporales,
+                              args.semilla)
+        generador.llenar(db)
+        contador = Contador(db)
+        opciones = dict((nombre, nombre in args.opcion)
+                        for nombre in OPCIONES)
+        despachante = DespachanteSimulado(carpeta, EjecutorFalso(),
+                                          **opciones)
+        resultado = OrderedDict([
+            ('version', version()),
+            ('fecha', datetime.now().isoformat()),
+            ('python', platform.python_version()),
+            ('peewee', peewee.__version__),
+            ('base', args.base),
+            ('parametros', generador.parametros()),
+            ('opciones', sorted(args.opcion)),
+            ('etapas', Benchmark(despachante, contador).ejecutar()),
+        ])
+    finally:
+        shutil.rmtree(carpeta)
+        db.drop_tables(MODELOS, safe=True)
+        db.close()
+    anterior = None
+    if args.salida:
+        anterior = guardar(args.salida, resultado)
+    mostrar(resultado, anterior)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,17 @@
-from .despachante import Despachante
+import sys
+
+# El despachante se importa recien cuando se utiliza, para que los modulos
+# livianos como `vigencia` no carguen peewee ni la base de datos
+if sys.version_info < (3, 7):
+    from .despachante import Despachante  # noqa: F401
+
+
+def __getattr__(nombre):
+    '''
+    Importa el despachante la primera vez que se utiliza.
+    '''
+    if nombre == 'Despachante':
+        from . import despachante
+        return despachante.Despachante
+    raise AttributeError("module %r has no attribute %r" %
+                         (__name__, nombre))
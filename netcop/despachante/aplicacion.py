@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+Aplicacion de los comandos de un despacho en el sistema operativo.
+
+Los comandos se ejecutan de a uno, esperando que termine cada uno con un
+tiempo maximo, y se registra la salida de error de los que fallan. Un cerrojo
+sobre un archivo impide que dos despachos se ejecuten al mismo tiempo y
+mezclen sus comandos.
+'''
+import fcntl
+import logging
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from . import comandos
+
+log = logging.getLogger(__name__)
+
+# Archivo del cerrojo que comparten todos los despachos
+CERROJO = '/tmp/netcop-despachar.lock'
+
+
+class Paso:
+    '''
+    Comando de un despacho. Si se pasan lineas se escriben en la entrada del
+    comando a medida que se generan. El archivo es el que lee el comando,
+    indicado en sus argumentos. Los errores de los pasos tolerantes no
+    interrumpen el despacho.
+    '''
+
+    def __init__(self, nombre, comando, lineas=None, archivo=None,
+                 tolerante=False):
+        self.nombre = nombre
+        self.comando = comando
+        self.lineas = lineas
+        self.archivo = archivo
+        self.tolerante = tolerante
+
+
+def lineas_archivo(archivo):
+    '''
+    Genera las lineas del archivo sin el salto de linea.
+    '''
+    with open(archivo) as f:
+        for linea in f:
+            yield linea.rstrip('\n')
+
+
+class Fallo:
+    '''
+    Comando de un despacho que termino con error. El codigo es None si se
+    supero el tiempo maximo.
+    '''
+
+    def __init__(self, nombre, comando, codigo, salida):
+        self.nombre = nombre
+        self.comando = comando
+        self.codigo = codigo
+        self.salida = salida
+
+    def __str__(self):
+        if self.codigo is None:
+            motivo = "supero el tiempo maximo"
+        else:
+            motivo = "termino con codigo %d" % self.codigo
+        texto = "%s: %s %s" % (self.nombre, " ".join(self.comando), motivo)
+        if self.salida:
+            texto += ": %s" % self.salida.strip()
+        return texto
+
+
+class ErrorAplicacion(Exception):
+    '''
+    Error al aplicar un despacho. Contiene los comandos que fallaron y si se
+    pudieron restaurar las reglas del ultimo despacho correcto.
+    '''
+
+    def __init__(self, fallos, restaurado):
+        Exception.__init__(self, "; ".join(str(f) for f in fallos))
+        self.fallos = fallos
+        self.restaurado = restaurado
+
+
+@contextmanager
+def cerrojo(archivo=CERROJO):
+    '''
+    Espera a que ningun otro despacho tenga el cerrojo y lo mantiene mientras
+    dura el contexto.
+    '''
+    with open(archivo, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Ejecutor:
+    '''
+    Ejecuta los comandos en el sistema operativo.
+    '''
+
+    def __init__(self, tiempo_maximo=None):
+        '''
+        Recibe el tiempo maximo en segundos de cada comando, o None si no hay
+        limite.
+        '''
+        self.tiempo_maximo = tiempo_maximo
+
+    def ejecutar(self, comando, lineas=None):
+        '''
+        Ejecuta el comando escribiendo las lineas en su entrada estandar a
+        medida que se generan, si se pasan, y espera a que termine. Devuelve
+        el codigo de salida, None si se supero el tiempo maximo y se termino
+        el proceso, 127 si no se pudo ejecutar o 1 si no se pudieron generar
+        las lineas y se termino el proceso, y la salida de error.
+        '''
+        # la salida de error va a un archivo para que el comando no se
+        # bloquee mientras se escribe su entrada
+        salida = tempfile.TemporaryFile()
+        try:
+            proceso = subprocess.Popen(
+                comando, stderr=salida,
+                stdin=subprocess.PIPE if lineas is not None else None
+            )
+        except OSError as e:
+            # el comando no existe o no se puede ejecutar, igual que en sh
+            salida.close()
+            return 127, "%s\n" % e
+        vencido = []
+        temporizador = None
+        if self.tiempo_maximo:
+            def terminar():
+                vencido.append(True)
+                proceso.kill()
+            temporizador = threading.Timer(self.tiempo_maximo, terminar)
+            temporizador.start()
+        error = None
+        try:
+            if lineas is not None:
+                try:
+                    self.escribir(proceso, comando, lineas)
+                except Exception as e:
+                    # se termina el comando antes de cerrar su entrada, para
+                    # que no aplique las lineas que recibio hasta el error
+                    log.error("No se pudieron generar las lineas de %s: %s",
+                              comando[0], e)
+                    error = e
+                    proceso.kill()
+                    proceso.wait()
+                finally:
+                    try:
+                        proceso.stdin.close()
+                    except (IOError, OSError):
+                        pass
+            codigo = proceso.wait()
+        finally:
+            if temporizador is not None:
+                temporizador.cancel()
+        salida.seek(0)
+        texto = salida.read().decode('utf-8', 'replace')
+        salida.close()
+        if error is not None:
+            return 1, texto + "%s\n" % error
+        return (None if vencido else codigo), texto
+
+    @staticmethod
+    def escribir(proceso, comando, lineas):
+        '''
+        Escribe las lineas en la entrada del proceso. Si el comando termina
+        antes de leerlas todas se deja de escribir. Los errores al generar las
+        lineas se propagan.
+        '''
+        for linea in lineas:
+            try:
+                proceso.stdin.write(comandos.codificar(linea))
+            except (IOError, OSError) as e:
+                # el comando termino antes de leer todas las lineas
+                log.error("No se pudo escribir en %s: %s", comando[0], e)
+                return
+
+
+class Grabador:
+    '''
+    Reemplaza al ejecutor en las pruebas: registra los comandos y las lineas
+    que hubiera recibido cada uno, sin ejecutarlos. Los comandos de la lista
+    de fallas terminan con error.
+    '''
+
+    def __init__(self, fallas=()):
+        self.comandos = list()
+        # lineas escritas en la entrada de cada comando, None si no recibio
+        self.entradas = list()
+        self.fallas = [list(c) for c in fallas]
+
+    def ejecutar(self, comando, lineas=None):
+        self.comandos.append(list(comando))
+        self.entradas.append(None if lineas is None else list(lineas))
+        if list(comando) in self.fallas:
+            return 1, "error simulado\n"
+        return 0, ""
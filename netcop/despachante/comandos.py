@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+'''
+Emisores que transforman la representacion intermedia del modulo `reglas` en
+los comandos que configuran el kernel.
+
+Los emisores reciben una lista de operaciones, pares (objeto, borrar), y
+generan:
+
+* un script sh con un comando `$IPTABLES ...` o `$TC ...` por objeto.
+* el formato de *iptables-restore*, de manera que las tablas filter y mangle
+  se cargan en un unico commit atomico en lugar de ejecutar un proceso por
+  cada regla.
+* los comandos de tc agrupados por interfaz, para aplicarlos con una unica
+  invocacion de `tc -batch` por interfaz.
+* un archivo de *nftables* que reemplaza la tabla del despachante de una vez.
+
+Los conjuntos de ipset que utilizan las reglas se cargan con una unica llamada
+a `ipset restore`. Cada conjunto se carga en uno temporal que luego se
+intercambia con el que utilizan las reglas, de manera que nunca quedan
+vacios mientras se cargan.
+
+Los scripts terminan en el primer comando que falla. Solo se ignora el error
+al eliminar la disciplina raiz de una interfaz, que falla si la interfaz
+todavia tiene la disciplina por defecto.
+
+Las lineas se generan a medida que se recorren. Las que se deben agrupar, como
+las reglas de cada tabla de iptables-restore, se acumulan en archivos
+temporales, de manera que la memoria no depende de la cantidad de reglas.
+'''
+import tempfile
+from collections import OrderedDict
+from .models import Conjunto, Flag, Horario
+from .reglas import (Comentario, PoliticaCadena, Vaciado, Cadena, Regla,
+                     Qdisc, Clase, Filtro, FILTER, MANGLE, FORWARD, ACCEPT,
+                     REJECT, RETURN, MARK, GUARDAR_MARCA, RESTAURAR_MARCA)
+
+IPTABLES = '$IPTABLES'
+IPTABLES_RESTORE = '$IPTABLES_RESTORE'
+TC = '$TC'
+IPSET = '$IPSET'
+NFT = '$NFT'
+
+# Cabecera de los scripts generados
+CABECERA = [
+    '#!/bin/sh',
+    'set -e',
+    'IPTABLES="/sbin/iptables"',
+    'IPTABLES_RESTORE="/sbin/iptables-restore"',
+    'TC="/sbin/tc"',
+    'IPSET="/sbin/ipset"',
+    'NFT="/usr/sbin/nft"',
+]
+
+# Bytes que puede ocupar en memoria un acumulador de lineas antes de pasar a
+# un archivo temporal
+MAX_MEMORIA = 1024 * 1024
+
+
+def codificar(linea):
+    '''
+    Devuelve los bytes de la linea terminada en salto de linea, para escribirla
+    en la entrada de un proceso o calcular su huella.
+    '''
+    linea = linea + '\n'
+    if isinstance(linea, bytes):
+        return linea
+    return linea.encode('utf-8')
+
+
+class Acumulador:
+    '''
+    Acumula lineas en memoria hasta MAX_MEMORIA bytes y luego en un archivo
+    temporal. Se puede recorrer mas de una vez.
+    '''
+
+    def __init__(self):
+        self.archivo = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORIA,
+                                                     mode='w+')
+
+    def agregar(self, linea):
+        self.archivo.write(linea + '\n')
+
+    def __iter__(self):
+        self.archivo.seek(0)
+        for linea in self.archivo:
+            yield linea.rstrip('\n')
+        self.archivo.seek(0, 2)
+
+
+def regla(objeto, borrar=False, tabla=False):
+    '''
+    Devuelve los argumentos de iptables que agregan o eliminan la regla. La
+    tabla solo se incluye si se indica y no es la tabla por defecto.
+
+    Si la regla tiene posicion se inserta en esa posicion, o se elimina la
+    regla de esa posicion sin repetir sus flags.
+    '''
+    argumentos = ['-D' if borrar else '-A', objeto.cadena]
+    if objeto.posicion is not None:
+        # el numero de regla debe seguir a la cadena
+        argumentos = ['-D' if borrar else '-I', objeto.cadena,
+                      str(objeto.posicion)]
+    if tabla and objeto.tabla != FILTER:
+        argumentos.extend(['-t', objeto.tabla])
+    if borrar and objeto.posicion is not None:
+        return " ".join(argumentos)
+    argumentos.extend(Flag.texto(k, v) for k, v in objeto.flags)
+    argumentos.extend(['-j', objeto.destino])
+    if objeto.marca is not None:
+        argumentos.extend(['--set-mark', str(objeto.marca)])
+    return " ".join(argumentos)
+
+
+def iptables(objeto, borrar=False):
+    '''
+    Devuelve la lista de comandos de iptables que aplican la operacion, o
+    None si el objeto no es de iptables.
+    '''
+    if isinstance(objeto, Regla):
+        return ["%s %s" % (IPTABLES, regla(objeto, borrar, tabla=True))]
+    tabla = ''
+    if objeto_tabla(objeto) != FILTER:
+        tabla = ' -t %s' % objeto_tabla(objeto)
+    if isinstance(objeto, Cadena):
+        return ["%s%s %s %s" % (IPTABLES, tabla, '-X' if borrar else '-N',
+                                objeto.nombre)]
+    if isinstance(objeto, PoliticaCadena):
+        return ["%s -P %s %s" % (IPTABLES, objeto.cadena, objeto.destino)]
+    if isinstance(objeto, Vaciado):
+        comandos = ["%s -F%s" % (IPTABLES, tabla)]
+        if objeto.cadenas:
+            comandos.append("%s -X%s" % (IPTABLES, tabla))
+        return comandos
+    return None
+
+
+def objeto_tabla(objeto):
+    '''
+    Devuelve la tabla de iptables del objeto, o None si no es de iptables.
+    '''
+    return getattr(objeto, 'tabla', None)
+
+
+def tc(objeto, borrar=False):
+    '''
+    Devuelve los argumentos de tc que aplican la operacion, o None si el
+    objeto no es del tc. Para eliminar un objeto alcanzan los atributos que lo
+    identifican.
+    '''
+    accion = 'del' if borrar else 'add'
+    if isinstance(objeto, Qdisc):
+        if objeto.padre == 'root':
+            comando = "qdisc %s dev %s root" % (accion, objeto.interfaz)
+        else:
+            comando = "qdisc %s dev %s parent %s" % (accion, objeto.interfaz,
+                                                     objeto.padre)
+        if borrar:
+            return comando
+        return "%s handle %s %s" % (comando, objeto.handle, objeto.opciones)
+    if isinstance(objeto, Clase):
+        comando = "class %s dev %s parent %s classid %s" % (
+            accion, objeto.interfaz, objeto.padre, objeto.clase)
+        if borrar:
+            return comando
+        comando += " htb rate %s" % objeto.velocidad
+        if objeto.maxima is not None:
+            comando += " ceil %s" % objeto.maxima
+        if objeto.prioridad is not None:
+            comando += " prio %s" % objeto.prioridad
+        return comando
+    if isinstance(objeto, Filtro):
+        comando = "filter %s dev %s parent %s prio %d protocol ip" % (
+            accion, objeto.interfaz, objeto.padre, objeto.prioridad)
+        if objeto.handle is None:
+            return "%s fw" % comando
+        comando = "%s handle %s fw" % (comando, objeto.handle)
+        if borrar:
+            return comando
+        return "%s flowid %s" % (comando, objeto.clase)
+    return None
+
+
+def limpieza(objeto, borrar):
+    '''
+    Devuelve verdadero si la operacion elimina la disciplina raiz de una
+    interfaz. Falla si la interfaz todavia tiene la disciplina por defecto,
+    por lo que su error se ignora.
+    '''
+    return borrar and isinstance(objeto, Qdisc) and objeto.padre == 'root'
+
+
+def linea_tc(objeto, borrar=False):
+    '''
+    Devuelve el comando de tc del script sh que aplica la operacion, o None
+    si el objeto no es del tc.
+    '''
+    comando = tc(objeto, borrar)
+    if comando is None:
+        return None
+    if limpieza(objeto, borrar):
+        return "%s %s 2>/dev/null || true" % (TC, comando)
+    return "%s %s" % (TC, comando)
+
+
+def sh(operaciones):
+    '''
+    Devuelve las lineas del script sh que aplica las operaciones.
+    '''
+    return list(iter_sh(operaciones))
+
+
+def iter_sh(operaciones):
+    '''
+    Genera las lineas del script sh que aplica las operaciones a medida que
+    se recorren.
+    '''
+    for objeto, borrar in operaciones:
+        if isinstance(objeto, Comentario):
+            yield "# DEBUG: %s" % objeto.texto
+            continue
+        comandos = iptables(objeto, borrar)
+        if comandos is not None:
+            for comando in comandos:
+                yield comando
+            continue
+        comando = linea_tc(objeto, borrar)
+        if comando is None:
+            raise ValueError("Objeto no soportado: %r" % objeto)
+        yield comando
+
+
+class IptablesRestore:
+    '''
+    Acumula operaciones de iptables en el formato que entiende
+    iptables-restore.
+    '''
+
+    def __init__(self):
+        # tabla -> {'cadenas': {cadena: politica}, 'reglas': Acumulador}
+        self.tablas = OrderedDict()
+
+    def tabla(self, nombre):
+        '''
+        Devuelve la tabla con el nombre pasado por parametro. Si no existe la
+        crea.
+        '''
+        if nombre not in self.tablas:
+            self.tablas[nombre] = {
+                'cadenas': OrderedDict(),
+                'reglas': Acumulador(),
+            }
+        return self.tablas[nombre]
+
+    def agregar(self, objeto, borrar=False):
+        '''
+        Agrega una operacion sobre un objeto de iptables.
+
+        Devuelve falso en caso que el objeto no sea de iptables.
+        '''
+        if objeto_tabla(objeto) is None:
+            return False
+        tabla = self.tabla(objeto.tabla)
+        if isinstance(objeto, Vaciado):
+            # iptables-restore vacia y elimina todas las cadenas de las tablas
+            # que carga, alcanza con registrar la tabla
+            pass
+        elif isinstance(objeto, PoliticaCadena):
+            tabla['cadenas'][objeto.cadena] = objeto.destino
+        elif isinstance(objeto, Cadena) and not borrar:
+            tabla['cadenas'][objeto.nombre] = '-'
+        elif isinstance(objeto, Cadena):
+            tabla['reglas'].agregar("-X %s" % objeto.nombre)
+        else:
+            tabla['reglas'].agregar(regla(objeto, borrar))
+        return True
+
+    def lineas(self):
+        '''
+        Genera las lineas en formato iptables-restore, una seccion por tabla
+        terminada en COMMIT.
+        '''
+        for nombre, tabla in self.tablas.items():
+            yield "*%s" % nombre
+            for cadena, politica in tabla['cadenas'].items():
+                yield ":%s %s [0:0]" % (cadena, politica)
+            for linea in tabla['reglas']:
+                yield linea
+            yield "COMMIT"
+
+
+class TcBatch:
+    '''
+    Acumula operaciones del tc agrupadas por interfaz en el formato que
+    entiende `tc -batch`.
+
+    `tc -batch` termina con error si falla cualquiera de sus comandos, por lo
+    que las operaciones que eliminan la disciplina raiz se guardan aparte,
+    para ejecutarlas antes ignorando su error.
+    '''
+
+    def __init__(self):
+        # interfaz -> [comando, ...]
+        self.interfaces = OrderedDict()
+        # interfaz -> [comando, ...] que eliminan la disciplina raiz
+        self.limpiezas = OrderedDict()
+
+    def agregar(self, objeto, borrar=False):
+        '''
+        Agrega una operacion sobre un objeto del tc.
+
+        Devuelve falso en caso que el objeto no sea del tc.
+        '''
+        comando = tc(objeto, borrar)
+        if comando is None:
+            return False
+        comandos = self.interfaces.setdefault(objeto.interfaz, list())
+        if limpieza(objeto, borrar):
+            comandos = self.limpiezas.setdefault(objeto.interfaz, list())
+        comandos.append(comando)
+        return True
+
+    def lineas(self, interfaz):
+        '''
+        Devuelve los comandos de la interfaz en formato tc -batch.
+        '''
+        return list(self.interfaces.get(interfaz, []))
+
+
+def inverso(operaciones):
+    '''
+    Devuelve las operaciones que deshacen las operaciones pasadas por
+    parametro, en orden inverso. Los comentarios se descartan.
+    '''
+    return [(objeto, not borrar) for objeto, borrar in reversed(operaciones)
+            if not isinstance(objeto, Comentario)]
+
+
+def separar_tc(operaciones):
+    '''
+    Separa las operaciones del tc del resto.
+
+    Devuelve una tupla con un generador de las operaciones restantes y un
+    objeto TcBatch con los comandos de tc agrupados por interfaz, que se
+    completa a medida que se recorren las operaciones restantes.
+    '''
+    batch = TcBatch()
+    resto = ((objeto, borrar) for objeto, borrar in operaciones
+             if not batch.agregar(objeto, borrar))
+    return resto, batch
+
+
+def script_restore(operaciones, noflush=False):
+    '''
+    Genera las lineas del script que aplica las operaciones, cargando todas
+    las reglas de iptables con una unica llamada a iptables-restore.
+
+    El resto de los comandos (tc) se mantienen en el mismo orden. Con noflush
+    no se vacian las tablas, para aplicar solo las diferencias de un despacho
+    incremental.
+    '''
+    restore = IptablesRestore()
+    for linea in iter_sh((objeto, borrar) for objeto, borrar in operaciones
+                         if not restore.agregar(objeto, borrar)):
+        yield linea
+    yield "%s%s <<'EOF'" % (IPTABLES_RESTORE, ' --noflush' if noflush else '')
+    for linea in restore.lineas():
+        yield linea
+    yield "EOF"
+
+
+def lineas_ipset(conjuntos):
+    '''
+    Devuelve las lineas en formato `ipset restore` que crean y cargan los
+    conjuntos pasados por parametro.
+    '''
+    return list(iter_ipset(conjuntos))
+
+
+def iter_ipset(conjuntos):
+    '''
+    Genera las lineas en formato `ipset restore` que crean y cargan los
+    conjuntos pasados por parametro.
+
+    Los conjuntos compartidos por varias politicas se cargan una sola vez, y
+    los miembros de un conjunto `list:set` se cargan antes que la lista. Los
+    elementos se cargan en un conjunto temporal que se intercambia con `swap`
+    por el conjunto que utilizan las reglas y luego se elimina.
+    '''
+    cargados = set()
+
+    def cargar(conjunto):
+        if conjunto.nombre in cargados:
+            return
+        cargados.add(conjunto.nombre)
+        if conjunto.tipo == Conjunto.LISTA:
+            for miembro in conjunto.elementos:
+                for linea in cargar(miembro):
+                    yield linea
+        temporal = conjunto.nombre + Conjunto.TEMPORAL
+        yield "create %s %s -exist" % (temporal, conjunto.tipo)
+        yield "flush %s" % temporal
+        for elemento in conjunto.elementos:
+            yield "add %s %s -exist" % (temporal, elemento)
+        yield "create %s %s -exist" % (conjunto.nombre, conjunto.tipo)
+        yield "swap %s %s" % (temporal, conjunto.nombre)
+        yield "destroy %s" % temporal
+
+    for conjunto in conjuntos:
+        for linea in cargar(conjunto):
+            yield linea
+
+
+def limpieza_ipset(ipset=IPSET):
+    '''
+    Devuelve el comando de sh que elimina los conjuntos del despachante que
+    ya no se utilizan. Los que todavia utilizan las reglas o un conjunto
+    `list:set` no se pueden eliminar y se conservan.
+    '''
+    return ("%s list -n 2>/dev/null | grep '^%s-' | while read conjunto; "
+            "do %s destroy \"$conjunto\" 2>/dev/null || true; done"
+            % (ipset, Conjunto.PREFIJO, ipset))
+
+
+def script_ipset(conjuntos):
+    '''
+    Genera las lineas del script que cargan los conjuntos de ipset con una
+    unica llamada a `ipset restore`.
+    '''
+    yield "%s restore <<'EOF'" % IPSET
+    for linea in iter_ipset(conjuntos):
+        yield linea
+    yield "EOF"
+
+
+# Tabla de nftables del despachante
+TABLA_NFT = 'netcop'
+
+# Prioridad de la cadena base de cada tabla de iptables en nftables
+PRIORIDAD_NFT = OrderedDict([(MANGLE, -150), (FILTER, 0)])
+
+# Dias de la semana de nftables, segun `datetime.weekday()`
+DIAS_NFT = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday')
+
+
+def nombre_nft(tabla, nombre):
+    '''
+    Devuelve el nombre en nftables de una cadena de iptables. Las cadenas de
+    ambas tablas conviven en una unica tabla de nftables.
+    '''
+    nombre = nombre.lower().replace('-', '_')
+    return nombre if tabla == FILTER else "%s_%s" % (tabla, nombre)
+
+
+def valores_nft(valor, rango=False):
+    '''
+    Devuelve una lista de valores separados por coma en formato nftables. Los
+    rangos de puertos `inicio:fin` se traducen a `inicio-fin`.
+    '''
+    valores = [str(v).strip() for v in str(valor).split(',')]
+    if rango:
+        valores = [v.replace(':', '-') for v in valores]
+    if len(valores) == 1:
+        return valores[0]
+    return "{ %s }" % ", ".join(valores)
+
+
+def flags_nft(flags):
+    '''
+    Traduce los flags de una regla de iptables a expresiones de nftables.
+    '''
+    flags = OrderedDict(flags)
+    protocolo = flags.get(Flag.PROTOCOLO)
+    puertos = (Flag.PUERTO_ORIGEN, Flag.PUERTO_DESTINO, Flag.PUERTOS_ORIGEN,
+               Flag.PUERTOS_DESTINO)
+    campos = {
+        Flag.IP_ORIGEN: 'ip saddr',
+        Flag.IP_DESTINO: 'ip daddr',
+        Flag.MAC_ORIGEN: 'ether saddr',
+        Flag.PUERTO_ORIGEN: 'sport',
+        Flag.PUERTOS_ORIGEN: 'sport',
+        Flag.PUERTO_DESTINO: 'dport',
+        Flag.PUERTOS_DESTINO: 'dport',
+    }
+    expresiones = list()
+    for key, valor in flags.items():
+        if key == Flag.INTERFAZ_ENTRADA:
+            expresiones.append('iifname "%s"' % valor)
+        elif key == Flag.EXTENSION_MAC:
+            continue
+        elif key == Flag.PROTOCOLO:
+            if not [p for p in puertos if p in flags]:
+                expresiones.append("meta l4proto %s" % valor)
+        elif isinstance(valor, Conjunto):
+            expresiones.append("%s @%s" % (campos[key],
+                                           nombre_nft(FILTER, valor.nombre)))
+        elif key in puertos:
+            expresiones.append("%s %s %s" % (protocolo, campos[key],
+                                             valores_nft(valor, rango=True)))
+        elif key in campos:
+            expresiones.append("%s %s" % (campos[key], valores_nft(valor)))
+        elif key == Flag.HORARIO and isinstance(valor, Horario):
+            expresiones.append('meta day { %s } meta hour "%s"-"%s"' % (
+                ", ".join('"%s"' % DIAS_NFT[d] for d in valor.dias),
+                valor.inicio.strftime('%H:%M:%S'),
+                valor.fin.strftime('%H:%M:%S'),
+            ))
+        elif key == Flag.MARCA:
+            marca, mascara = valor.split('/')
+            expresiones.append("meta mark & %s == %s" % (mascara, marca))
+        else:
+            raise ValueError("Flag no soportado en nftables: %s" % key)
+    return expresiones
+
+
+def regla_nft(objeto):
+    '''
+    Devuelve la regla de nftables equivalente a la regla de iptables.
+    '''
+    destinos = {ACCEPT: 'accept', REJECT: 'reject', RETURN: 'return',
+                GUARDAR_MARCA: 'ct mark set meta mark',
+                RESTAURAR_MARCA: 'meta mark set ct mark'}
+    if objeto.destino == MARK:
+        destino = "meta mark set %d" % objeto.marca
+    elif objeto.destino in destinos:
+        destino = destinos[objeto.destino]
+    else:
+        destino = "jump %s" % nombre_nft(objeto.tabla, objeto.destino)
+    return " ".join(flags_nft(objeto.flags) + [destino])
+
+
+def conjunto_nft(conjunto):
+    '''
+    Devuelve la declaracion del conjunto de ipset como set de nftables. Los
+    conjuntos `list:set` se declaran con los elementos de sus miembros.
+    '''
+    lineas = ["set %s {" % nombre_nft(FILTER, conjunto.nombre)]
+    if conjunto.tipo == Conjunto.MAC:
+        lineas.append("type ether_addr")
+    else:
+        lineas.extend(["type ipv4_addr", "flags interval"])
+    elementos = conjunto.hojas()
+    if elementos:
+        lineas.append("elements = { %s }" % ", ".join(str(e)
+                                                      for e in elementos))
+    lineas.append("}")
+    return lineas
+
+
+class Nftables:
+    '''
+    Acumula las operaciones de iptables traducidas a nftables, para generar
+    el archivo que reemplaza la tabla del despachante.
+
+    Las cadenas FORWARD de cada tabla de iptables se traducen a cadenas base
+    con la prioridad de la tabla. Las reglas de cada politica son contiguas,
+    por lo que sus cadenas se escriben a medida que llegan. Las operaciones de
+    borrado y el resto de los objetos se ignoran, ya que se reemplaza la tabla
+    completa.
+    '''
+
+    def __init__(self):
+        self.bases = OrderedDict(((tabla, FORWARD), Acumulador())
+                                 for tabla in PRIORIDAD_NFT)
+        self.politicas = dict()
+        self.cadenas = Acumulador()
+        self.abierta = None
+
+    def agregar(self, objeto, borrar=False):
+        '''
+        Agrega una operacion sobre un objeto de iptables.
+
+        Devuelve falso en caso que el objeto no sea de iptables.
+        '''
+        if objeto_tabla(objeto) is None:
+            return False
+        if borrar:
+            return True
+        if isinstance(objeto, Cadena):
+            self.abrir((objeto.tabla, objeto.nombre))
+        elif isinstance(objeto, Regla):
+            clave = (objeto.tabla, objeto.cadena)
+            if clave in self.bases:
+                self.bases[clave].agregar(regla_nft(objeto))
+            else:
+                # si la cadena ya se cerro se abre otro bloque, nft agrega
+                # las reglas a la cadena existente
+                self.abrir(clave)
+                self.cadenas.agregar(regla_nft(objeto))
+        elif isinstance(objeto, PoliticaCadena):
+            self.politicas[(objeto.tabla, objeto.cadena)] = objeto.destino
+        return True
+
+    def abrir(self, clave):
+        '''
+        Abre el bloque de la cadena, cerrando el bloque anterior.
+        '''
+        if self.abierta == clave:
+            return
+        self.cerrar()
+        self.cadenas.agregar("chain %s {" % nombre_nft(*clave))
+        self.abierta = clave
+
+    def cerrar(self):
+        '''
+        Cierra el bloque de la cadena abierta.
+        '''
+        if self.abierta is not None:
+            self.cadenas.agregar("}")
+            self.abierta = None
+
+    def lineas(self, conjuntos=()):
+        '''
+        Genera las lineas del archivo de nftables con las reglas acumuladas y
+        los conjuntos pasados por parametro.
+        '''
+        self.cerrar()
+        yield "table ip %s" % TABLA_NFT
+        yield "delete table ip %s" % TABLA_NFT
+        yield "table ip %s {" % TABLA_NFT
+        cargados = set()
+        for conjunto in conjuntos:
+            if conjunto.nombre not in cargados:
+                cargados.add(conjunto.nombre)
+                for linea in conjunto_nft(conjunto):
+                    yield linea
+        for linea in self.cadenas:
+            yield linea
+        for (tabla, cadena), reglas in self.bases.items():
+            yield "chain %s {" % nombre_nft(tabla, cadena)
+            yield "type filter hook forward priority %d; policy %s;" % (
+                PRIORIDAD_NFT[tabla],
+                self.politicas.get((tabla, cadena), ACCEPT).lower())
+            for linea in reglas:
+                yield linea
+            yield "}"
+        yield "}"
+
+
+def script_nft(operaciones, conjuntos=()):
+    '''
+    Genera las lineas del script que cargan las reglas de iptables de las
+    operaciones con una unica llamada a nft. Los comandos de tc se mantienen
+    antes de la carga.
+    '''
+    carga = Nftables()
+    comandos = list()
+    for objeto, borrar in operaciones:
+        if not carga.agregar(objeto, borrar):
+            comando = linea_tc(objeto, borrar)
+            if comando is not None:
+                comandos.append(comando)
+    for comando in comandos:
+        yield comando
+    yield "%s -f - <<'EOF'" % NFT
+    for linea in carga.lineas(conjuntos):
+        yield linea
+    yield "EOF"
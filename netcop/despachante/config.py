@@ -13,6 +13,27 @@ El formato del archivo esperado es
     url_download=http://netcop.com/download
     local_version=/var/local/netcop/version
 
+    [despachante]
+    iptables_restore=no
+    tc_batch=no
+    ipset=no
+    multiport=no
+    incremental=no
+    cadenas=no
+    notificaciones=no
+    ventana_notificaciones=2
+    horario_kernel=no
+    nftables=no
+    agregacion=no
+    directo=no
+    paralelo=no
+    procesos=0
+    connmark=no
+    tiempo_maximo=300
+    metricas=/var/lib/node_exporter/textfile_collector/netcop.prom
+    historial=/var/lib/netcop/despachos.json
+    instantanea=/var/lib/netcop/politicas.pickle
+
     [database]
     host=
     database=netcop
@@ -42,6 +63,45 @@ class Default:
         'velocidad_bajada': '100',
         'velocidad_subida': '100',
     }
+    DESPACHANTE = {
+        'iptables_restore': 'no',
+        'tc_batch': 'no',
+        'ipset': 'no',
+        'multiport': 'no',
+        'incremental': 'no',
+        'cadenas': 'no',
+        'notificaciones': 'no',
+        'ventana_notificaciones': '2',
+        'horario_kernel': 'no',
+        'nftables': 'no',
+        'agregacion': 'no',
+        'directo': 'no',
+        'paralelo': 'no',
+        'procesos': '0',
+        'connmark': 'no',
+        'tiempo_maximo': '300',
+        'metricas': '',
+        'historial': '',
+        'instantanea': '',
+    }
+
+
+def opcion(seccion, nombre):
+    '''
+    Devuelve el valor de una opcion de la seccion pasada por parametro. Si la
+    opcion no se encuentra en el archivo de configuracion devuelve el valor
+    por defecto.
+    '''
+    return globals()[seccion].get(nombre, getattr(Default, seccion)[nombre])
+
+
+def habilitada(seccion, nombre):
+    '''
+    Devuelve verdadero si la opcion booleana esta habilitada.
+    '''
+    return str(opcion(seccion, nombre)).strip().lower() in ('1', 'si', 'yes',
+                                                            'true', 'on')
+
 
 config = configparser.ConfigParser()
 config.read(NETCOP_CONFIG, encoding='utf8')
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+Mantiene el despachante en ejecucion para activar y desactivar las politicas
+con rango horario en el momento exacto en que empieza o termina el rango, en
+lugar de consultar periodicamente la base de datos desde el cron.
+
+Si se le pasa una escucha de notificaciones, tambien despacha cuando se
+modifican las politicas en la base de datos. Las modificaciones recibidas
+dentro de una ventana de tiempo se agrupan en un unico despacho. Si la escucha
+pierde la conexion, se vuelve a conectar y se despacha, ya que se pudieron
+perder notificaciones. Si no se puede conectar se reintenta en el proximo
+ciclo.
+'''
+import time
+import logging
+from datetime import datetime, timedelta
+from . import models
+
+log = logging.getLogger(__name__)
+
+
+class Demonio:
+    '''
+    Despacha las politicas y duerme hasta el proximo cambio del conjunto de
+    politicas activas.
+    '''
+
+    # Tiempo maximo en segundos de cada espera. Permite detectar cambios en el
+    # reloj del sistema sin acceder a la base de datos.
+    ESPERA_MAXIMA = 300
+
+    # Cantidad de ventanas que como maximo se puede postergar un despacho
+    # mientras se sigan recibiendo notificaciones
+    MAX_VENTANAS = 10
+
+    def __init__(self, despachante, escucha=None, ventana=2,
+                 reloj=datetime.now, dormir=time.sleep):
+        '''
+        Recibe el despachante a utilizar y opcionalmente una escucha de
+        notificaciones de cambios de politicas, con la ventana en segundos en
+        la que se agrupan las notificaciones.
+
+        El reloj y la funcion para dormir se pueden reemplazar en las pruebas.
+        '''
+        self.despachante = despachante
+        self.escucha = escucha
+        self.ventana = ventana
+        self.reloj = reloj
+        self.dormir = dormir
+        # el primer despacho se aplica siempre, los siguientes solo si
+        # cambiaron las reglas
+        self.forzar = True
+
+    def despachar(self):
+        '''
+        Despacha las politicas activas y devuelve la fecha del proximo cambio
+        de politicas activas, o None si no hay cambios programados.
+        '''
+        abrir = models.db.is_closed()
+        if abrir:
+            models.db.connect()
+        try:
+            log.info("Despachando politicas")
+            self.despachante.despachar(forzar=self.forzar)
+            self.forzar = False
+            if self.despachante.cargadas is None:
+                # sin cambios desde el ultimo despacho no se cargan las
+                # politicas y sigue vigente el proximo cambio que se guardo
+                proximo = self.despachante.leer_proximo()
+            else:
+                proximo = self.despachante.proximo_cambio(
+                    politicas=self.despachante.cargadas
+                )
+        finally:
+            if abrir:
+                models.db.close()
+        log.info("Proximo cambio de politicas: %s", proximo)
+        return proximo
+
+    def esperar(self, hasta):
+        '''
+        Duerme hasta la fecha pasada por parametro o hasta recibir una
+        notificacion de cambios. Si la fecha es None duerme hasta recibir una
+        notificacion, o indefinidamente si no hay escucha.
+        '''
+        while hasta is None or self.reloj() < hasta:
+            segundos = self.ESPERA_MAXIMA
+            if hasta is not None:
+                restante = (hasta - self.reloj()).total_seconds()
+                segundos = max(min(segundos, restante), 0)
+            if self.escucha is None:
+                self.dormir(segundos)
+            elif self.escucha.esperar(segundos):
+                self.agrupar()
+                # las politicas notificadas se consultan en la base de datos
+                # aunque la version de sus tablas no haya cambiado
+                self.despachante.descartar_instantanea()
+                return
+
+    def agrupar(self):
+        '''
+        Espera a que no se reciban notificaciones durante una ventana, para
+        agrupar una rafaga de modificaciones en un unico despacho. El
+        despacho no se posterga mas de MAX_VENTANAS ventanas.
+        '''
+        limite = self.reloj() + timedelta(
+            seconds=self.ventana * self.MAX_VENTANAS
+        )
+        while self.reloj() < limite:
+            if not self.escucha.esperar(self.ventana):
+                return
+        log.info("Se recibieron notificaciones durante %d segundos, se "
+                 "despacha igualmente", self.ventana * self.MAX_VENTANAS)
+
+    def ciclo(self):
+        '''
+        Despacha las politicas y espera hasta el proximo cambio.
+        '''
+        self.esperar(self.despachar())
+
+    def ejecutar(self):
+        '''
+        Ejecuta el demonio indefinidamente.
+        '''
+        log.info("Iniciando demonio de despacho")
+        while True:
+            try:
+                self.ciclo()
+            except Exception as e:
+                log.exception("Error en el despacho: %s", e)
+                self.dormir(self.ESPERA_MAXIMA)
@@ -4,11 +4,16 @@ Encargado de transformar las politicas creadas por el usuario en comandos que
 el sistema operativo pueda reconocer.
 '''
 import os
+import json
+import shutil
+import hashlib
 import logging
-import subprocess
-from . import models, config
+import multiprocessing
+from . import models, config, comandos, reglas, metricas, aplicacion
+from .instantanea import Instantanea
+from . import vigencia
+from contextlib import contextmanager
 from datetime import datetime
-from jinja2 import Environment, PackageLoader
 
 log = logging.getLogger(__name__)
 
@@ -24,86 +29,269 @@ class Despachante:
     # operativo se reinicia
     SCRIPT_FILE = '/tmp/netcop-despachar-politicas'
 
-    @property
-    def fecha_ultimo_despacho(self):
+    # Archivos con los comandos de tc de cada interfaz en modo tc -batch
+    TC_BATCH_FILE = '/tmp/netcop-despachar-tc-%s'
+
+    # Estado del ultimo despacho incremental. Al igual que el script, se
+    # elimina cuando el sistema operativo se reinicia y se pierden las reglas
+    ESTADO_FILE = '/tmp/netcop-despachar-estado.json'
+
+    # Numero de las clases de cada politica en el ultimo despacho con
+    # connmark, que se conserva para las conexiones abiertas
+    NUMEROS_FILE = '/tmp/netcop-despachar-numeros.json'
+
+    # Huella del conjunto de reglas aplicado en el ultimo despacho
+    HUELLA_FILE = '/tmp/netcop-despachar-huella'
+
+    # Version de las tablas de politicas y fecha del proximo cambio de
+    # politicas activas en el ultimo despacho
+    VERSION_FILE = vigencia.ARCHIVO
+
+    # Comandos y copias de los archivos del ultimo despacho completo que se
+    # aplico correctamente, para restaurarlo si falla un despacho
+    BUENO_FILE = '/tmp/netcop-despachar-bueno.json'
+
+    # Cerrojo que impide que dos despachos se ejecuten al mismo tiempo
+    CERROJO_FILE = aplicacion.CERROJO
+
+    TC = '/sbin/tc'
+    IPSET = '/sbin/ipset'
+    IPTABLES_RESTORE = '/sbin/iptables-restore'
+    NFT = '/usr/sbin/nft'
+
+    # Numero maximo de politica. Los numeros 9998 y 9999 son las colas por
+    # defecto y raiz del tc
+    MAX_NUMERO_POLITICA = 9997
+
+    def __init__(self, iptables_restore=None, tc_batch=None, ipset=None,
+                 multiport=None, incremental=None, cadenas=None,
+                 horario_kernel=None, nftables=None, agregacion=None,
+                 directo=None, paralelo=None, connmark=None):
         '''
-        Obtiene la fecha y hora del ultimo despacho.
-        Devuelve None si no se encontro despacho anterior.
+        Inicializa las opciones del despachante. Las opciones que no se pasan
+        por parametro se leen del archivo de configuracion.
+
+        * iptables_restore: carga las reglas de iptables con una unica llamada
+          a iptables-restore en lugar de ejecutar un comando por regla.
+        * tc_batch: aplica los comandos de tc con una unica llamada a
+          `tc -batch` por interfaz.
+        * ipset: captura las redes de cada clase de trafico y las mac-address
+          de cada politica con conjuntos de ipset.
+        * multiport: agrupa los puertos de cada protocolo en reglas de
+          multiport, uniendo los puertos consecutivos en rangos.
+        * incremental: aplica solo las reglas de las politicas que cambiaron
+          desde el ultimo despacho.
+        * cadenas: agrega las reglas de cada politica en una cadena propia, a
+          la que se entra con un unico salto desde FORWARD.
+        * horario_kernel: evalua los rangos horarios de las politicas en el
+          kernel con el modulo time de iptables, de manera que no hace falta
+          volver a despachar cuando empieza o termina un rango.
+        * nftables: carga las reglas en una tabla de nftables en lugar de
+          utilizar iptables. Como nftables reemplaza la tabla completa de
+          manera atomica, no se aplica el despacho incremental.
+        * agregacion: agrupa las redes de origen y destino de cada politica
+          en la menor cantidad de prefijos, descartando las redes repetidas o
+          contenidas en otras y uniendo las redes contiguas.
+        * directo: aplica las reglas escribiendolas en la entrada de
+          `tc -batch`, `ipset restore` e iptables-restore (o nft) a medida que
+          se generan, sin escribir el script ni archivos temporales.
+        * paralelo: construye las reglas de las politicas en paralelo, con la
+          cantidad de procesos de la opcion `procesos` del archivo de
+          configuracion, o uno por procesador si es 0.
+        * connmark: clasifica solo el primer paquete de cada conexion y
+          guarda su marca en la conexion. Los paquetes siguientes recuperan la
+          marca con una unica regla al principio de la tabla mangle. Cada
+          politica conserva el numero de sus clases entre despachos, para que
+          las conexiones abiertas sigan en la clase de su politica.
         '''
-        try:
-            return datetime.fromtimestamp(os.path.getmtime(self.SCRIPT_FILE))
-        except OSError:
-            return None
+        self.iptables_restore = self._opcion('iptables_restore',
+                                             iptables_restore)
+        self.tc_batch = self._opcion('tc_batch', tc_batch)
+        self.ipset = self._opcion('ipset', ipset)
+        self.multiport = self._opcion('multiport', multiport)
+        self.incremental = self._opcion('incremental', incremental)
+        self.cadenas = self._opcion('cadenas', cadenas)
+        self.horario_kernel = self._opcion('horario_kernel', horario_kernel)
+        self.nftables = self._opcion('nftables', nftables)
+        self.agregacion = self._opcion('agregacion', agregacion)
+        self.directo = self._opcion('directo', directo)
+        self.paralelo = self._opcion('paralelo', paralelo)
+        self.connmark = self._opcion('connmark', connmark)
+        # cantidad de procesos que construyen las reglas, None si no se
+        # construyen en paralelo
+        self.procesos = None
+        if self.paralelo:
+            self.procesos = (int(config.opcion('DESPACHANTE', 'procesos')) or
+                             multiprocessing.cpu_count())
+        if self.nftables and self.incremental:
+            log.warning("El despacho incremental no se aplica con nftables")
+            self.incremental = False
+        # tiempos y contadores del ultimo despacho
+        self.metricas = metricas.Metricas()
+        # duracion en segundos de cada etapa del ultimo despacho
+        self.tiempos = self.metricas.tiempos
+        # archivos donde se exportan las metricas de cada despacho
+        self.archivo_metricas = config.opcion('DESPACHANTE', 'metricas')
+        self.archivo_historial = config.opcion('DESPACHANTE', 'historial')
+        # instantanea local de las politicas, None si no se utiliza
+        self.instantanea = None
+        if config.opcion('DESPACHANTE', 'instantanea'):
+            self.instantanea = Instantanea(config.opcion('DESPACHANTE',
+                                                         'instantanea'))
+        # ejecuta los comandos del despacho, con el tiempo maximo en segundos
+        # de cada comando
+        self.ejecutor = aplicacion.Ejecutor(
+            int(config.opcion('DESPACHANTE', 'tiempo_maximo')) or None
+        )
+        # todas las politicas activas de la ultima consulta, incluso fuera de
+        # su rango horario, para calcular el proximo cambio sin cargarlas
+        # nuevamente
+        self.cargadas = None
+        # numero de cada politica del despacho en curso con connmark, que se
+        # guarda cuando se aplica correctamente
+        self.numeros = None
+        # cantidad de reglas antes y despues de agrupar puertos
+        self.compactacion = None
+        # cantidad de redes antes y despues de agruparlas
+        self.agrupacion = None
 
-    def hay_reglas_temporales(self):
+    @staticmethod
+    def _opcion(nombre, valor):
         '''
-        Devuelve verdadero en caso que existan politicas en la base de datos
-        que posean un rango horario de validez.
+        Devuelve el valor pasado por parametro. Si es None devuelve el valor de
+        la opcion en el archivo de configuracion.
         '''
-        now = datetime.now()
-        return (models.RangoHorario
-                      .select(models.RangoHorario.dia == now.weekday())
-                      .exists())
+        if valor is None:
+            return config.habilitada('DESPACHANTE', nombre)
+        return valor
+
+    @contextmanager
+    def etapa(self, nombre):
+        '''
+        Mide el tiempo que tarda en ejecutarse una etapa del despacho.
+        '''
+        try:
+            with self.metricas.etapa(nombre):
+                yield
+        finally:
+            log.info("Etapa %s: %.3f segundos", nombre, self.tiempos[nombre])
 
     def hay_cambio_de_politicas(self):
         '''
-        Devuelve verdadero en caso que existan cambios en las politicas
-        despachadas por ultima vez y las politicas vigentes en el momento
-        actual.
+        Devuelve verdadero en caso que el conjunto de reglas de las politicas
+        vigentes en el momento actual sea distinto del aplicado en el ultimo
+        despacho.
+
+        Se comparan las huellas de las reglas generadas, por lo que se detectan
+        tanto las politicas activadas o desactivadas por su rango horario como
+        las modificaciones de objetivos, redes o velocidades.
         '''
-        ultimo_despacho = self.fecha_ultimo_despacho
+        anterior = self.leer_huella()
         # si no se encontro ultimo despacho, hay cambios de politicas
-        if ultimo_despacho is None:
+        if anterior is None:
             log.info("No se encontro despacho previo")
             return True
-        anterior = set(self.obtener_politicas(ultimo_despacho))
-        ahora = set(self.obtener_politicas())
-        log.debug("Politicas activas el ultimo despacho: %s" %
-                  [str(p) for p in anterior])
-        log.debug("Politicas activas ahora: %s" %
-                  [str(p) for p in ahora])
-        # si la diferencia es distinta de cero, hay cambios
-        return len(anterior - ahora) + len(ahora - anterior) != 0
+        huella = self.calcular_huella(self.obtener_politicas())
+        log.debug("Huella del ultimo despacho: %s, huella actual: %s",
+                  anterior, huella)
+        return huella != anterior
+
+    def cargar_politicas(self, guardar=True):
+        '''
+        Devuelve las politicas activas con su grafo precargado, desde la
+        instantanea local si esta configurada y sigue vigente. Si guardar es
+        falso no se actualiza la instantanea.
+        '''
+        consulta = models.Politica.select().where(
+            models.Politica.activa == True
+        )
+        if self.instantanea is None:
+            return models.precargar(consulta)
+        politicas = self.instantanea.politicas(consulta, guardar)
+        self.metricas.contadores['instantanea'] = int(self.instantanea.usada)
+        return politicas
+
+    def descartar_instantanea(self):
+        '''
+        Descarta la instantanea local, para que el proximo despacho consulte
+        las politicas en la base de datos.
+        '''
+        if self.instantanea is not None:
+            self.instantanea.descartar()
 
-    def obtener_politicas(self, fecha=None):
+    def obtener_politicas(self, fecha=None, guardar=True):
         '''
         Obtiene una lista de politicas activas en la fecha pasada por
         parametro.
 
         En caso que no se pase fecha por parametro, obtiene las politicas
         activas en el momento actual.
+
+        Si los rangos horarios se evaluan en el kernel se devuelven todas las
+        politicas activas, sin importar sus rangos horarios. Si guardar es
+        falso no se actualiza la instantanea local.
         '''
         fecha = datetime.now() if fecha is None else fecha
-        politicas = models.Politica.select().where(
-            models.Politica.activa == True
-        )
-        return [p for p in politicas if p.esta_activa(fecha)]
+        with self.etapa('cargar_politicas'):
+            politicas = self.cargar_politicas(guardar)
+        self.cargadas = politicas
+        if self.horario_kernel:
+            return politicas
+        with self.etapa('evaluar_actividad'):
+            return [p for p in politicas if p.esta_activa(fecha)]
 
-    def despacho_necesario(self):
+    def proximo_cambio(self, fecha=None, politicas=None):
         '''
-        Devuelve verdadero en caso que sea necesario un nuevo despacho.
+        Devuelve la fecha y hora posterior a la fecha pasada por parametro en
+        la que cambia el conjunto de politicas activas debido a sus rangos
+        horarios. Si no se pasan las politicas activas se cargan.
 
-        Sera necesario un nuevo despacho cuando no exista un despacho anterior,
-        o cuando existan reglas temporales y haya que activar o desactivar
-        politicas debido al paso del tiempo.
+        Devuelve None si el conjunto de politicas activas no cambia con el
+        paso del tiempo, o si los rangos horarios se evaluan en el kernel.
         '''
-        reglas_temporales = self.hay_reglas_temporales()
-        cambio_politicas = self.hay_cambio_de_politicas()
-        log.debug("Hay reglas temporales? %s" % reglas_temporales)
-        log.debug("Hay cambio politicas? %s" % cambio_politicas)
-        return (self.fecha_ultimo_despacho is None or reglas_temporales and
-                cambio_politicas)
+        if self.horario_kernel:
+            return None
+        fecha = datetime.now() if fecha is None else fecha
+        if politicas is None:
+            politicas = self.cargar_politicas()
+        limites = sorted(set(limite for p in politicas for h in p.horarios
+                             for limite in h.limites(fecha)))
+        actuales = set(p for p in politicas if p.esta_activa(fecha))
+        for limite in limites:
+            # los limites contiguos de una misma politica no la desactivan
+            if set(p for p in politicas if p.esta_activa(limite)) != actuales:
+                return limite
+        return None
 
-    def despachar(self):
+    def contexto(self, politicas):
         '''
-        Genera el script bash con las politicas activas en este momento y lo
-        manda a ejecutar al sistema operativo.
+        Prepara las politicas segun las opciones del despachante y devuelve los
+        parametros para construir su representacion intermedia.
         '''
-        env = Environment(loader=PackageLoader('netcop.despachante'))
-        template = env.get_template('main.jinja')
-        politicas = self.obtener_politicas()
-        contexto = {
-            'politicas': politicas,
+        for politica in politicas:
+            politica.usar_ipset = self.ipset
+            politica.usar_multiport = self.multiport
+            politica.usar_horario_kernel = self.horario_kernel
+            politica.usar_agregacion = self.agregacion
+        if self.multiport:
+            self.compactacion = (
+                sum(p.cantidad_reglas(multiport=False) for p in politicas),
+                sum(p.cantidad_reglas() for p in politicas),
+            )
+            self.metricas.contadores['reglas_sin_multiport'] = \
+                self.compactacion[0]
+            log.info("Reglas antes de agrupar puertos: %d, despues: %d",
+                     *self.compactacion)
+        if self.agregacion:
+            cantidades = [p.cantidad_redes() for p in politicas]
+            antes = sum(x[0] for x in cantidades)
+            despues = sum(x[1] for x in cantidades)
+            self.agrupacion = (antes, despues)
+            self.metricas.contadores['redes_sin_agrupar'] = antes
+            self.metricas.contadores['redes'] = despues
+            log.info("Redes antes de agrupar: %d, despues: %d, se eliminaron "
+                     "%d prefijos", antes, despues, antes - despues)
+        return {
             'if_outside': config.NETCOP['outside'],
             'if_inside': config.NETCOP['inside'],
             'bw_bajada': config.NETCOP['velocidad_bajada'],
@@ -111,15 +299,913 @@ class Despachante:
             'cant_alta_prioridad': len(
                 [x for x in politicas if x.prioridad == x.PRIO_ALTA]
             ),
+            'usar_cadenas': self.cadenas,
+            'usar_ipset': self.ipset,
+            'usar_connmark': self.connmark,
         }
+
+    def configuracion(self, politicas, numeros=None, perezosa=False):
+        '''
+        Construye la representacion intermedia de la configuracion del kernel
+        con las politicas pasadas por parametro.
+
+        Si se pasa un diccionario con el numero de cada politica se utiliza
+        para las clases del tc en lugar de la posicion en la lista. Si es
+        perezosa, los objetos de cada politica se construyen a medida que se
+        recorren las operaciones.
+        '''
+        log.debug("Construyendo reglas")
+        constructor = reglas.Constructor(**self.contexto(politicas))
+        return constructor.configuracion(politicas, numeros, perezosa,
+                                         self.metricas, self.procesos)
+
+    def emitir(self, operaciones, conjuntos=(), noflush=False):
+        '''
+        Genera el script que aplica las operaciones segun las opciones del
+        despachante: carga de conjuntos de ipset, formato iptables-restore o
+        nftables y comandos de tc con tc -batch.
+
+        Devuelve una tupla con un generador de las lineas del script y los
+        comandos de tc agrupados por interfaz (TcBatch), o None si los
+        comandos de tc estan en el script. El TcBatch se completa a medida que
+        se recorren las lineas del script.
+        '''
+        batch = None
+        if self.tc_batch:
+            operaciones, batch = comandos.separar_tc(operaciones)
+        return self.lineas(operaciones, conjuntos, noflush), batch
+
+    def lineas(self, operaciones, conjuntos, noflush):
+        '''
+        Genera las lineas del script que aplica las operaciones.
+        '''
+        for linea in comandos.CABECERA:
+            yield linea
+        if self.nftables:
+            log.debug("Traduciendo reglas a nftables")
+            for linea in comandos.script_nft(operaciones, conjuntos):
+                yield linea
+            return
+        if self.ipset and conjuntos:
+            log.debug("Agregando conjuntos de ipset")
+            for linea in comandos.script_ipset(conjuntos):
+                yield linea
+        if self.iptables_restore:
+            log.debug("Traduciendo reglas a formato iptables-restore")
+            script = comandos.script_restore(operaciones, noflush=noflush)
+        else:
+            script = comandos.iter_sh(operaciones)
+        for linea in script:
+            yield linea
+        if self.ipset:
+            # los conjuntos de las politicas y clases eliminadas dejan de
+            # estar en uso luego de cargar las reglas
+            yield comandos.limpieza_ipset()
+
+    def generar_script(self, politicas, numeros=None):
+        '''
+        Genera las lineas del script bash que configura el kernel con las
+        politicas pasadas por parametro.
+        '''
+        configuracion = self.configuracion(politicas, numeros)
         log.debug("Generando script")
-        script = template.render(**contexto)
-        log.debug("Escribiendo script en archivo %s" % self.SCRIPT_FILE)
-        with open(self.SCRIPT_FILE, 'w') as f:
-            for line in script.split('\n'):
-                line = line.strip()
-                if line:
-                    f.write(line + '\n')
-        # ejecuto script
-        log.debug("Ejecutando script %s" % self.SCRIPT_FILE)
-        subprocess.Popen(['/bin/sh', self.SCRIPT_FILE])
+        lineas, _ = self.emitir(configuracion.operaciones(),
+                                configuracion.conjuntos())
+        return list(lineas)
+
+    def partes(self, operaciones, conjuntos=(), noflush=False):
+        '''
+        Separa las operaciones en los programas que las aplican leyendo de su
+        entrada estandar: `tc -batch` de cada interfaz, `ipset restore` e
+        iptables-restore o nft, en el orden en que se deben ejecutar.
+
+        Devuelve una lista de pasos. Las lineas de cada paso se generan a
+        medida que se recorren y se pueden recorrer mas de una vez. Antes de
+        los comandos de cada interfaz se elimina su disciplina raiz, si
+        corresponde, ignorando el error. Al final se eliminan los conjuntos de
+        ipset que ya no se utilizan.
+        '''
+        operaciones, batch = comandos.separar_tc(operaciones)
+        if self.nftables:
+            carga = comandos.Nftables()
+            comando = [self.NFT, '-f', '-']
+        else:
+            carga = comandos.IptablesRestore()
+            comando = [self.IPTABLES_RESTORE] + (['--noflush'] if noflush
+                                                 else [])
+        for objeto, borrar in operaciones:
+            if (not carga.agregar(objeto, borrar) and
+                    not isinstance(objeto, reglas.Comentario)):
+                raise ValueError("Objeto no soportado: %r" % objeto)
+        partes = list()
+        for interfaz in batch.interfaces:
+            partes.extend(self.limpiezas(batch, interfaz))
+            partes.append(aplicacion.Paso(
+                'tc %s' % interfaz, [self.TC, '-force', '-batch', '-'],
+                batch.lineas(interfaz)
+            ))
+        if self.nftables:
+            partes.append(aplicacion.Paso(
+                'nft', comando, models.Flujo(carga.lineas, conjuntos)
+            ))
+            return partes
+        if self.ipset and conjuntos:
+            partes.append(aplicacion.Paso(
+                'ipset', [self.IPSET, 'restore'],
+                models.Flujo(comandos.iter_ipset, conjuntos)
+            ))
+        partes.append(aplicacion.Paso('iptables-restore', comando,
+                                      models.Flujo(carga.lineas)))
+        if self.ipset:
+            partes.append(aplicacion.Paso(
+                'limpieza ipset',
+                ['/bin/sh', '-c', comandos.limpieza_ipset(self.IPSET)],
+                tolerante=True
+            ))
+        return partes
+
+    def limpiezas(self, batch, interfaz):
+        '''
+        Devuelve los pasos que eliminan la disciplina raiz de la interfaz
+        antes de aplicar sus comandos con tc -batch. Son tolerantes, ya que
+        fallan si la interfaz todavia tiene la disciplina por defecto.
+        '''
+        return [aplicacion.Paso('limpieza %s' % interfaz,
+                                [self.TC] + comando.split(), tolerante=True)
+                for comando in batch.limpiezas.get(interfaz, [])]
+
+    @staticmethod
+    def huella(contenido):
+        '''
+        Devuelve una huella estable del contenido pasado por parametro, que
+        debe poder serializarse en JSON.
+        '''
+        return hashlib.sha1(
+            json.dumps(contenido, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def leer_huella(self):
+        '''
+        Lee la huella del conjunto de reglas del ultimo despacho. Devuelve None
+        si no se encontro.
+        '''
+        try:
+            with open(self.HUELLA_FILE) as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def guardar_huella(self, huella):
+        '''
+        Guarda la huella del conjunto de reglas despachado.
+        '''
+        with open(self.HUELLA_FILE, 'w') as f:
+            f.write(huella + '\n')
+
+    def descartar_huella(self):
+        '''
+        Elimina la huella y el estado incremental del ultimo despacho, para
+        que el proximo despacho aplique todas las reglas.
+        '''
+        for archivo in (self.HUELLA_FILE, self.ESTADO_FILE):
+            if os.path.exists(archivo):
+                os.remove(archivo)
+
+    def leer_version(self):
+        '''
+        Lee la version de las tablas de politicas del ultimo despacho.
+        Devuelve None si no se encontro.
+        '''
+        datos = vigencia.leer(self.VERSION_FILE)
+        return None if datos is None else datos['version']
+
+    def leer_proximo(self):
+        '''
+        Lee la fecha del proximo cambio de politicas activas guardada en el
+        ultimo despacho. Devuelve None si no hay cambios programados o no se
+        encontro.
+        '''
+        datos = vigencia.leer(self.VERSION_FILE)
+        if datos is None or datos['proximo'] is None:
+            return None
+        return datetime.fromtimestamp(datos['proximo'])
+
+    def guardar_version(self, version, proximo=None):
+        '''
+        Guarda la version de las tablas de politicas despachada y la fecha del
+        proximo cambio de politicas activas. Si la version es None se elimina
+        la del despacho anterior.
+        '''
+        if version is None:
+            if os.path.exists(self.VERSION_FILE):
+                os.remove(self.VERSION_FILE)
+            return
+        vigencia.guardar(self.VERSION_FILE, version, proximo,
+                         self.huella_opciones())
+
+    def huella_opciones(self):
+        '''
+        Devuelve el hash de las opciones del despachante y de la configuracion
+        de netcop, que cambian las reglas despachadas.
+        '''
+        return vigencia.contexto(dict((nombre, getattr(self, nombre))
+                                      for nombre in vigencia.OPCIONES))
+
+    def sin_cambios(self, version):
+        '''
+        Devuelve verdadero si la version de las tablas de politicas y las
+        opciones y la configuracion son las del ultimo despacho y todavia no
+        llego el proximo cambio de politicas activas por sus rangos horarios.
+        '''
+        datos = vigencia.leer(self.VERSION_FILE)
+        return (version is not None and datos is not None and
+                datos['version'] == version and
+                datos.get('contexto') == self.huella_opciones() and
+                not vigencia.vencida(datos))
+
+    def leer_estado(self):
+        '''
+        Lee el estado del ultimo despacho incremental. Devuelve None si no se
+        encontro.
+        '''
+        try:
+            with open(self.ESTADO_FILE) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def guardar_estado(self, estado):
+        '''
+        Guarda el estado del despacho incremental. Si el estado es None elimina
+        el estado anterior.
+        '''
+        if estado is None:
+            try:
+                os.remove(self.ESTADO_FILE)
+            except OSError:
+                pass
+            return
+        with open(self.ESTADO_FILE, 'w') as f:
+            json.dump(estado, f)
+
+    def asignar_numeros(self, politicas, anterior):
+        '''
+        Asigna un numero estable a cada politica para identificar sus clases en
+        el tc. Las politicas del despacho anterior mantienen su numero y las
+        nuevas ocupan los numeros libres mas chicos.
+        '''
+        previos = dict()
+        if anterior is not None:
+            previos = dict((int(k), v['numero'])
+                           for k, v in anterior['politicas'].items())
+        numeros = dict((p.id_politica, previos[p.id_politica])
+                       for p in politicas if p.id_politica in previos)
+        usados = set(numeros.values())
+        libre = 1
+        for politica in politicas:
+            if politica.id_politica in numeros:
+                continue
+            while libre in usados:
+                libre += 1
+            if libre > self.MAX_NUMERO_POLITICA:
+                raise ValueError("No hay numeros libres para la politica %d" %
+                                 politica.id_politica)
+            numeros[politica.id_politica] = libre
+            usados.add(libre)
+        return numeros
+
+    def leer_numeros(self):
+        '''
+        Lee los numeros de las politicas del ultimo despacho con connmark,
+        con la misma forma que el estado incremental. Devuelve None si no se
+        encontro.
+        '''
+        try:
+            with open(self.NUMEROS_FILE) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def guardar_numeros(self, numeros):
+        '''
+        Guarda el numero de cada politica. Si los numeros son None elimina
+        los del despacho anterior.
+        '''
+        if numeros is None:
+            try:
+                os.remove(self.NUMEROS_FILE)
+            except OSError:
+                pass
+            return
+        politicas = dict((str(k), {'numero': v}) for k, v in numeros.items())
+        with open(self.NUMEROS_FILE, 'w') as f:
+            json.dump({'politicas': politicas}, f)
+
+    def numerar(self, politicas):
+        '''
+        Devuelve el numero de cada politica para sus clases en el tc, o None
+        si se numeran por su posicion. Con connmark las conexiones abiertas
+        conservan la marca de su clase, por lo que cada politica mantiene el
+        numero del despacho anterior aunque se agreguen o quiten otras.
+        '''
+        if self.incremental:
+            return self.asignar_numeros(politicas, self.leer_estado())
+        if self.connmark:
+            return self.asignar_numeros(politicas, self.leer_numeros())
+        return None
+
+    @staticmethod
+    def estructura(anterior, actual):
+        '''
+        Devuelve los objetos serializados que crean la cadena de una politica
+        o saltan a ella y que no cambiaron entre los dos despachos. Al
+        modificar la politica se reemplaza solo el contenido de la cadena.
+        '''
+        if anterior is None or actual is None:
+            return []
+        return [objeto for objeto in anterior['objetos']
+                if objeto in actual['objetos'] and
+                reglas.es_estructura(reglas.desde_json(objeto))]
+
+    @staticmethod
+    def reglas_forward(objetos):
+        '''
+        Devuelve las reglas de los objetos pasados por parametro que estan en
+        la cadena FORWARD de su tabla.
+        '''
+        return [objeto for objeto in objetos
+                if isinstance(objeto, reglas.Regla) and
+                objeto.cadena == reglas.FORWARD]
+
+    def cadenas_forward(self, inicio, fragmentos):
+        '''
+        Devuelve un diccionario con las reglas de la cadena FORWARD de cada
+        tabla, en orden, como pares (politica, regla). Las reglas iniciales no
+        tienen politica.
+
+        Recibe los objetos iniciales y pares (politica, objetos) en el orden
+        de las politicas.
+        '''
+        cadenas = dict()
+        for objeto in self.reglas_forward(inicio):
+            cadenas.setdefault(objeto.tabla, []).append((None, objeto))
+        for clave, objetos in fragmentos:
+            for objeto in self.reglas_forward(objetos):
+                cadenas.setdefault(objeto.tabla, []).append((clave, objeto))
+        return cadenas
+
+    @staticmethod
+    def ubicar(cadenas, objetivo, agregar):
+        '''
+        Asigna la posicion de las reglas de FORWARD que se deben agregar para
+        que cada cadena quede en el orden de la configuracion completa.
+
+        Recibe las cadenas luego de quitar las reglas (ver `cadenas_forward`),
+        las cadenas de la configuracion completa y los pares (politica,
+        objeto) que se agregan, en el orden de las politicas. Devuelve la
+        lista de objetos a agregar, o None si las reglas que se conservan
+        quedaron en otro orden.
+        '''
+        posiciones = dict()
+        for tabla, reglas_objetivo in objetivo.items():
+            actuales = cadenas.get(tabla, [])
+            indice = 0
+            faltantes = list()
+            for posicion, regla in enumerate(reglas_objetivo, 1):
+                if indice < len(actuales) and actuales[indice] == regla:
+                    indice += 1
+                else:
+                    faltantes.append((regla, posicion))
+            if indice < len(actuales):
+                return None
+            posiciones[tabla] = faltantes
+        for tabla, actuales in cadenas.items():
+            if tabla not in objetivo and actuales:
+                return None
+        resultado = list()
+        for clave, objeto in agregar:
+            if (isinstance(objeto, reglas.Regla) and
+                    objeto.cadena == reglas.FORWARD):
+                faltantes = posiciones[objeto.tabla]
+                if not faltantes or faltantes[0][0] != (clave, objeto):
+                    return None
+                regla, posicion = faltantes.pop(0)
+                objeto = objeto.en_posicion(posicion)
+            resultado.append((objeto, False))
+        if [x for x in posiciones.values() if x]:
+            return None
+        return resultado
+
+    def generar_incremental(self, politicas):
+        '''
+        Genera las operaciones que aplican solo las diferencias entre las
+        politicas pasadas por parametro y las del ultimo despacho incremental.
+
+        Las politicas quitadas o modificadas se eliminan deshaciendo sus
+        objetos, y las nuevas o modificadas se agregan. Las politicas sin
+        cambios no se tocan. Las reglas de FORWARD se eliminan e insertan por
+        su posicion, de manera que cada politica ocupa el mismo lugar que en
+        la configuracion completa y no se elimina la regla igual de otra
+        politica. Si no hay un despacho anterior, cambio la configuracion
+        general o cambio el orden de las politicas que no se modificaron se
+        aplica la configuracion completa.
+
+        Devuelve una tupla con las operaciones, vacias si no hay cambios, los
+        conjuntos de ipset que utilizan, si se trata de la configuracion
+        completa, el estado que se debe guardar luego de aplicarla y la
+        configuracion completa.
+        '''
+        anterior = self.leer_estado()
+        numeros = self.asignar_numeros(politicas, anterior)
+        contexto = self.contexto(politicas)
+        base = dict((k, v) for k, v in contexto.items()
+                    if k != 'cant_alta_prioridad')
+        base.update(multiport=self.multiport,
+                    horario_kernel=self.horario_kernel,
+                    agregacion=self.agregacion)
+        configuracion = reglas.Constructor(**contexto).configuracion(
+            politicas, numeros, metricas=self.metricas, procesos=self.procesos
+        )
+        # los objetos iniciales, como los filtros del tc, tambien son parte
+        # de la configuracion general
+        base['inicio'] = [[objeto.a_json(), borrar]
+                          for objeto, borrar in configuracion.inicio]
+        estado = {
+            'base': self.huella(base),
+            'politicas': dict(),
+            'orden': list(),
+        }
+        for fragmento in configuracion.fragmentos:
+            estado['politicas'][str(fragmento.politica)] = {
+                'numero': fragmento.numero,
+                'objetos': [objeto.a_json() for objeto in fragmento.objetos],
+                'conjuntos': comandos.lineas_ipset(fragmento.conjuntos),
+            }
+            estado['orden'].append(str(fragmento.politica))
+        completa = (configuracion.operaciones(), configuracion.conjuntos(),
+                    True, estado, configuracion)
+        if (anterior is None or anterior.get('base') != estado['base'] or
+                'orden' not in anterior):
+            log.info("Sin despacho incremental previo, se aplica la "
+                     "configuracion completa")
+            return completa
+        previas = anterior['politicas']
+        actuales = estado['politicas']
+        inicio = [objeto for objeto, borrar in configuracion.inicio]
+        cadenas = self.cadenas_forward(inicio, [
+            (clave, [reglas.desde_json(x) for x in previas[clave]['objetos']])
+            for clave in anterior['orden']
+        ])
+        quitar = list()
+        agregar = list()
+        conjuntos = list()
+        for clave in anterior['orden']:
+            datos = previas[clave]
+            if actuales.get(clave) != datos:
+                log.debug("Quitando politica %s", clave)
+                conservar = self.estructura(datos, actuales.get(clave))
+                for objeto, borrar in comandos.inverso([
+                    (reglas.desde_json(objeto), False)
+                    for objeto in datos['objetos'] if objeto not in conservar
+                ]):
+                    if (isinstance(objeto, reglas.Regla) and
+                            objeto.cadena == reglas.FORWARD):
+                        # se elimina la regla de esta politica, aunque otra
+                        # tenga una regla igual antes en la cadena
+                        cadena = cadenas[objeto.tabla]
+                        indice = cadena.index((clave, objeto))
+                        del cadena[indice]
+                        objeto = objeto.en_posicion(indice + 1)
+                    quitar.append((objeto, borrar))
+        for fragmento in configuracion.fragmentos:
+            clave = str(fragmento.politica)
+            if previas.get(clave) != actuales[clave]:
+                log.debug("Agregando politica %s", clave)
+                conservar = self.estructura(previas.get(clave),
+                                            actuales[clave])
+                agregar.extend((clave, objeto) for objeto in fragmento.objetos
+                               if objeto.a_json() not in conservar)
+                conjuntos.extend(fragmento.conjuntos)
+        objetivo = self.cadenas_forward(inicio, [
+            (str(fragmento.politica), fragmento.objetos)
+            for fragmento in configuracion.fragmentos
+        ])
+        agregar = self.ubicar(cadenas, objetivo, agregar)
+        if agregar is None:
+            log.info("Cambio el orden de las politicas, se aplica la "
+                     "configuracion completa")
+            return completa
+        return quitar + agregar, conjuntos, False, estado, configuracion
+
+    def escribir(self, archivo, lineas):
+        '''
+        Escribe las lineas pasadas por parametro en el archivo.
+        '''
+        log.debug("Escribiendo archivo %s", archivo)
+        cantidad = 0
+        with open(archivo, 'w') as f:
+            for line in lineas:
+                f.write(line + '\n')
+                cantidad += 1
+        self.metricas.contar('lineas', cantidad)
+
+    def secciones(self, lineas, batch, archivos=False):
+        '''
+        Genera las secciones de un despacho, tuplas con el nombre de la
+        seccion, el archivo donde se escribe (None si no se escribe) y sus
+        lineas: el script y luego los comandos de tc de cada interfaz, que se
+        conocen recien al terminar de recorrer el script.
+        '''
+        yield 'script', self.SCRIPT_FILE if archivos else None, lineas
+        if batch is None:
+            return
+        for interfaz in batch.interfaces:
+            yield ('tc %s' % interfaz,
+                   self.TC_BATCH_FILE % interfaz if archivos else None,
+                   batch.lineas(interfaz))
+
+    def volcar(self, secciones):
+        '''
+        Recorre las lineas de las secciones pasadas por parametro, las escribe
+        en su archivo a medida que se generan y devuelve la huella de todas
+        ellas, sin mantener las lineas en memoria.
+        '''
+        huella = hashlib.sha1()
+
+        def leer(nombre, lineas):
+            huella.update(comandos.codificar(nombre))
+            for linea in lineas:
+                huella.update(comandos.codificar(linea))
+                yield linea
+
+        for nombre, archivo, lineas in secciones:
+            if archivo is None:
+                for linea in leer(nombre, lineas):
+                    pass
+            else:
+                self.escribir(archivo, leer(nombre, lineas))
+        return huella.hexdigest()
+
+    def volcar_partes(self, partes):
+        '''
+        Devuelve la huella de las lineas de los pasos del modo directo,
+        recorriendolas sin escribirlas.
+        '''
+        return self.volcar((paso.nombre, None, paso.lineas) for paso in partes
+                           if paso.lineas is not None)
+
+    def preparar(self, politicas):
+        '''
+        Genera las operaciones que aplican las politicas pasadas por parametro
+        segun el modo del despachante.
+
+        Devuelve una tupla con las operaciones, vacias si no hay nada que
+        aplicar, los conjuntos de ipset que utilizan, si se deben aplicar sin
+        vaciar las tablas, el estado incremental a guardar (None fuera del
+        modo incremental) y la configuracion completa de las politicas. Fuera
+        del modo incremental los objetos se construyen a medida que se
+        recorren las operaciones, y con connmark cada politica conserva el
+        numero del despacho anterior.
+        '''
+        if self.incremental:
+            operaciones, conjuntos, completa, estado, configuracion = \
+                self.generar_incremental(politicas)
+            return (operaciones, conjuntos, not completa, estado,
+                    configuracion)
+        self.numeros = self.numerar(politicas)
+        configuracion = self.configuracion(politicas, self.numeros,
+                                           perezosa=True)
+        return (configuracion.operaciones(), configuracion.conjuntos(), False,
+                None, configuracion)
+
+    def compilar(self, politicas):
+        '''
+        Genera el script de las politicas pasadas por parametro segun el modo
+        del despachante.
+
+        Devuelve una tupla con un generador de las lineas del script, vacio si
+        no hay nada que aplicar, los comandos de tc agrupados por interfaz (o
+        None) y el estado incremental a guardar (None fuera del modo
+        incremental).
+        '''
+        operaciones, conjuntos, noflush, estado, configuracion = \
+            self.preparar(politicas)
+        if not operaciones:
+            return [], None, estado
+        lineas, batch = self.emitir(operaciones, conjuntos, noflush)
+        return lineas, batch, estado
+
+    def calcular_huella(self, politicas):
+        '''
+        Devuelve la huella del conjunto de reglas de las politicas pasadas por
+        parametro. En modo incremental la huella se calcula sobre el estado,
+        que contiene las reglas de todas las politicas y no solo las
+        diferencias. En el resto de los modos se calcula recorriendo las
+        lineas que se aplicarian, sin guardarlas.
+        '''
+        operaciones, conjuntos, noflush, estado, configuracion = \
+            self.preparar(politicas)
+        if estado is not None:
+            return self.huella(estado)
+        if self.directo:
+            return self.volcar_partes(self.partes(operaciones, conjuntos,
+                                                  noflush))
+        lineas, batch = self.emitir(operaciones, conjuntos, noflush)
+        return self.volcar(self.secciones(lineas, batch))
+
+    def despachar(self, forzar=True):
+        '''
+        Genera el script bash con las politicas activas en este momento y lo
+        manda a ejecutar al sistema operativo.
+
+        Si no se fuerza el despacho y el conjunto de reglas generado es igual
+        al del ultimo despacho no se aplica nada. Devuelve verdadero si se
+        aplicaron las reglas.
+
+        En modo incremental solo se aplican las diferencias con el despacho
+        anterior.
+
+        En modo tc -batch los comandos de tc se aplican con una invocacion de
+        `tc -batch` por interfaz y se espera a que termine cada etapa para
+        informar su duracion.
+
+        Las lineas se escriben en los archivos, o en la entrada de los
+        programas en modo directo, a medida que se generan.
+
+        Las metricas del despacho se exportan al terminar, aunque falle. Los
+        despachos se ejecutan de a uno, esperando el cerrojo del archivo
+        CERROJO_FILE. Si falla algun comando se restauran las reglas del
+        ultimo despacho correcto y se lanza ErrorAplicacion.
+
+        Los despachos forzados descartan la instantanea local de las
+        politicas. Los no forzados terminan sin cargar las politicas si la
+        version de sus tablas no cambio y no llego el proximo cambio por
+        rangos horarios desde el ultimo despacho.
+        '''
+        self.metricas.reiniciar()
+        if forzar:
+            self.descartar_instantanea()
+        aplicado = False
+        error = True
+        self.cargadas = None
+        self.numeros = None
+        try:
+            with aplicacion.cerrojo(self.CERROJO_FILE), \
+                    self.metricas.consultas(models.db):
+                with self.etapa('total'):
+                    # la version se lee antes de cargar las politicas, para
+                    # no perder modificaciones posteriores
+                    version = models.VersionTabla.actual()
+                    if not forzar and self.sin_cambios(version):
+                        log.info("No hay cambios en la base de datos desde "
+                                 "el ultimo despacho")
+                    else:
+                        aplicado = self.__despachar(forzar)
+                        proximo = None
+                        if version is not None:
+                            proximo = self.proximo_cambio(
+                                politicas=self.cargadas
+                            )
+                        self.guardar_version(version, proximo)
+            error = False
+        finally:
+            # si el despacho falla se elimina la version, para volver a
+            # intentarlo aunque no cambie la base de datos
+            if error:
+                self.guardar_version(None)
+            self.metricas.contadores['aplicado'] = int(aplicado)
+            self.metricas.contadores['error'] = int(error)
+            self.exportar_metricas()
+        return aplicado
+
+    def __despachar(self, forzar):
+        with self.etapa('obtener_politicas'):
+            politicas = self.obtener_politicas()
+        for politica in politicas:
+            self.metricas.contar_politica(reglas.tipo_politica(politica))
+        with self.etapa('generar_script'):
+            operaciones, conjuntos, noflush, estado, configuracion = \
+                self.preparar(politicas)
+        anterior = None if forzar else self.leer_huella()
+        huella = None if estado is None else self.huella(estado)
+        if not operaciones or huella is not None and huella == anterior:
+            log.info("No hay cambios en las politicas despachadas")
+            return False
+        if self.directo:
+            return self.despachar_directo(operaciones, conjuntos, noflush,
+                                          estado, huella, anterior,
+                                          configuracion)
+        lineas, batch = self.emitir(operaciones, conjuntos, noflush)
+        with self.etapa('escribir'):
+            escrita = self.volcar(self.secciones(lineas, batch, True))
+            huella = huella or escrita
+        if huella == anterior:
+            log.info("No hay cambios en las politicas despachadas")
+            return False
+        # los archivos de un despacho completo alcanzan para restaurarlo
+        self.aplicar(self.pasos(batch), configuracion if noflush else None,
+                     huella, estado)
+        return True
+
+    def pasos(self, batch):
+        '''
+        Devuelve los pasos que aplican los archivos del despacho: los comandos
+        de tc de cada interfaz, si se aplican con tc -batch, y el script.
+        '''
+        pasos = list()
+        for interfaz in (batch.interfaces if batch is not None else ()):
+            archivo = self.TC_BATCH_FILE % interfaz
+            pasos.extend(self.limpiezas(batch, interfaz))
+            pasos.append(aplicacion.Paso(
+                'tc %s' % interfaz, [self.TC, '-force', '-batch', archivo],
+                archivo=archivo
+            ))
+        pasos.append(aplicacion.Paso('script', ['/bin/sh', self.SCRIPT_FILE],
+                                     archivo=self.SCRIPT_FILE))
+        return pasos
+
+    def aplicar(self, pasos, configuracion=None, huella=None, estado=None):
+        '''
+        Ejecuta los pasos del despacho. Si todos terminan correctamente se
+        guarda el despacho como el ultimo correcto: los archivos de los
+        pasos, o la configuracion completa si se pasa, cuando los pasos solo
+        aplican diferencias o no dejan archivos. Si alguno falla se restaura
+        el ultimo despacho correcto.
+
+        La huella y el estado incremental se guardan recien cuando el
+        despacho se aplico correctamente. Si la aplicacion se interrumpe por
+        cualquier error se descartan los del despacho anterior, ya que las
+        reglas pudieron quedar aplicadas a medias.
+        '''
+        try:
+            with self.etapa('aplicar'):
+                fallos = self.ejecutar_pasos(pasos)
+                if fallos:
+                    self.restaurar(fallos)
+        except Exception:
+            self.descartar_huella()
+            raise
+        if huella is not None:
+            self.guardar_huella(huella)
+        self.guardar_estado(estado)
+        self.guardar_numeros(self.numeros)
+        with self.etapa('guardar_bueno'):
+            self.guardar_bueno(pasos, configuracion)
+
+    def ejecutar_pasos(self, pasos, contador='lineas'):
+        '''
+        Ejecuta los pasos midiendo la duracion de cada uno. Se detiene en el
+        primer comando que falla, salvo en los pasos tolerantes, y devuelve
+        la lista de fallos. Las lineas escritas en la entrada de los comandos
+        se suman al contador pasado por parametro.
+        '''
+        for paso in pasos:
+            log.debug("Ejecutando %s", " ".join(paso.comando))
+            lineas = paso.lineas
+            if lineas is not None:
+                lineas = self.contar_lineas(lineas, contador)
+            with self.etapa(paso.nombre):
+                codigo, salida = self.ejecutor.ejecutar(paso.comando, lineas)
+            if codigo != 0:
+                fallo = aplicacion.Fallo(paso.nombre, paso.comando, codigo,
+                                         salida)
+                if paso.tolerante:
+                    log.debug("Se ignora el error de %s", fallo)
+                    continue
+                log.error("Fallo el despacho en %s", fallo)
+                self.metricas.contar('fallos')
+                return [fallo]
+        return []
+
+    def contar_lineas(self, lineas, contador='lineas'):
+        '''
+        Devuelve las lineas pasadas por parametro, sumando al contador de las
+        metricas la cantidad que se recorrio.
+        '''
+        cantidad = 0
+        try:
+            for linea in lineas:
+                cantidad += 1
+                yield linea
+        finally:
+            self.metricas.contar(contador, cantidad)
+
+    def guardar_bueno(self, pasos, configuracion=None):
+        '''
+        Guarda los comandos que aplican el despacho como el ultimo despacho
+        correcto, con una copia de los archivos que leen.
+
+        Si se pasa la configuracion completa, sus lineas se escriben en
+        archivos que se restauran escribiendolos en la entrada de `tc -batch`,
+        `ipset restore` e iptables-restore (o nft), como en el modo directo.
+        Un error al guardar no interrumpe el despacho.
+        '''
+        bueno = list()
+        try:
+            if configuracion is not None:
+                pasos = self.partes(configuracion.operaciones(),
+                                    configuracion.conjuntos())
+            for indice, paso in enumerate(pasos):
+                comando = paso.comando
+                entrada = None
+                if paso.lineas is not None:
+                    entrada = '%s.%d' % (self.BUENO_FILE, indice)
+                    with open(entrada, 'w') as f:
+                        for linea in paso.lineas:
+                            f.write(linea + '\n')
+                elif paso.archivo is not None:
+                    copia = paso.archivo + '.bueno'
+                    shutil.copyfile(paso.archivo, copia)
+                    comando = [copia if x == paso.archivo else x
+                               for x in comando]
+                bueno.append([paso.nombre, comando, entrada, paso.tolerante])
+            with open(self.BUENO_FILE, 'w') as f:
+                json.dump(bueno, f)
+        except (IOError, OSError) as e:
+            log.warning("No se pudo guardar el despacho correcto: %s", e)
+            if os.path.exists(self.BUENO_FILE):
+                os.remove(self.BUENO_FILE)
+
+    def restaurar(self, fallos):
+        '''
+        Restaura las reglas del ultimo despacho que se aplico correctamente y
+        lanza ErrorAplicacion. Se eliminan la huella y el estado para que el
+        proximo despacho aplique todas las reglas.
+        '''
+        self.descartar_huella()
+        bueno = self.leer_bueno()
+        restaurado = False
+        if bueno is None:
+            log.error("No hay un despacho correcto para restaurar")
+        else:
+            with self.etapa('restaurar'):
+                # las lineas restauradas no son parte del despacho
+                restaurado = not self.ejecutar_pasos(bueno,
+                                                     'lineas_restauradas')
+            if restaurado:
+                log.info("Se restauro el ultimo despacho correcto")
+        raise aplicacion.ErrorAplicacion(fallos, restaurado)
+
+    def leer_bueno(self):
+        '''
+        Devuelve los pasos del ultimo despacho correcto, o None si no se
+        encontro o le falta alguno de sus archivos.
+        '''
+        try:
+            with open(self.BUENO_FILE) as f:
+                bueno = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        # los despachos correctos de versiones anteriores no se restauran
+        if not all(isinstance(paso, list) and len(paso) == 4
+                   for paso in bueno):
+            return None
+        pasos = list()
+        for nombre, comando, entrada, tolerante in bueno:
+            if entrada is not None and not os.path.exists(entrada):
+                return None
+            pasos.append(aplicacion.Paso(
+                nombre, comando,
+                None if entrada is None else models.Flujo(
+                    aplicacion.lineas_archivo, entrada
+                ),
+                tolerante=tolerante
+            ))
+        return pasos
+
+    def despachar_directo(self, operaciones, conjuntos, noflush, estado,
+                          huella, anterior, configuracion):
+        '''
+        Aplica las operaciones escribiendo sus lineas en la entrada de cada
+        programa, sin archivos intermedios. Fuera del modo incremental la
+        huella se calcula con una primera pasada sobre las lineas, antes de
+        aplicarlas.
+
+        Luego de aplicarlas se escribe la configuracion completa en los
+        archivos del ultimo despacho correcto, para poder restaurarla si
+        falla un despacho posterior.
+        '''
+        with self.etapa('emision'):
+            partes = self.partes(operaciones, conjuntos, noflush)
+        if huella is None:
+            with self.etapa('huella'):
+                huella = self.volcar_partes(partes)
+            if huella == anterior:
+                log.info("No hay cambios en las politicas despachadas")
+                return False
+        self.aplicar(partes, configuracion if noflush else None, huella,
+                     estado)
+        return True
+
+    def exportar_metricas(self):
+        '''
+        Exporta las metricas del ultimo despacho a los archivos configurados.
+        Un error al exportar no interrumpe el despacho.
+        '''
+        try:
+            if self.archivo_metricas:
+                self.metricas.exportar(self.archivo_metricas)
+            if self.archivo_historial:
+                self.metricas.agregar_historial(self.archivo_historial)
+        except (IOError, OSError) as e:
+            log.warning("No se pudieron exportar las metricas: %s", e)
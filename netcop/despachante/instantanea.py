@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+Instantanea local del grafo de politicas activas, para despachar sin consultar
+la base de datos.
+
+La instantanea guarda en un archivo local las politicas activas con sus rangos
+horarios, objetivos, clases de trafico, redes y puertos, junto con la version
+de las tablas de politicas (ver `models.VersionTabla`) leida antes de
+cargarlas. Mientras la version no cambie las politicas se arman desde la
+instantanea. Si no se instalaron las versiones en la base de datos las
+politicas se consultan siempre.
+
+La instantanea se descarta en los despachos forzados y en los provocados por
+notificaciones de cambios. Si la base de datos no responde se utiliza la
+ultima instantanea guardada.
+'''
+import os
+import pickle
+import logging
+import peewee
+from . import models
+
+log = logging.getLogger(__name__)
+
+# Version del formato del archivo. Las instantaneas de otra version se
+# descartan.
+VERSION = 2
+
+
+def extraer(politicas):
+    '''
+    Devuelve el grafo de las politicas precargadas como tuplas de valores,
+    con las clases de trafico compartidas una sola vez.
+    '''
+    datos = dict((clave, list()) for clave in (
+        'politicas', 'horarios', 'objetivos', 'clases', 'redes', 'puertos'
+    ))
+    clases = dict()
+    for politica in politicas:
+        datos['politicas'].append((
+            politica.id_politica, politica.nombre, politica.descripcion,
+            politica.activa, politica.prioridad, politica.velocidad_subida,
+            politica.velocidad_bajada,
+        ))
+        for horario in politica.horarios:
+            datos['horarios'].append((politica.id_politica, horario.dia,
+                                      horario.hora_inicial, horario.hora_fin))
+        for objetivo in politica.objetivos:
+            clase = objetivo.clase
+            datos['objetivos'].append((
+                politica.id_politica,
+                clase.id_clase if clase is not None else None,
+                objetivo.tipo, objetivo.direccion_fisica,
+            ))
+            if clase is not None:
+                clases[clase.id_clase] = clase
+    for id_clase, clase in sorted(clases.items()):
+        datos['clases'].append((id_clase, clase.nombre))
+        for item in clase.redes:
+            datos['redes'].append((id_clase, item.cidr.direccion,
+                                   item.cidr.prefijo, item.grupo))
+        for item in clase.puertos:
+            datos['puertos'].append((id_clase, item.puerto.numero,
+                                     item.puerto.protocolo, item.grupo))
+    return datos
+
+
+def armar(datos):
+    '''
+    Arma en memoria las politicas de un grafo devuelto por `extraer`, igual
+    que si se hubieran precargado de la base de datos.
+    '''
+    clases = dict()
+    for id_clase, nombre in datos['clases']:
+        clase = models.ClaseTrafico(id_clase=id_clase, nombre=nombre)
+        clase.redes = list()
+        clase.puertos = list()
+        clases[id_clase] = clase
+    for id_clase, direccion, prefijo, grupo in datos['redes']:
+        item = models.ClaseCIDR(grupo=grupo)
+        item.cidr = models.CIDR(direccion=direccion, prefijo=prefijo)
+        clases[id_clase].redes.append(item)
+    for id_clase, numero, protocolo, grupo in datos['puertos']:
+        item = models.ClasePuerto(grupo=grupo)
+        item.puerto = models.Puerto(numero=numero, protocolo=protocolo)
+        clases[id_clase].puertos.append(item)
+    politicas = list()
+    por_id = dict()
+    for (id_politica, nombre, descripcion, activa, prioridad, subida,
+         bajada) in datos['politicas']:
+        politica = models.Politica(
+            id_politica=id_politica, nombre=nombre, descripcion=descripcion,
+            activa=activa, prioridad=prioridad, velocidad_subida=subida,
+            velocidad_bajada=bajada,
+        )
+        politica.horarios = list()
+        politica.objetivos = list()
+        politicas.append(politica)
+        por_id[id_politica] = politica
+    for id_politica, dia, inicio, fin in datos['horarios']:
+        por_id[id_politica].horarios.append(models.RangoHorario(
+            dia=dia, hora_inicial=inicio, hora_fin=fin
+        ))
+    for id_politica, id_clase, tipo, direccion_fisica in datos['objetivos']:
+        objetivo = models.Objetivo(tipo=tipo,
+                                   direccion_fisica=direccion_fisica)
+        objetivo.politica = por_id[id_politica]
+        objetivo.clase = clases[id_clase] if id_clase is not None else None
+        por_id[id_politica].objetivos.append(objetivo)
+    return politicas
+
+
+class Instantanea:
+    '''
+    Archivo con la ultima instantanea del grafo de politicas activas.
+    '''
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        # si es falso, la proxima vez se consulta la base de datos aunque la
+        # version de las tablas no haya cambiado
+        self.vigente = True
+        # verdadero si las ultimas politicas se armaron desde la instantanea
+        self.usada = False
+        # ultima instantanea leida o guardada
+        self.ultima = None
+
+    def descartar(self):
+        '''
+        Descarta la instantanea en la proxima consulta de politicas.
+        '''
+        self.vigente = False
+
+    def leer(self):
+        '''
+        Devuelve la instantanea guardada, o None si no se encontro.
+        '''
+        if self.ultima is not None:
+            return self.ultima
+        try:
+            with open(self.archivo, 'rb') as f:
+                guardada = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError,
+                pickle.UnpicklingError):
+            return None
+        if not isinstance(guardada, dict) or \
+                guardada.get('version') != VERSION:
+            return None
+        self.ultima = guardada
+        return guardada
+
+    def guardar(self, tablas, datos):
+        '''
+        Guarda la instantanea con la version de las tablas de politicas,
+        reemplazando el archivo de manera atomica. Un error al guardar no
+        interrumpe el despacho.
+        '''
+        self.ultima = {'version': VERSION, 'tablas': tablas, 'datos': datos}
+        temporal = self.archivo + '.tmp'
+        try:
+            carpeta = os.path.dirname(self.archivo)
+            if carpeta and not os.path.isdir(carpeta):
+                os.makedirs(carpeta)
+            with open(temporal, 'wb') as f:
+                pickle.dump(self.ultima, f, 2)
+            os.rename(temporal, self.archivo)
+        except (IOError, OSError) as e:
+            log.warning("No se pudo guardar la instantanea %s: %s",
+                        self.archivo, e)
+
+    def politicas(self, consulta, guardar=True):
+        '''
+        Devuelve las politicas de la consulta con su grafo precargado. Si la
+        version de las tablas de politicas no cambio desde la ultima
+        instantanea, o si la base de datos no responde, se arman desde la
+        instantanea. Si guardar es falso, las politicas consultadas no
+        reemplazan la instantanea.
+        '''
+        self.usada = False
+        try:
+            # la version se lee antes de cargar las politicas, de manera que
+            # una modificacion posterior cambia la version guardada
+            actual = models.VersionTabla.consultar()
+            if self.vigente and actual is not None:
+                guardada = self.leer()
+                if guardada is not None and guardada['tablas'] == actual:
+                    log.debug("Politicas obtenidas de la instantanea local")
+                    self.usada = True
+                    return armar(guardada['datos'])
+            politicas = models.precargar(consulta)
+        except (peewee.DatabaseError, peewee.InterfaceError) as e:
+            guardada = self.leer()
+            if guardada is None:
+                raise
+            log.warning("No se pudo consultar la base de datos (%s), se "
+                        "utiliza la instantanea local", e)
+            self.usada = True
+            return armar(guardada['datos'])
+        if guardar:
+            self.guardar(actual, extraer(politicas))
+            self.vigente = True
+        return politicas
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+Metricas de cada despacho: la duracion de cada etapa y la cantidad de
+consultas a la base de datos, de reglas, de lineas aplicadas, de lineas
+restauradas luego de un fallo y de politicas de cada tipo.
+
+Las metricas del ultimo despacho se exportan en el formato de texto de
+Prometheus, para que las lea el colector textfile de node_exporter, y se
+agregan a un historial en JSON.
+'''
+import os
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Prefijo de los nombres de las metricas de Prometheus
+PREFIJO = 'netcop_despacho'
+
+# Cantidad maxima de despachos que se guardan en el historial
+MAX_HISTORIAL = 1000
+
+
+def etiqueta(valor):
+    '''
+    Escapa el valor de una etiqueta de Prometheus.
+    '''
+    return (str(valor).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def reemplazar(archivo, contenido):
+    '''
+    Reemplaza el contenido del archivo de manera atomica, para que nunca se
+    lea un archivo incompleto.
+    '''
+    temporal = archivo + '.tmp'
+    with open(temporal, 'w') as f:
+        f.write(contenido)
+    os.rename(temporal, archivo)
+
+
+class Metricas:
+    '''
+    Tiempos y contadores del ultimo despacho.
+    '''
+
+    def __init__(self):
+        # duracion en segundos de cada etapa
+        self.tiempos = OrderedDict()
+        self.contadores = OrderedDict()
+        # cantidad de politicas de cada tipo
+        self.politicas = OrderedDict()
+        self.fecha = None
+
+    def reiniciar(self):
+        '''
+        Descarta las metricas del despacho anterior.
+        '''
+        self.tiempos.clear()
+        self.contadores.clear()
+        self.politicas.clear()
+        self.fecha = time.time()
+
+    @contextmanager
+    def etapa(self, nombre):
+        '''
+        Mide la duracion de una etapa. Si la etapa se ejecuta mas de una vez
+        se acumula su duracion.
+        '''
+        inicio = time.time()
+        try:
+            yield
+        finally:
+            self.tiempos[nombre] = (self.tiempos.get(nombre, 0) +
+                                    time.time() - inicio)
+
+    def contar(self, nombre, cantidad=1):
+        '''
+        Incrementa el contador pasado por parametro.
+        '''
+        self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def contar_politica(self, tipo):
+        '''
+        Incrementa la cantidad de politicas del tipo pasado por parametro.
+        '''
+        self.politicas[tipo] = self.politicas.get(tipo, 0) + 1
+
+    @contextmanager
+    def consultas(self, db):
+        '''
+        Cuenta las consultas que se ejecutan en la base de datos mientras dura
+        el contexto.
+        '''
+        execute_sql = db.execute_sql
+
+        def contar(*args, **kwargs):
+            self.contar('consultas')
+            return execute_sql(*args, **kwargs)
+        self.contadores.setdefault('consultas', 0)
+        db.execute_sql = contar
+        try:
+            yield
+        finally:
+            db.execute_sql = execute_sql
+
+    def resultado(self):
+        '''
+        Devuelve un diccionario con las metricas, que se puede serializar en
+        JSON.
+        '''
+        return OrderedDict([
+            ('fecha', self.fecha),
+            ('etapas', OrderedDict((nombre, round(segundos, 6))
+                                   for nombre, segundos
+                                   in self.tiempos.items())),
+            ('contadores', self.contadores),
+            ('politicas', self.politicas),
+        ])
+
+    def prometheus(self):
+        '''
+        Devuelve las lineas de las metricas en el formato de texto de
+        Prometheus.
+        '''
+        lineas = [
+            '# HELP %s_fecha_segundos Fecha del ultimo despacho.' % PREFIJO,
+            '# TYPE %s_fecha_segundos gauge' % PREFIJO,
+            '%s_fecha_segundos %.3f' % (PREFIJO, self.fecha or 0),
+            '# HELP %s_etapa_segundos Duracion de cada etapa del ultimo '
+            'despacho.' % PREFIJO,
+            '# TYPE %s_etapa_segundos gauge' % PREFIJO,
+        ]
+        for nombre, segundos in self.tiempos.items():
+            lineas.append('%s_etapa_segundos{etapa="%s"} %.6f' %
+                          (PREFIJO, etiqueta(nombre), segundos))
+        lineas.extend([
+            '# HELP %s_politicas Politicas despachadas de cada tipo.' %
+            PREFIJO,
+            '# TYPE %s_politicas gauge' % PREFIJO,
+        ])
+        for tipo, cantidad in self.politicas.items():
+            lineas.append('%s_politicas{tipo="%s"} %d' %
+                          (PREFIJO, etiqueta(tipo), cantidad))
+        for nombre, valor in self.contadores.items():
+            lineas.append('# TYPE %s_%s gauge' % (PREFIJO, nombre))
+            lineas.append('%s_%s %d' % (PREFIJO, nombre, valor))
+        return lineas
+
+    def exportar(self, archivo):
+        '''
+        Escribe las metricas en el archivo en el formato de texto de
+        Prometheus.
+        '''
+        reemplazar(archivo, ''.join(linea + '\n'
+                                    for linea in self.prometheus()))
+
+    def agregar_historial(self, archivo, maximo=MAX_HISTORIAL):
+        '''
+        Agrega las metricas al historial en JSON, que conserva los ultimos
+        despachos.
+        '''
+        historial = list()
+        try:
+            with open(archivo) as f:
+                historial = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        historial.append(self.resultado())
+        reemplazar(archivo, json.dumps(historial[-maximo:]))
@@ -6,9 +6,12 @@ Utiliza el paquete *peewee* para el mapeo objeto-relacional. Permite realizar
 las consultas a la base de datos en lenguaje python de forma sencilla sin
 necesidad de escribir codigo SQL.
 '''
+import socket
+import struct
 import itertools
 import peewee as models
-from datetime import datetime
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
 from . import config
 
 # Identificador de grupo para servicios que esten en la red local
@@ -27,20 +30,185 @@ class Flag:
     '''
     Declara flags que utiliza iptables.
     '''
+    INTERFAZ_ENTRADA = '-i'
     IP_ORIGEN = '--source'
     IP_DESTINO = '--destination'
     PUERTO_ORIGEN = '--source-port'
     PUERTO_DESTINO = '--destination-port'
+    PUERTOS_ORIGEN = '-m multiport --source-ports'
+    PUERTOS_DESTINO = '-m multiport --destination-ports'
     MAC_ORIGEN = '--mac-source'
     EXTENSION_MAC = '-m mac'
     PROTOCOLO = '-p'
-    PRIORIDAD = (EXTENSION_MAC,
+    # los rangos horarios se evaluan con la zona horaria del kernel, que debe
+    # coincidir con la del sistema
+    HORARIO = '-m time --kerneltz'
+    # marca del paquete con una mascara, solo en las reglas iniciales
+    MARCA = '-m mark --mark'
+    PRIORIDAD = (INTERFAZ_ENTRADA,
+                 EXTENSION_MAC,
                  PROTOCOLO,
                  MAC_ORIGEN,
                  IP_ORIGEN,
                  IP_DESTINO,
                  PUERTO_ORIGEN,
-                 PUERTO_DESTINO)
+                 PUERTO_DESTINO,
+                 PUERTOS_ORIGEN,
+                 PUERTOS_DESTINO,
+                 HORARIO)
+
+    @staticmethod
+    def texto(key, value):
+        '''
+        Devuelve el texto del flag con su valor, tal como lo espera iptables.
+        '''
+        if isinstance(value, Conjunto):
+            return value.flag(key)
+        if value == '':
+            return key
+        return "%s %s" % (key, value)
+
+
+class FlagsRegla(tuple):
+    '''
+    Flags de una regla de iptables. Es una tupla con el valor de cada flag de
+    `Flag.PRIORIDAD`, en ese orden, y None en los flags que no se utilizan.
+    Ocupa mucho menos memoria que un diccionario por regla.
+
+    Se puede consultar como un diccionario de solo lectura con los flags como
+    claves.
+    '''
+    __slots__ = ()
+
+    # posicion de cada flag en la tupla
+    POSICION = dict((key, i) for i, key in enumerate(Flag.PRIORIDAD))
+
+    # pares de flags que se intercambian en las reglas de bajada
+    BAJADA = ((Flag.IP_ORIGEN, Flag.IP_DESTINO),
+              (Flag.PUERTO_ORIGEN, Flag.PUERTO_DESTINO),
+              (Flag.PUERTOS_ORIGEN, Flag.PUERTOS_DESTINO))
+
+    def __new__(cls, valores=None):
+        if valores is None:
+            valores = (None,) * len(Flag.PRIORIDAD)
+        return tuple.__new__(cls, valores)
+
+    @classmethod
+    def desde(cls, flags):
+        '''
+        Devuelve los flags del diccionario pasado por parametro.
+        '''
+        if isinstance(flags, cls):
+            return flags
+        valores = [None] * len(Flag.PRIORIDAD)
+        for key, value in flags.items():
+            valores[cls.POSICION[key]] = value
+        return cls(valores)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        valor = tuple.__getitem__(self, self.POSICION[key])
+        if valor is None:
+            raise KeyError(key)
+        return valor
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        valor = tuple.__getitem__(self, self.POSICION[key])
+        return default if valor is None else valor
+
+    def keys(self):
+        return [key for key, value in self.pares()]
+
+    def pares(self):
+        '''
+        Devuelve una tupla de pares (flag, valor) con los flags utilizados, en
+        el orden que los espera iptables.
+        '''
+        return tuple((key, value) for key, value in zip(Flag.PRIORIDAD, self)
+                     if value is not None)
+
+    def combinar(self, otro):
+        '''
+        Devuelve los flags de ambas reglas. Si un flag esta en las dos se
+        utiliza el valor de la otra regla.
+        '''
+        return FlagsRegla([b if b is not None else a
+                           for a, b in zip(self, otro)])
+
+    def comunes(self, otro):
+        '''
+        Devuelve los flags que tienen el mismo valor en ambas reglas.
+        '''
+        return FlagsRegla([a if a == b else None for a, b in zip(self, otro)])
+
+    def sin(self, *keys):
+        '''
+        Devuelve una copia de los flags sin los flags pasados por parametro.
+        '''
+        valores = list(self)
+        for key in keys:
+            valores[self.POSICION[key]] = None
+        return FlagsRegla(valores)
+
+    def bajada(self):
+        '''
+        Devuelve los flags de la regla para el trafico de bajada, con el
+        origen y el destino intercambiados. Devuelve None si la regla no tiene
+        redes ni puertos que intercambiar.
+        '''
+        valores = list(self)
+        modificado = False
+        for origen, destino in self.BAJADA:
+            origen, destino = self.POSICION[origen], self.POSICION[destino]
+            valores[origen], valores[destino] = self[destino], self[origen]
+            modificado = modificado or valores[origen] is not None or \
+                valores[destino] is not None
+        return FlagsRegla(valores) if modificado else None
+
+
+class Flujo(object):
+    '''
+    Secuencia perezosa de flags de reglas. No guarda las reglas, sino que las
+    vuelve a generar en cada recorrido, por lo que la memoria no depende de la
+    cantidad de combinaciones.
+    '''
+    __slots__ = ('funcion', 'argumentos')
+
+    def __init__(self, funcion, *argumentos):
+        self.funcion = funcion
+        self.argumentos = argumentos
+
+    def __iter__(self):
+        return self.funcion(*self.argumentos)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getitem__(self, indice):
+        for item in itertools.islice(self, indice, None):
+            return item
+        raise IndexError(indice)
+
+    def __bool__(self):
+        for _ in self:
+            return True
+        return False
+    __nonzero__ = __bool__
+
+
+def pares_flags(flags):
+    '''
+    Devuelve una tupla de pares (flag, valor) con los flags del diccionario
+    pasado por parametro, en el orden que los espera iptables.
+    '''
+    if isinstance(flags, FlagsRegla):
+        return flags.pares()
+    return tuple((key, flags[key]) for key in Flag.PRIORIDAD
+                 if flags.get(key) is not None)
 
 
 class Param:
@@ -54,6 +222,226 @@ class Param:
     TCP_ORIGEN = 'tcp_origen'
     TCP_DESTINO = 'tcp_destino'
     MAC = 'mac'
+    CLASE_ORIGEN = 'clase_origen'
+    CLASE_DESTINO = 'clase_destino'
+
+
+class Conjunto:
+    '''
+    Conjunto de ipset con redes o mac-address que se utiliza en lugar de listar
+    los valores en cada regla de iptables.
+
+    Los conjuntos de tipo `list:set` contienen a otros conjuntos.
+    '''
+    PREFIJO = 'netcop'
+    # sufijo del conjunto donde se cargan los elementos antes del swap
+    TEMPORAL = '-t'
+    RED = 'hash:net'
+    MAC = 'hash:mac'
+    LISTA = 'list:set'
+
+    def __init__(self, nombre, tipo, elementos):
+        self.nombre = "%s-%s" % (self.PREFIJO, nombre)
+        self.tipo = tipo
+        self.elementos = sorted(elementos, key=str)
+
+    @classmethod
+    def referencia(cls, nombre):
+        '''
+        Devuelve un conjunto sin elementos que solo sirve para referenciar por
+        su nombre completo a un conjunto existente.
+        '''
+        conjunto = cls(nombre, None, [])
+        conjunto.nombre = nombre
+        return conjunto
+
+    def flag(self, key):
+        '''
+        Devuelve el flag de iptables que captura los paquetes cuyo origen o
+        destino (segun el flag key) pertenezca al conjunto.
+        '''
+        direccion = ('src' if key in (Flag.IP_ORIGEN, Flag.MAC_ORIGEN) else
+                     'dst')
+        return "-m set --match-set %s %s" % (self.nombre, direccion)
+
+    def hojas(self):
+        '''
+        Devuelve los elementos del conjunto. Si es un conjunto `list:set`
+        devuelve los elementos de los conjuntos que contiene.
+        '''
+        if self.tipo != self.LISTA:
+            return list(self.elementos)
+        return sorted(set(e for c in self.elementos for e in c.hojas()),
+                      key=str)
+
+    def __eq__(self, item):
+        return isinstance(item, Conjunto) and self.nombre == item.nombre
+
+    def __ne__(self, item):
+        return not self == item
+
+    def __hash__(self):
+        return hash(self.nombre)
+
+    def __str__(self):
+        return self.nombre
+
+
+# Prefijo de las cadenas de iptables de cada politica
+PREFIJO_CADENA = 'netcop-'
+
+# Cantidad maxima de puertos en una regla de multiport. Los rangos ocupan dos
+# lugares.
+MULTIPORT_MAX = 15
+
+
+def rangos_puertos(puertos):
+    '''
+    Agrupa los numeros de puerto consecutivos en rangos. Devuelve una lista
+    ordenada de tuplas (inicio, fin).
+    '''
+    rangos = list()
+    for numero in sorted(set(int(p) for p in puertos)):
+        if rangos and rangos[-1][1] == numero - 1:
+            rangos[-1] = (rangos[-1][0], numero)
+        else:
+            rangos.append((numero, numero))
+    return rangos
+
+
+def listas_multiport(puertos):
+    '''
+    Devuelve los puertos agrupados en listas de multiport de hasta
+    MULTIPORT_MAX lugares, con los puertos consecutivos unidos en rangos.
+    '''
+    listas = list()
+    actual = list()
+    usados = 0
+    for inicio, fin in rangos_puertos(puertos):
+        peso = 1 if inicio == fin else 2
+        if usados + peso > MULTIPORT_MAX:
+            listas.append(actual)
+            actual = list()
+            usados = 0
+        actual.append(str(inicio) if inicio == fin else
+                      "%d:%d" % (inicio, fin))
+        usados += peso
+    if actual:
+        listas.append(actual)
+    return [",".join(lista) for lista in listas]
+
+
+def leer_red(red):
+    '''
+    Devuelve una tupla con la direccion como entero y el prefijo de la red IPv4
+    en notacion CIDR pasada por parametro. Los bits de host de la direccion se
+    ponen en cero. Devuelve None si no es una red IPv4 valida.
+    '''
+    direccion, _, prefijo = str(red).partition('/')
+    if direccion.count('.') != 3:
+        return None
+    try:
+        prefijo = int(prefijo) if prefijo else 32
+        numero = struct.unpack('!I', socket.inet_aton(direccion))[0]
+    except (ValueError, socket.error):
+        return None
+    if not 0 <= prefijo <= 32:
+        return None
+    mascara = (0xffffffff << (32 - prefijo)) & 0xffffffff
+    return numero & mascara, prefijo
+
+
+def ordenar_redes(redes):
+    '''
+    Devuelve la lista de redes ordenadas por direccion y prefijo, con las que
+    no son redes IPv4 al final. Los parametros de las politicas son conjuntos,
+    cuyo orden cambia entre procesos, y el orden de las reglas debe ser
+    siempre el mismo.
+    '''
+    def clave(red):
+        leida = leer_red(red)
+        return (leida is None, leida or (0, 0), str(red))
+    return sorted(redes, key=clave)
+
+
+def texto_red(numero, prefijo):
+    '''
+    Devuelve la red en notacion CIDR.
+    '''
+    return "%d.%d.%d.%d/%d" % (numero >> 24, (numero >> 16) & 0xff,
+                               (numero >> 8) & 0xff, numero & 0xff, prefijo)
+
+
+def agrupar_redes(redes):
+    '''
+    Agrupa las redes IPv4 en la menor cantidad de prefijos que cubren las
+    mismas direcciones. Descarta las redes repetidas o contenidas en otra red
+    y une las redes hermanas en el prefijo que las contiene, por ejemplo
+    10.0.0.0/25 y 10.0.0.128/25 en 10.0.0.0/24.
+
+    Devuelve una lista ordenada de redes en notacion CIDR. Las redes que no
+    son IPv4 se agregan al final sin cambios.
+    '''
+    otras = set()
+    leidas = set()
+    for red in redes:
+        leida = leer_red(red)
+        if leida is None:
+            otras.add(red)
+        else:
+            leidas.add(leida)
+    pila = list()
+    # al ordenar por direccion y prefijo, una red contenida en otra solo
+    # puede estar contenida en la ultima red agregada
+    for numero, prefijo in sorted(leidas):
+        if pila:
+            ultimo, largo = pila[-1]
+            if numero >> (32 - largo) == ultimo >> (32 - largo):
+                continue
+        pila.append((numero, prefijo))
+        while len(pila) > 1:
+            (primero, largo), (segundo, otro) = pila[-2:]
+            tamanio = 1 << (32 - largo)
+            if (largo != otro or largo == 0 or primero & tamanio or
+                    primero + tamanio != segundo):
+                break
+            pila[-2:] = [(primero, largo - 1)]
+    return ([texto_red(numero, prefijo) for numero, prefijo in pila] +
+            sorted(otras, key=str))
+
+
+class Horario:
+    '''
+    Rango horario que se evalua en el kernel con el modulo time de iptables.
+    Agrupa los dias de la semana que comparten la hora de inicio y fin.
+    '''
+
+    def __init__(self, dias, inicio, fin):
+        '''
+        Los dias son numeros segun `datetime.weekday()`. La hora de fin esta
+        incluida en el rango.
+        '''
+        self.dias = tuple(sorted(dias))
+        self.inicio = inicio
+        self.fin = fin
+
+    def __eq__(self, item):
+        return (isinstance(item, Horario) and
+                (self.dias, self.inicio, self.fin) ==
+                (item.dias, item.inicio, item.fin))
+
+    def __ne__(self, item):
+        return not self == item
+
+    def __hash__(self):
+        return hash((self.dias, self.inicio, self.fin))
+
+    def __str__(self):
+        return "--weekdays %s --timestart %s --timestop %s" % (
+            ",".join(RangoHorario.nombre_dia(d) for d in self.dias),
+            self.inicio.strftime('%H:%M:%S'),
+            self.fin.strftime('%H:%M:%S'),
+        )
 
 
 class Protocolo:
@@ -184,6 +572,19 @@ class Politica(models.Model):
     PRIO_ALTA = 1
     PRIO_NORMAL = 3
     PRIO_BAJA = 7
+    # parametros de puertos origen y destino de cada protocolo
+    PUERTOS = (
+        ('tcp', Param.TCP_ORIGEN, Param.TCP_DESTINO),
+        ('udp', Param.UDP_ORIGEN, Param.UDP_DESTINO),
+    )
+    # captura redes y mac-address con conjuntos de ipset
+    usar_ipset = False
+    # agrupa los puertos en reglas de multiport
+    usar_multiport = False
+    # evalua los rangos horarios en el kernel con el modulo time de iptables
+    usar_horario_kernel = False
+    # agrupa las redes de cada sentido en la menor cantidad de prefijos
+    usar_agregacion = False
     id_politica = models.PrimaryKeyField()
     nombre = models.CharField(max_length=63)
     descripcion = models.CharField(max_length=255, null=True)
@@ -200,40 +601,104 @@ class Politica(models.Model):
             getattr(Param, attr): set()
             for attr in dir(Param) if not attr.startswith('__')
         }
+        # redes de cada clase de trafico de los objetivos
+        self.redes_clase = defaultdict(set)
         return super(Politica, self).__init__(*args, **kwargs)
 
     def flags_dict(self):
         '''
-        Devuelve una lista de diccionarios con los flags necesarios para
-        configurar el iptables para que capture los hosts definidos en la
-        política.
+        Devuelve una lista con los flags necesarios para configurar el
+        iptables para que capture los hosts definidos en la política.
+        '''
+        return list(self.iter_flags())
+
+    def iter_flags(self):
+        '''
+        Devuelve un flujo con los flags de cada regla de la politica. Las
+        reglas se generan a medida que se recorre el flujo, sin guardarlas.
         '''
         for objetivo in self.objetivos:
             objetivo.obtener_parametros(self)
 
-        return self.flags_bajada(
-            self.flags_mac(
-                self.flags_puerto(
-                    self.flags_redes([])
+        return self.flags_horario(
+            self.flags_bajada(
+                self.flags_mac(
+                    self.flags_puerto(
+                        self.flags_redes([])
+                    )
                 )
             )
         )
 
+    def copia(self):
+        '''
+        Devuelve una copia liviana de la politica para construir sus reglas en
+        otro proceso. La copia no tiene objetivos sino los parametros que se
+        obtienen de ellos, y sus rangos horarios no referencian a la politica.
+        '''
+        for objetivo in self.objetivos:
+            objetivo.obtener_parametros(self)
+        copia = Politica(
+            id_politica=self.id_politica,
+            nombre=self.nombre,
+            activa=self.activa,
+            prioridad=self.prioridad,
+            velocidad_subida=self.velocidad_subida,
+            velocidad_bajada=self.velocidad_bajada,
+        )
+        copia.parametros = self.parametros
+        copia.redes_clase = self.redes_clase
+        copia.objetivos = []
+        copia.horarios = [RangoHorario(dia=h.dia, hora_inicial=h.hora_inicial,
+                                       hora_fin=h.hora_fin)
+                          for h in self.horarios]
+        for opcion in ('usar_ipset', 'usar_multiport', 'usar_horario_kernel',
+                       'usar_agregacion'):
+            setattr(copia, opcion, getattr(self, opcion))
+        return copia
+
     def flags(self):
         '''
         Devuelve una lista de string con los flags necesarios para
         configurar el iptables para que capture los hosts definidos en la
         política.
         '''
-        lista = list()
-        for flags in self.flags_dict():
-            linea = list()
-            for key in Flag.PRIORIDAD:
-                value = flags.get(key)
-                if value is not None:
-                    linea.append("%s %s" % (key, value))
-            lista.append(" ".join(linea))
-        return lista
+        return [self.linea_flags(flags) for flags in self.iter_flags()]
+
+    def linea_flags(self, flags):
+        '''
+        Devuelve el string con los flags del diccionario pasado por parametro,
+        en el orden que los espera iptables.
+        '''
+        return " ".join(Flag.texto(key, value)
+                        for key, value in pares_flags(flags))
+
+    def flags_comunes(self, lista):
+        '''
+        Devuelve los flags que comparten todas las reglas de la lista. Se
+        utilizan en el salto a la cadena de la politica para que los paquetes
+        que no coinciden no la recorran.
+        '''
+        comunes = None
+        for flags in lista:
+            flags = FlagsRegla.desde(flags)
+            comunes = flags if comunes is None else comunes.comunes(flags)
+        if comunes is None:
+            return FlagsRegla()
+        # los flags de puertos y mac necesitan el protocolo y la extension
+        if Flag.PROTOCOLO not in comunes:
+            comunes = comunes.sin(Flag.PUERTO_ORIGEN, Flag.PUERTO_DESTINO,
+                                  Flag.PUERTOS_ORIGEN, Flag.PUERTOS_DESTINO)
+        if Flag.MAC_ORIGEN not in comunes:
+            comunes = comunes.sin(Flag.EXTENSION_MAC)
+        return comunes
+
+    @property
+    def cadena(self):
+        '''
+        Nombre de la cadena de iptables con las reglas de la politica.
+        '''
+        return "%s%d" % (PREFIJO_CADENA, self.id_politica)
 
     def flags_mac(self, lista):
         '''
@@ -242,8 +707,12 @@ class Politica(models.Model):
         '''
         if not self.hay_macs():
             return lista
+        if self.usar_ipset:
+            return self.producto_cartesiano(lista, [
+                {Flag.MAC_ORIGEN: self.conjunto_macs()}
+            ])
         flags = [{Flag.MAC_ORIGEN: mac, Flag.EXTENSION_MAC: ''}
-                 for mac in self.parametros[Param.MAC]]
+                 for mac in sorted(self.parametros[Param.MAC], key=str)]
         return self.producto_cartesiano(lista, flags)
 
     def flags_puerto(self, lista):
@@ -253,35 +722,98 @@ class Politica(models.Model):
         '''
         if not self.hay_puertos():
             return lista
-        PUERTOS = (
-            ('tcp', Param.TCP_ORIGEN, Param.TCP_DESTINO),
-            ('udp', Param.UDP_ORIGEN, Param.UDP_DESTINO),
-        )
         ret = list()
-        for proto, origen, destino in PUERTOS:
-            if not self.parametros[destino]:
-                for sport in self.parametros[origen]:
+        for proto, origen, destino in self.PUERTOS:
+            sports = self.valores_puerto(origen, Flag.PUERTO_ORIGEN,
+                                         Flag.PUERTOS_ORIGEN)
+            dports = self.valores_puerto(destino, Flag.PUERTO_DESTINO,
+                                         Flag.PUERTOS_DESTINO)
+            if not dports:
+                for key, sport in sports:
                     ret.append({
                         Flag.PROTOCOLO: proto,
-                        Flag.PUERTO_ORIGEN: sport,
+                        key: sport,
                     })
-            elif not self.parametros[origen]:
-                for dport in self.parametros[destino]:
+            elif not sports:
+                for key, dport in dports:
                     ret.append({
                         Flag.PROTOCOLO: proto,
-                        Flag.PUERTO_DESTINO: dport,
+                        key: dport,
                     })
             else:
-                for sport, dport in itertools.product(
-                        self.parametros[origen],
-                        self.parametros[destino]):
+                for (skey, sport), (dkey, dport) in itertools.product(
+                        sports, dports):
                     ret.append({
                         Flag.PROTOCOLO: proto,
-                        Flag.PUERTO_ORIGEN: sport,
-                        Flag.PUERTO_DESTINO: dport,
+                        skey: sport,
+                        dkey: dport,
                     })
         return self.producto_cartesiano(lista, ret)
 
+    def valores_puerto(self, param, key, key_multiport, multiport=None):
+        '''
+        Devuelve una lista de tuplas (flag, valor) con los puertos del
+        parametro.
+
+        Si se agrupan puertos con multiport, los puertos consecutivos se unen
+        en rangos y se agrupan en listas de hasta MULTIPORT_MAX lugares. Las
+        listas de un solo puerto o rango utilizan el flag comun.
+        '''
+        multiport = self.usar_multiport if multiport is None else multiport
+        if not multiport:
+            return [(key, puerto) for puerto in sorted(self.parametros[param])]
+        return [(key if ',' not in valor else key_multiport, valor)
+                for valor in listas_multiport(self.parametros[param])]
+
+    def cantidad_reglas(self, multiport=None):
+        '''
+        Devuelve la cantidad de reglas que genera la politica sin necesidad de
+        construirlas.
+
+        Permite comparar la cantidad de reglas con y sin agrupar los puertos
+        con multiport.
+        '''
+        factores = self.factores(multiport)
+        cantidad = 0
+        for nombre in ('redes', 'puertos', 'macs'):
+            factor = factores[nombre]
+            if factor:
+                cantidad = cantidad * factor if cantidad else factor
+        return cantidad * factores['bajada'] * factores['horarios']
+
+    def factores(self, multiport=None):
+        '''
+        Devuelve los factores por los que se multiplican las reglas de la
+        politica en cada etapa de la expansion de flags: redes, puertos,
+        mac-address, trafico de bajada y horarios. Las etapas de redes,
+        puertos y mac-address con factor 0 no agregan flags.
+        '''
+        for objetivo in self.objetivos:
+            objetivo.obtener_parametros(self)
+        puertos = 0
+        for proto, origen, destino in self.PUERTOS:
+            sports = len(self.valores_puerto(origen, None, None, multiport))
+            dports = len(self.valores_puerto(destino, None, None, multiport))
+            puertos += sports * dports or sports or dports
+        macs = 0
+        if self.hay_macs():
+            macs = 1 if self.usar_ipset else len(self.parametros[Param.MAC])
+        redes = 1 if self.hay_redes() else 0
+        # las reglas con redes o puertos se duplican para el trafico de bajada
+        bajada = 1
+        if (self.velocidad_bajada or self.prioridad) and (redes or puertos):
+            bajada = 2
+        horarios = 1
+        if self.usar_horario_kernel and self.hay_horarios():
+            horarios = len(self.horarios_kernel())
+        return OrderedDict([
+            ('redes', redes),
+            ('puertos', puertos),
+            ('macs', macs),
+            ('bajada', bajada),
+            ('horarios', horarios),
+        ])
+
     def flags_redes(self, lista):
         '''
         Devuelve los flags para que capture las redes definidas en los
@@ -290,16 +822,131 @@ class Politica(models.Model):
         if not self.hay_redes():
             return lista
         flags = dict()
+        if self.usar_ipset:
+            for key, param, clases in (
+                    (Flag.IP_ORIGEN, Param.IP_ORIGEN, Param.CLASE_ORIGEN),
+                    (Flag.IP_DESTINO, Param.IP_DESTINO, Param.CLASE_DESTINO)):
+                if self.parametros[param]:
+                    flags[key] = self.conjunto_redes(param, clases)
+            return self.producto_cartesiano(lista, [flags])
         if self.parametros[Param.IP_ORIGEN]:
-            flags[Flag.IP_ORIGEN] = ",".join(
-                self.parametros[Param.IP_ORIGEN]
-            )
+            flags[Flag.IP_ORIGEN] = ",".join(self.redes(Param.IP_ORIGEN))
         if self.parametros[Param.IP_DESTINO]:
-            flags[Flag.IP_DESTINO] = ",".join(
-                self.parametros[Param.IP_DESTINO]
-            )
+            flags[Flag.IP_DESTINO] = ",".join(self.redes(Param.IP_DESTINO))
         return self.producto_cartesiano(lista, [flags])
 
+    def redes(self, param, agregacion=None):
+        '''
+        Devuelve las redes del parametro. Si se agrupan las redes se devuelve
+        la menor cantidad de prefijos que cubren las mismas direcciones.
+        '''
+        if agregacion is None:
+            agregacion = self.usar_agregacion
+        if agregacion:
+            return agrupar_redes(self.parametros[param])
+        return ordenar_redes(self.parametros[param])
+
+    def redes_de_clase(self, id_clase):
+        '''
+        Devuelve las redes de la clase de trafico, agrupadas si corresponde.
+        '''
+        if self.usar_agregacion:
+            return agrupar_redes(self.redes_clase[id_clase])
+        return self.redes_clase[id_clase]
+
+    def cantidad_redes(self):
+        '''
+        Devuelve una tupla con la cantidad de redes de origen y destino que
+        captura la politica antes y despues de agruparlas.
+        '''
+        for objetivo in self.objetivos:
+            objetivo.obtener_parametros(self)
+        params = (Param.IP_ORIGEN, Param.IP_DESTINO)
+        return (sum(len(self.parametros[param]) for param in params),
+                sum(len(self.redes(param, True)) for param in params))
+
+    def conjunto_redes(self, param, clases):
+        '''
+        Devuelve el conjunto de ipset con las redes del parametro.
+
+        Cada clase de trafico tiene su propio conjunto, que puede ser
+        compartido por varias politicas. Si el parametro contiene redes de mas
+        de una clase se devuelve un conjunto `list:set` que las agrupa, con un
+        nombre distinto al de las redes sin clase para que un mismo nombre no
+        cambie de tipo.
+        '''
+        sufijo = 'o' if param == Param.IP_ORIGEN else 'd'
+        nombre = "p%d-%s" % (self.id_politica, sufijo)
+        ids = self.parametros[clases]
+        if not ids:
+            # redes que no pertenecen a una clase de trafico
+            return Conjunto(nombre, Conjunto.RED, self.redes(param))
+        miembros = [Conjunto("c%d" % i, Conjunto.RED, self.redes_de_clase(i))
+                    for i in sorted(ids)]
+        if len(miembros) == 1:
+            return miembros[0]
+        return Conjunto(nombre + '-lista', Conjunto.LISTA, miembros)
+
+    def conjunto_macs(self):
+        '''
+        Devuelve el conjunto de ipset con las mac-address de la politica.
+        '''
+        return Conjunto("p%d-mac" % self.id_politica, Conjunto.MAC,
+                        self.parametros[Param.MAC])
+
+    def conjuntos(self):
+        '''
+        Devuelve la lista de conjuntos de ipset que utilizan las reglas de la
+        politica.
+
+        Se debe llamar luego de obtener los flags de la politica.
+        '''
+        conjuntos = list()
+        if self.hay_macs():
+            conjuntos.append(self.conjunto_macs())
+        for param, clases in ((Param.IP_ORIGEN, Param.CLASE_ORIGEN),
+                              (Param.IP_DESTINO, Param.CLASE_DESTINO)):
+            if self.parametros[param]:
+                conjuntos.append(self.conjunto_redes(param, clases))
+        return conjuntos
+
+    def flags_horario(self, lista):
+        '''
+        Devuelve los flags para que las reglas solo capturen el trafico dentro
+        de los rangos horarios de la politica. Se genera una copia de las
+        reglas por cada horario distinto.
+
+        Solo se aplica si se evaluan los rangos horarios en el kernel.
+        '''
+        if (not lista or not self.usar_horario_kernel or
+                not self.hay_horarios()):
+            return lista
+        flags = [{Flag.HORARIO: horario} for horario in self.horarios_kernel()]
+        if not flags:
+            # ningun rango horario es valido, la politica nunca esta activa
+            return []
+        return self.producto_cartesiano(lista, flags)
+
+    def horarios_kernel(self):
+        '''
+        Devuelve los horarios del modulo time de iptables que corresponden a
+        los rangos horarios de la politica. Los rangos con el mismo horario en
+        distintos dias se agrupan en un unico horario.
+        '''
+        dias = defaultdict(set)
+        for horario in self.horarios:
+            # el rango no incluye la hora de fin y timestop si la incluye
+            if horario.hora_inicial < horario.hora_fin:
+                dias[(horario.hora_inicial, horario.hora_fin)].add(
+                    horario.dia
+                )
+        ret = list()
+        for (inicio, fin), numeros in sorted(dias.items()):
+            fin = (datetime.combine(datetime.today(), fin) -
+                   timedelta(seconds=1)).time()
+            ret.append(Horario(numeros, inicio, fin))
+        return ret
+
     def flags_bajada(self, lista):
         '''
         Como las reglas del trafico de bajada se aplican en la interfaz inside,
@@ -309,35 +956,20 @@ class Politica(models.Model):
         '''
         if not self.velocidad_bajada and not self.prioridad:
             return lista
-        pares = ((Flag.IP_ORIGEN, Flag.IP_DESTINO),
-                 (Flag.PUERTO_ORIGEN, Flag.PUERTO_DESTINO),)
-        ret = list(lista)
-        for item in lista:
-            # hago una copia de los flags eliminando los valores de los pares
-            modificado = False
-            nuevo = self.__item_bajada(item)
-            # intercambio de pares
-            for origen, destino in pares:
-                if origen in item:
-                    modificado = nuevo[destino] = item[origen]
-                if destino in item:
-                    modificado = nuevo[origen] = item[destino]
-            # agrego nuevo item a la lista de flags
-            if modificado:
-                ret.append(nuevo)
-        return ret
+        return Flujo(self.__bajada, lista)
 
-    def __item_bajada(self, item):
+    @staticmethod
+    def __bajada(lista):
         '''
-        Copia un diccionario de flags, eliminando keys no deseadas para aplicar
-        los flags de bajada.
+        Recorre dos veces la lista: primero devuelve las reglas de subida y
+        luego las de bajada de las reglas que tienen redes o puertos.
         '''
-        indeseables = (Flag.IP_ORIGEN, Flag.IP_DESTINO, Flag.PUERTO_ORIGEN,
-                       Flag.PUERTO_DESTINO)
-        nuevo = item.copy()
-        for key in indeseables:
-            nuevo.pop(key, None)
-        return nuevo
+        for item in lista:
+            yield item
+        for item in lista:
+            nuevo = FlagsRegla.desde(item).bajada()
+            if nuevo is not None:
+                yield nuevo
 
     def hay_puertos(self):
         '''
@@ -355,6 +987,12 @@ class Politica(models.Model):
         '''
         return self.parametros[Param.MAC]
 
+    def hay_horarios(self):
+        '''
+        Devuelve verdadero si la politica tiene rangos horarios.
+        '''
+        return bool(list(self.horarios))
+
     def hay_redes(self):
         '''
         Devuelve verdadero si se definen redes en la politica.
@@ -364,17 +1002,28 @@ class Politica(models.Model):
 
     def producto_cartesiano(self, lista1, lista2):
         '''
-        Realiza el producto cartesiano entre dos listas de diccionarios.
+        Devuelve un flujo con el producto cartesiano entre las reglas de la
+        primera lista, que puede ser un flujo, y los flags de la segunda.
         '''
-        if not lista1:
-            return lista2
-        elif not lista2:
-            return lista1
-        else:
-            lista = list()
-            for flags1, flags2 in itertools.product(lista1, lista2):
-                lista.append(dict(flags1, **flags2))
-            return lista
+        return Flujo(self.__producto, lista1,
+                     [FlagsRegla.desde(flags) for flags in lista2])
+
+    @staticmethod
+    def __producto(lista1, lista2):
+        '''
+        Genera el producto cartesiano. Si alguna de las listas esta vacia
+        devuelve los elementos de la otra.
+        '''
+        vacia = True
+        for flags1 in lista1:
+            vacia = False
+            if not lista2:
+                yield FlagsRegla.desde(flags1)
+            for flags2 in lista2:
+                yield FlagsRegla.desde(flags1).combinar(flags2)
+        if vacia:
+            for flags2 in lista2:
+                yield flags2
 
     def esta_activa(self, fecha=None):
         '''
@@ -385,12 +1034,13 @@ class Politica(models.Model):
         '''
         if not self.activa:
             return False
+        horarios = list(self.horarios)
         # si no tiene restriccion de horarios, esta activa
-        if self.horarios.count() == 0:
+        if not horarios:
             return True
         fecha = fecha or datetime.now()
         # Si existe algun rango activo
-        for horario in self.horarios:
+        for horario in horarios:
             if fecha in horario:
                 return True
         return False
@@ -447,17 +1097,20 @@ class Objetivo(models.Model):
         Obtiene los valores de parametros para que coincida las subredes de la
         clase.
         '''
-        if self.clase and self.clase.redes.count() > 0:
-            param = (Param.IP_ORIGEN if self.tipo == Objetivo.ORIGEN else
-                     Param.IP_DESTINO)
+        if self.clase:
+            param, clases = ((Param.IP_ORIGEN, Param.CLASE_ORIGEN)
+                             if self.tipo == Objetivo.ORIGEN else
+                             (Param.IP_DESTINO, Param.CLASE_DESTINO))
             for item in self.clase.redes:
                 politica.parametros[param].add(str(item.cidr))
+                politica.parametros[clases].add(self.clase.id_clase)
+                politica.redes_clase[self.clase.id_clase].add(str(item.cidr))
 
     def parametros_puertos(self, politica):
         '''
         Obtiene los flags para que coincida los puertos de la clase.
         '''
-        if self.clase and self.clase.puertos.count() > 0:
+        if self.clase:
             for item in self.clase.puertos:
                 for proto in (Protocolo.TCP, Protocolo.UDP):
                     param = self.definir_parametro_puerto(proto, item.puerto,
@@ -494,7 +1147,8 @@ class RangoHorario(models.Model):
 
     Atributos
     ----------
-        * dia: Dia de la semana, entre 0 y 6 siendo 0 el dia domingo y 6 sabado
+        * dia: Dia de la semana, entre 0 y 6 siendo 0 el dia lunes y 6
+          domingo, igual que `datetime.weekday()`
         * hora_inicial: Hora de inicio del rango valido
         * hora_fin: Hora de fin del rango valido
     '''
@@ -505,6 +1159,17 @@ class RangoHorario(models.Model):
     hora_inicial = models.TimeField()
     hora_fin = models.TimeField()
 
+    # Nombre de cada dia de la semana en el modulo time de iptables, segun el
+    # numero de dia que se guarda en la base de datos
+    DIAS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+    @classmethod
+    def nombre_dia(cls, dia):
+        '''
+        Devuelve el nombre del dia de la semana en el modulo time de iptables.
+        '''
+        return cls.DIAS[dia]
+
     def __contains__(self, item):
         '''
         Devuelve verdadero si la fecha-hora (item) esta dentro del rango.
@@ -512,6 +1177,152 @@ class RangoHorario(models.Model):
         return (item.weekday() == self.dia and
                 self.hora_inicial <= item.time() < self.hora_fin)
 
+    def limites(self, fecha):
+        '''
+        Devuelve las proximas fechas posteriores a la fecha pasada por
+        parametro en las que el rango empieza y termina.
+        '''
+        dias = (self.dia - fecha.weekday()) % 7
+        for hora in (self.hora_inicial, self.hora_fin):
+            limite = datetime.combine(fecha.date() + timedelta(days=dias),
+                                      hora)
+            if limite <= fecha:
+                limite += timedelta(days=7)
+            yield limite
+
     class Meta:
         database = db
         db_table = u'rango_horario'
+
+
+class VersionTabla(models.Model):
+    '''
+    Version de cada tabla que define las politicas. Un disparador de la tabla
+    incrementa la version y registra la fecha de modificacion en cada
+    sentencia que la modifica, de manera que se puede saber si cambiaron las
+    politicas con una unica consulta, sin cargarlas.
+    '''
+    # Tablas que definen las politicas despachadas
+    TABLAS = ('politica', 'rango_horario', 'objetivo', 'clase_trafico',
+              'cidr', 'puerto', 'clase_cidr', 'clase_puerto')
+
+    FUNCION = '''
+CREATE OR REPLACE FUNCTION netcop_versionar() RETURNS trigger AS $$
+BEGIN
+    UPDATE version_tabla SET version = version + 1, modificacion = now()
+    WHERE tabla = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+'''
+
+    DISPARADOR = '''
+CREATE TRIGGER netcop_versionar
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s
+FOR EACH STATEMENT EXECUTE PROCEDURE netcop_versionar()
+'''
+
+    tabla = models.CharField(max_length=32, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    modificacion = models.DateTimeField(default=datetime.now)
+
+    @classmethod
+    def instalar(cls):
+        '''
+        Crea la tabla de versiones y los disparadores que la mantienen en las
+        tablas de politicas. Solo se puede instalar en PostgreSQL.
+        '''
+        with db.atomic():
+            db.create_tables([cls], safe=True)
+            for tabla in cls.TABLAS:
+                if not cls.select().where(cls.tabla == tabla).exists():
+                    cls.create(tabla=tabla)
+            db.execute_sql(cls.FUNCION)
+            for tabla in cls.TABLAS:
+                db.execute_sql("DROP TRIGGER IF EXISTS netcop_versionar ON "
+                               "%s" % tabla)
+                db.execute_sql(cls.DISPARADOR % tabla)
+
+    @classmethod
+    def consultar(cls):
+        '''
+        Devuelve la version de las politicas, la suma de las versiones de sus
+        tablas, que aumenta con cada modificacion. Devuelve None si no se
+        instalaron las versiones en la base de datos y lanza la excepcion si
+        no se pudo consultar la base de datos.
+        '''
+        if not isinstance(db, models.PostgresqlDatabase):
+            return None
+        try:
+            # si la tabla no existe PostgreSQL aborta la transaccion, que se
+            # deshace al salir del bloque
+            with db.atomic():
+                version = cls.select(models.fn.SUM(cls.version)).scalar()
+        except models.ProgrammingError:
+            return None
+        return int(version) if version is not None else None
+
+    @classmethod
+    def actual(cls):
+        '''
+        Devuelve la version de las politicas, o None si no se instalaron las
+        versiones o si no se pudo consultar la base de datos.
+        '''
+        try:
+            return cls.consultar()
+        except (models.DatabaseError, models.InterfaceError):
+            return None
+
+    class Meta:
+        database = db
+        db_table = u'version_tabla'
+
+
+def precargar(politicas):
+    '''
+    Carga en memoria el grafo completo de las politicas pasadas por parametro:
+    rangos horarios, objetivos, clases de trafico, redes y puertos.
+
+    Utiliza una cantidad fija de consultas a la base de datos, sin importar la
+    cantidad de politicas o clases. Luego de precargar, `flags()` y
+    `esta_activa()` no realizan consultas.
+    '''
+    politicas = list(politicas)
+    horarios = defaultdict(list)
+    objetivos = defaultdict(list)
+    ids = [p.id_politica for p in politicas]
+    if ids:
+        for horario in RangoHorario.select().where(
+                RangoHorario.politica << ids):
+            horarios[horario.id_politica].append(horario)
+        for objetivo in Objetivo.select().where(Objetivo.politica << ids):
+            objetivos[objetivo.id_politica].append(objetivo)
+    # cargo las clases de trafico referenciadas por los objetivos
+    clases = dict()
+    redes = defaultdict(list)
+    puertos = defaultdict(list)
+    ids = set(o.id_clase for items in objetivos.values() for o in items
+              if o.id_clase is not None)
+    if ids:
+        for clase in ClaseTrafico.select().where(ClaseTrafico.id_clase << ids):
+            clases[clase.id_clase] = clase
+        for item in (ClaseCIDR.select(ClaseCIDR, CIDR)
+                              .join(CIDR)
+                              .where(ClaseCIDR.clase << ids)):
+            redes[item.id_clase].append(item)
+        for item in (ClasePuerto.select(ClasePuerto, Puerto)
+                                .join(Puerto)
+                                .where(ClasePuerto.clase << ids)):
+            puertos[item.id_clase].append(item)
+    for clase in clases.values():
+        clase.redes = redes[clase.id_clase]
+        clase.puertos = puertos[clase.id_clase]
+    # armo el grafo en memoria
+    for politica in politicas:
+        politica.horarios = horarios[politica.id_politica]
+        politica.objetivos = objetivos[politica.id_politica]
+        for objetivo in politica.objetivos:
+            objetivo.politica = politica
+            if objetivo.id_clase is not None:
+                objetivo.clase = clases[objetivo.id_clase]
+    return politicas
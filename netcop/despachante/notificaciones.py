@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+Recibe avisos de la base de datos cuando se modifican las politicas, para
+despacharlas en el momento sin esperar a la proxima ejecucion del cron.
+
+Utiliza LISTEN/NOTIFY de PostgreSQL. Los disparadores de las tablas que
+definen las politicas envian una notificacion por el canal `CANAL` en cada
+sentencia que las modifica.
+
+Si se pierde la conexion se vuelve a conectar y a escuchar el canal. Como las
+notificaciones enviadas mientras tanto se pierden, se informa como un cambio
+de politicas.
+'''
+import select
+import logging
+import psycopg2
+import psycopg2.extensions
+from . import config, models
+
+log = logging.getLogger(__name__)
+
+# Canal por el que se notifican los cambios de politicas
+CANAL = 'netcop_politicas'
+
+# Tablas cuyas modificaciones cambian las politicas despachadas, las mismas
+# que versiona la base de datos
+TABLAS = models.VersionTabla.TABLAS
+
+FUNCION = '''
+CREATE OR REPLACE FUNCTION netcop_notificar() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('%s', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+''' % CANAL
+
+DISPARADOR = '''
+CREATE TRIGGER netcop_notificar
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s
+FOR EACH STATEMENT EXECUTE PROCEDURE netcop_notificar()
+'''
+
+
+def conectar():
+    '''
+    Abre una conexion con los parametros del archivo de configuracion.
+    '''
+    return psycopg2.connect(
+        database=config.DATABASE['database'],
+        host=config.DATABASE['host'],
+        user=config.DATABASE['user'],
+        password=config.DATABASE['password'],
+    )
+
+
+class Escucha:
+    '''
+    Conexion dedicada a la base de datos que escucha las notificaciones de
+    cambios de politicas.
+    '''
+
+    def __init__(self, conexion=None, conectar=conectar):
+        '''
+        Si no se pasa una conexion por parametro se abre con la funcion
+        conectar, que tambien se utiliza para volver a conectar si se pierde
+        la conexion.
+        '''
+        self.conectar = conectar
+        self.escuchando = False
+        self.conexion = None
+        self.abrir(conexion)
+
+    def abrir(self, conexion=None):
+        '''
+        Abre la conexion, si no se pasa por parametro, en modo autocommit.
+        '''
+        if conexion is None:
+            conexion = self.conectar()
+        conexion.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        )
+        self.conexion = conexion
+
+    def instalar(self):
+        '''
+        Crea o reemplaza los disparadores que notifican los cambios en las
+        tablas de politicas.
+        '''
+        cursor = self.conexion.cursor()
+        cursor.execute(FUNCION)
+        for tabla in TABLAS:
+            cursor.execute("DROP TRIGGER IF EXISTS netcop_notificar ON %s" %
+                           tabla)
+            cursor.execute(DISPARADOR % tabla)
+        cursor.close()
+
+    def escuchar(self):
+        '''
+        Comienza a escuchar el canal de notificaciones.
+        '''
+        cursor = self.conexion.cursor()
+        cursor.execute("LISTEN %s" % CANAL)
+        cursor.close()
+        self.escuchando = True
+
+    def reconectar(self):
+        '''
+        Cierra la conexion, abre una nueva y vuelve a escuchar el canal si se
+        estaba escuchando.
+        '''
+        try:
+            self.conexion.close()
+        except psycopg2.Error:
+            pass
+        self.abrir()
+        if self.escuchando:
+            self.escuchar()
+
+    def esperar(self, segundos):
+        '''
+        Espera una notificacion durante la cantidad de segundos pasada por
+        parametro. Devuelve verdadero si se recibio alguna notificacion.
+
+        Las notificaciones recibidas se descartan, solo interesa saber que hubo
+        cambios. Si se perdio la conexion se vuelve a conectar y se devuelve
+        verdadero, ya que se pudieron perder notificaciones. Si no se puede
+        volver a conectar se lanza la excepcion.
+        '''
+        try:
+            if not self.conexion.notifies:
+                if select.select([self.conexion], [], [], segundos)[0]:
+                    self.conexion.poll()
+        except (psycopg2.Error, select.error, ValueError) as e:
+            log.warning("Se perdio la conexion de notificaciones: %s", e)
+            self.reconectar()
+            return True
+        recibidas = [n.payload for n in self.conexion.notifies]
+        del self.conexion.notifies[:]
+        if recibidas:
+            log.debug("Cambios en las tablas %s", ", ".join(recibidas))
+        return bool(recibidas)
+
+    def cerrar(self):
+        '''
+        Cierra la conexion.
+        '''
+        self.conexion.close()
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+'''
+Plan de un despacho: compila las politicas sin aplicarlas e informa cuanto
+costaria aplicarlas y que cambia respecto del ultimo despacho.
+
+Por cada politica se informa la cantidad de reglas de iptables, de clases y
+filtros del tc, los factores de la expansion de flags y la cantidad de reglas
+que recorre como maximo un paquete de la politica en cada tabla.
+'''
+import json
+from collections import Counter, OrderedDict
+from . import reglas
+
+
+class Plan:
+    '''
+    Compila las politicas con las opciones del despachante sin ejecutar
+    ningun comando ni modificar los archivos del despacho.
+    '''
+
+    def __init__(self, despachante):
+        self.despachante = despachante
+        # datos de cada politica, en el orden en que se aplican
+        self.politicas = list()
+        # reglas en FORWARD de cada tabla, las que recorre un paquete que no
+        # coincide con ninguna politica
+        self.tablas = OrderedDict()
+        # diferencias con el ultimo despacho, None si no se encontro
+        self.diferencias = None
+        # reglas que recorren los paquetes siguientes de una conexion ya
+        # clasificada con connmark, None sin connmark
+        self.conexion = None
+
+    def calcular(self, politicas=None):
+        '''
+        Compila las politicas pasadas por parametro, o las activas en el
+        momento actual, y calcula el plan.
+        '''
+        despachante = self.despachante
+        if politicas is None:
+            # el plan no modifica la instantanea local
+            politicas = despachante.obtener_politicas(guardar=False)
+        anterior = None
+        if despachante.incremental:
+            anterior = despachante.leer_estado()
+        numeros = despachante.numerar(politicas)
+        configuracion = despachante.configuracion(politicas, numeros,
+                                                  perezosa=True)
+        por_id = dict((p.id_politica, p) for p in politicas)
+        self.politicas = list()
+        self.tablas = OrderedDict((tabla, 0) for tabla in (reglas.MANGLE,
+                                                           reglas.FILTER))
+        for objeto, borrar in configuracion.inicio:
+            if (isinstance(objeto, reglas.Regla) and not borrar and
+                    objeto.cadena == reglas.FORWARD):
+                self.tablas[objeto.tabla] += 1
+        self.conexion = None
+        if despachante.connmark:
+            # las reglas iniciales recuperan la marca de la conexion y
+            # terminan el recorrido de sus paquetes siguientes
+            self.conexion = self.tablas[reglas.MANGLE]
+        actuales = OrderedDict()
+        for fragmento in configuracion.fragmentos:
+            self.politicas.append(self.politica(por_id[fragmento.politica],
+                                                fragmento))
+            if anterior is not None:
+                actuales[str(fragmento.politica)] = [
+                    objeto.a_json() for objeto in fragmento.objetos
+                ]
+        # los paquetes que no captura ninguna politica tambien recorren las
+        # reglas finales, como las que guardan la marca sin clase
+        for objeto in configuracion.fin:
+            if (isinstance(objeto, reglas.Regla) and
+                    objeto.cadena == reglas.FORWARD):
+                self.tablas[objeto.tabla] += 1
+        if anterior is not None:
+            self.diferencias = self.comparar_estado(anterior, actuales)
+        elif despachante.directo:
+            self.diferencias = self.comparar_partes(configuracion)
+        else:
+            self.diferencias = self.comparar_archivos(configuracion)
+        return self
+
+    def politica(self, politica, fragmento):
+        '''
+        Devuelve los datos del plan de una politica. El recorrido de cada
+        tabla es la cantidad de reglas en FORWARD de las politicas anteriores
+        mas las reglas propias, en FORWARD o en su cadena.
+        '''
+        propias = Counter()
+        forward = Counter()
+        clases = 0
+        filtros = 0
+        for objeto in fragmento.objetos:
+            if isinstance(objeto, reglas.Regla):
+                propias[objeto.tabla] += 1
+                if objeto.cadena == reglas.FORWARD:
+                    forward[objeto.tabla] += 1
+            elif isinstance(objeto, reglas.Clase):
+                clases += 1
+            elif isinstance(objeto, reglas.Filtro):
+                filtros += 1
+        recorrido = max([self.tablas.get(tabla, 0) + cantidad
+                         for tabla, cantidad in propias.items()] or [0])
+        for tabla, cantidad in forward.items():
+            self.tablas[tabla] = self.tablas.get(tabla, 0) + cantidad
+        return OrderedDict([
+            ('politica', politica.id_politica),
+            ('nombre', politica.nombre),
+            ('tipo', reglas.tipo_politica(politica)),
+            ('reglas', sum(propias.values())),
+            ('clases', clases),
+            ('filtros', filtros),
+            ('factores', politica.factores()),
+            ('recorrido', recorrido),
+            ('cambio', None),
+        ])
+
+    def comparar_estado(self, anterior, actuales):
+        '''
+        Compara los objetos de cada politica con los del ultimo despacho
+        incremental.
+        '''
+        previas = anterior['politicas']
+        agregados = 0
+        quitados = 0
+        for datos in self.politicas:
+            clave = str(datos['politica'])
+            objetos = actuales[clave]
+            if clave not in previas:
+                datos['cambio'] = 'nueva'
+                agregados += len(objetos)
+            elif previas[clave]['objetos'] != objetos:
+                datos['cambio'] = 'modificada'
+                mas, menos = diferencia(previas[clave]['objetos'], objetos)
+                agregados += mas
+                quitados += menos
+            else:
+                datos['cambio'] = 'sin cambios'
+        quitadas = [int(clave) for clave in previas if clave not in actuales]
+        for clave in quitadas:
+            quitados += len(previas[str(clave)]['objetos'])
+        return OrderedDict([
+            ('referencia', self.despachante.ESTADO_FILE),
+            ('agregados', agregados),
+            ('quitados', quitados),
+            ('quitadas', sorted(quitadas)),
+        ])
+
+    def comparar_archivos(self, configuracion):
+        '''
+        Compara las lineas que se generarian con las de los archivos del
+        ultimo despacho. Devuelve None si no se encontro el script.
+        '''
+        despachante = self.despachante
+        lineas, batch = despachante.emitir(configuracion.operaciones(),
+                                           configuracion.conjuntos())
+        agregados = 0
+        quitados = 0
+        for nombre, archivo, actuales in despachante.secciones(lineas, batch,
+                                                               True):
+            previas = leer_lineas(archivo)
+            if previas is None and nombre == 'script':
+                return None
+            mas, menos = diferencia(previas or [], actuales)
+            agregados += mas
+            quitados += menos
+        return OrderedDict([
+            ('referencia', despachante.SCRIPT_FILE),
+            ('agregados', agregados),
+            ('quitados', quitados),
+            ('quitadas', []),
+        ])
+
+    def comparar_partes(self, configuracion):
+        '''
+        Compara las lineas que se escribirian en la entrada de cada programa
+        del modo directo con las del ultimo despacho correcto, ya que en este
+        modo no se escribe el script. Devuelve None si no se encontro.
+        '''
+        despachante = self.despachante
+        bueno = despachante.leer_bueno()
+        previas = dict((paso.nombre, paso.lineas) for paso in bueno or []
+                       if paso.lineas is not None)
+        if not previas:
+            return None
+        agregados = 0
+        quitados = 0
+        for paso in despachante.partes(configuracion.operaciones(),
+                                       configuracion.conjuntos()):
+            if paso.lineas is None:
+                continue
+            mas, menos = diferencia(previas.pop(paso.nombre, []),
+                                    paso.lineas)
+            agregados += mas
+            quitados += menos
+        # programas del ultimo despacho que ya no reciben lineas
+        for lineas in previas.values():
+            quitados += sum(1 for linea in lineas)
+        return OrderedDict([
+            ('referencia', despachante.BUENO_FILE),
+            ('agregados', agregados),
+            ('quitados', quitados),
+            ('quitadas', []),
+        ])
+
+    def lineas(self):
+        '''
+        Devuelve las lineas del plan para mostrar al usuario.
+        '''
+        formato = "%8s  %-20s %-13s %7s %6s %7s %-14s %9s  %s"
+        lineas = [
+            formato % ('politica', 'nombre', 'tipo', 'reglas', 'clases',
+                       'filtros', 'expansion', 'recorrido', 'cambio'),
+        ]
+        for datos in self.politicas:
+            lineas.append(formato % (
+                datos['politica'], datos['nombre'][:20], datos['tipo'],
+                datos['reglas'], datos['clases'], datos['filtros'],
+                "x".join(str(f) for f in datos['factores'].values()),
+                datos['recorrido'], datos['cambio'] or '-',
+            ))
+        lineas.append("")
+        lineas.append("Expansion: redes x puertos x macs x bajada x horarios")
+        lineas.append("Total: %d reglas, %d clases, %d filtros" % (
+            sum(d['reglas'] for d in self.politicas),
+            sum(d['clases'] for d in self.politicas),
+            sum(d['filtros'] for d in self.politicas),
+        ))
+        for tabla, cantidad in self.tablas.items():
+            lineas.append("Tabla %s: %d reglas en FORWARD" %
+                          (tabla, cantidad))
+        lineas.append("Recorrido maximo de un paquete de una politica: %d "
+                      "reglas" % max([d['recorrido'] for d in self.politicas]
+                                     or [0]))
+        if self.conexion is not None:
+            lineas.append("Recorrido de los paquetes siguientes de una "
+                          "conexion: %d reglas" % self.conexion)
+        if self.diferencias is None:
+            lineas.append("No se encontro un despacho anterior")
+        else:
+            lineas.append("Diferencias con %s: %d agregados, %d quitados" % (
+                self.diferencias['referencia'],
+                self.diferencias['agregados'],
+                self.diferencias['quitados'],
+            ))
+            if self.diferencias['quitadas']:
+                lineas.append("Politicas quitadas: %s" % ", ".join(
+                    str(x) for x in self.diferencias['quitadas']
+                ))
+        return lineas
+
+
+def diferencia(previos, actuales):
+    '''
+    Devuelve la cantidad de elementos agregados y quitados entre las dos
+    secuencias, sin tener en cuenta el orden.
+    '''
+    restantes = Counter(json.dumps(x) if isinstance(x, list) else x
+                        for x in previos)
+    agregados = 0
+    for elemento in actuales:
+        clave = json.dumps(elemento) if isinstance(elemento, list) else \
+            elemento
+        if restantes[clave] > 0:
+            restantes[clave] -= 1
+        else:
+            agregados += 1
+    return agregados, sum(restantes.values())
+
+
+def leer_lineas(archivo):
+    '''
+    Devuelve un generador de las lineas del archivo, o None si no existe.
+    '''
+    try:
+        f = open(archivo)
+    except (IOError, OSError):
+        return None
+
+    def lineas():
+        with f:
+            for linea in f:
+                yield linea.rstrip('\n')
+    return lineas()
@@ -0,0 +1,705 @@
+# -*- coding: utf-8 -*-
+'''
+Representacion intermedia de la configuracion del kernel.
+
+Las politicas se traducen a objetos que describen las cadenas y reglas de
+iptables y las colas, clases y filtros del tc, sin depender del formato con el
+que se aplican. Los emisores del modulo `comandos` transforman estos objetos en
+un script sh, o en los formatos de iptables-restore, tc -batch o nftables.
+
+Al trabajar sobre objetos se puede comparar, guardar y optimizar el conjunto
+de reglas antes de generar los comandos. Cada objeto se puede serializar en
+JSON para guardar el estado del despacho incremental.
+'''
+import multiprocessing
+from .models import (Conjunto, Politica, Flujo, Flag, PREFIJO_CADENA,
+                     pares_flags)
+
+# Tablas de iptables
+FILTER = 'filter'
+MANGLE = 'mangle'
+
+# Cadena de iptables por la que pasa el trafico reenviado
+FORWARD = 'FORWARD'
+
+# Colas del tc
+COLA_RAIZ = 9999
+COLA_DEFAULT = 9998
+
+# Destinos de las reglas de iptables
+ACCEPT = 'ACCEPT'
+REJECT = 'REJECT'
+RETURN = 'RETURN'
+MARK = 'MARK'
+# guardan la marca del paquete en su conexion y la restauran en los paquetes
+# siguientes
+GUARDAR_MARCA = 'CONNMARK --save-mark'
+RESTAURAR_MARCA = 'CONNMARK --restore-mark'
+
+# Prioridad del filtro fw de cada interfaz
+PRIORIDAD_FILTRO = 1
+
+# Bit que tienen las marcas de todas las clases de las politicas
+MARCA_CLASE = 0x10000
+
+# Marca de las conexiones que no captura ninguna politica. Tiene el bit de las
+# marcas de las clases, por lo que se recupera y termina el recorrido igual que
+# ellas, pero su classid 1:ffff no corresponde a ninguna clase y el tc envia
+# los paquetes a la clase por defecto.
+MARCA_SIN_CLASE = MARCA_CLASE | 0xffff
+
+
+def marca_clase(numero):
+    '''
+    Devuelve la marca de los paquetes de la clase 1:<numero> del tc. El
+    filtro fw sin handles utiliza la marca como classid, con la disciplina
+    raiz 1: en los 16 bits altos y la clase en los bajos. Los numeros de las
+    clases se escriben en hexadecimal en los comandos del tc.
+    '''
+    return MARCA_CLASE | int(str(numero), 16)
+
+
+class Objeto(object):
+    '''
+    Objeto de la representacion intermedia.
+
+    Cada subclase declara en ATRIBUTOS los parametros de su constructor, que
+    identifican al objeto. Dos objetos son iguales si son del mismo tipo y
+    tienen los mismos atributos.
+    '''
+    TIPO = None
+    ATRIBUTOS = ()
+
+    def clave(self):
+        '''
+        Devuelve una tupla con los atributos que identifican al objeto.
+        '''
+        return tuple(getattr(self, nombre) for nombre in self.ATRIBUTOS)
+
+    def a_json(self):
+        '''
+        Devuelve una lista con el tipo y los atributos del objeto que se puede
+        serializar en JSON.
+        '''
+        return [self.TIPO] + [serializar(valor) for valor in self.clave()]
+
+    def __eq__(self, item):
+        return (isinstance(item, Objeto) and self.TIPO == item.TIPO and
+                self.clave() == item.clave())
+
+    def __ne__(self, item):
+        return not self == item
+
+    def __hash__(self):
+        return hash((self.TIPO, self.clave()))
+
+    def __repr__(self):
+        return "%s%r" % (self.__class__.__name__, self.clave())
+
+
+class Comentario(Objeto):
+    '''
+    Comentario que describe los objetos siguientes. Solo se incluye en los
+    scripts sh.
+    '''
+    TIPO = 'comentario'
+    ATRIBUTOS = ('texto',)
+
+    def __init__(self, texto):
+        self.texto = texto
+
+
+class PoliticaCadena(Objeto):
+    '''
+    Politica por defecto de una cadena de iptables del sistema.
+    '''
+    TIPO = 'politica'
+    ATRIBUTOS = ('tabla', 'cadena', 'destino')
+
+    def __init__(self, tabla, cadena, destino):
+        self.tabla = tabla
+        self.cadena = cadena
+        self.destino = destino
+
+
+class Vaciado(Objeto):
+    '''
+    Elimina las reglas de todas las cadenas de una tabla de iptables y, si se
+    indica, las cadenas creadas por el despachante.
+    '''
+    TIPO = 'vaciado'
+    ATRIBUTOS = ('tabla', 'cadenas')
+
+    def __init__(self, tabla, cadenas=False):
+        self.tabla = tabla
+        self.cadenas = cadenas
+
+
+class Cadena(Objeto):
+    '''
+    Cadena de iptables creada por el despachante.
+    '''
+    TIPO = 'cadena'
+    ATRIBUTOS = ('tabla', 'nombre')
+
+    def __init__(self, tabla, nombre):
+        self.tabla = tabla
+        self.nombre = nombre
+
+
+class Regla(Objeto):
+    '''
+    Regla de iptables.
+
+    Los flags son una tupla de pares (flag, valor) en el orden que los espera
+    iptables. Si el destino es MARK, la marca es el valor que se asigna al
+    paquete.
+
+    La posicion, contando desde 1, no identifica a la regla: indica donde se
+    inserta o cual se elimina en lugar de agregarla al final de la cadena o
+    eliminar la primera regla igual.
+    '''
+    TIPO = 'regla'
+    ATRIBUTOS = ('tabla', 'cadena', 'flags', 'destino', 'marca')
+    posicion = None
+
+    def __init__(self, tabla, cadena, flags, destino, marca=None):
+        self.tabla = tabla
+        self.cadena = cadena
+        self.flags = tuple(tuple(par) for par in flags)
+        self.destino = destino
+        self.marca = marca
+
+    def salta_a_cadena(self):
+        '''
+        Devuelve verdadero si la regla salta a la cadena de una politica.
+        '''
+        return self.destino.startswith(PREFIJO_CADENA)
+
+    def en_posicion(self, posicion):
+        '''
+        Devuelve una copia de la regla en la posicion de la cadena pasada por
+        parametro.
+        '''
+        copia = Regla(self.tabla, self.cadena, self.flags, self.destino,
+                      self.marca)
+        copia.posicion = posicion
+        return copia
+
+
+class Qdisc(Objeto):
+    '''
+    Disciplina de colas del tc. El padre es 'root' para la disciplina raiz de
+    la interfaz.
+    '''
+    TIPO = 'qdisc'
+    ATRIBUTOS = ('interfaz', 'padre', 'handle', 'opciones')
+
+    def __init__(self, interfaz, padre, handle, opciones):
+        self.interfaz = interfaz
+        self.padre = padre
+        self.handle = handle
+        self.opciones = opciones
+
+
+class Clase(Objeto):
+    '''
+    Clase HTB del tc. Las velocidades incluyen la unidad.
+    '''
+    TIPO = 'clase'
+    ATRIBUTOS = ('interfaz', 'padre', 'clase', 'velocidad', 'maxima',
+                 'prioridad')
+
+    def __init__(self, interfaz, padre, clase, velocidad, maxima=None,
+                 prioridad=None):
+        self.interfaz = interfaz
+        self.padre = padre
+        self.clase = clase
+        self.velocidad = velocidad
+        self.maxima = maxima
+        self.prioridad = prioridad
+
+
+class Filtro(Objeto):
+    '''
+    Filtro fw del tc, que asigna a la clase los paquetes con la marca (handle)
+    puesta por iptables. Sin handle ni clase el filtro utiliza la marca de
+    cada paquete como classid.
+    '''
+    TIPO = 'filtro'
+    ATRIBUTOS = ('interfaz', 'padre', 'prioridad', 'handle', 'clase')
+
+    def __init__(self, interfaz, padre, prioridad, handle=None, clase=None):
+        self.interfaz = interfaz
+        self.padre = padre
+        self.prioridad = prioridad
+        self.handle = handle
+        self.clase = clase
+
+
+# Tipo de cada objeto serializado
+TIPOS = dict((cls.TIPO, cls) for cls in (Comentario, PoliticaCadena, Vaciado,
+                                         Cadena, Regla, Qdisc, Clase, Filtro))
+
+
+def serializar(valor):
+    '''
+    Convierte un atributo de un objeto en un valor que se puede serializar en
+    JSON. Los conjuntos de ipset se guardan por su nombre.
+    '''
+    if isinstance(valor, Conjunto):
+        return {'conjunto': valor.nombre}
+    if isinstance(valor, (tuple, list)):
+        return [serializar(x) for x in valor]
+    if valor is None or isinstance(valor, (bool, int, float)):
+        return valor
+    return u"%s" % valor
+
+
+def deserializar(valor):
+    '''
+    Convierte un atributo serializado por `serializar` en un valor que genera
+    los mismos comandos.
+    '''
+    if isinstance(valor, dict):
+        return Conjunto.referencia(valor['conjunto'])
+    if isinstance(valor, list):
+        return tuple(deserializar(x) for x in valor)
+    return valor
+
+
+def desde_json(datos):
+    '''
+    Reconstruye un objeto a partir de la lista devuelta por `a_json`.
+    '''
+    return TIPOS[datos[0]](*[deserializar(x) for x in datos[1:]])
+
+
+def es_estructura(objeto):
+    '''
+    Devuelve verdadero si el objeto crea la cadena de una politica o salta a
+    esa cadena.
+
+    Al modificar una politica estos objetos se conservan y solo se reemplaza el
+    contenido de la cadena, de manera que la politica mantiene su posicion.
+    '''
+    return (isinstance(objeto, Cadena) or
+            isinstance(objeto, Regla) and objeto.salta_a_cadena())
+
+
+def tipo_politica(politica):
+    '''
+    Devuelve el tipo de la politica: las politicas con prioridad son de
+    priorizacion, las que tienen velocidades son de limitacion y el resto de
+    restriccion.
+    '''
+    if politica.prioridad:
+        return 'priorizacion'
+    if politica.velocidad_bajada or politica.velocidad_subida:
+        return 'limitacion'
+    return 'restriccion'
+
+
+class Fragmento:
+    '''
+    Objetos que configuran una politica. Es la unidad que se agrega o quita en
+    el despacho incremental.
+    '''
+
+    def __init__(self, politica, numero, objetos, conjuntos=None):
+        '''
+        Recibe el id de la politica, el numero de sus clases en el tc, la lista
+        de objetos en el orden en que se aplican y los conjuntos de ipset que
+        utilizan sus reglas.
+        '''
+        self.politica = politica
+        self.numero = numero
+        self.objetos = objetos
+        self.conjuntos = conjuntos or []
+
+
+class Fragmentos:
+    '''
+    Fragmentos de las politicas que se construyen a medida que se recorren,
+    sin guardarlos. En memoria solo se mantienen los objetos de una politica
+    a la vez.
+
+    Si se pasan metricas, se acumula la duracion de la construccion, que
+    incluye la expansion de los flags, y la cantidad de reglas.
+
+    Si se indica una cantidad de procesos mayor a uno, los fragmentos se
+    construyen en paralelo a partir de copias livianas de las politicas, y se
+    devuelven en el orden original. El numero de cada politica se asigna
+    antes de repartirlas, por lo que no depende de los procesos.
+    '''
+
+    def __init__(self, constructor, politicas, numeros=None, metricas=None,
+                 procesos=None):
+        self.constructor = constructor
+        self.politicas = politicas
+        self.numeros = numeros
+        self.metricas = metricas
+        self.procesos = procesos
+
+    def tareas(self):
+        '''
+        Genera los pares (politica, numero) de cada fragmento.
+        '''
+        for indice, politica in enumerate(self.politicas):
+            numero = (indice + 1 if self.numeros is None else
+                      self.numeros[politica.id_politica])
+            yield politica, numero
+
+    def construidos(self):
+        '''
+        Genera los fragmentos construidos en este proceso o en paralelo.
+        '''
+        if not self.procesos or self.procesos < 2 or len(self.politicas) < 2:
+            for politica, numero in self.tareas():
+                yield self.constructor.politica(politica, numero)
+            return
+        pool = multiprocessing.Pool(min(self.procesos, len(self.politicas)))
+        try:
+            tareas = [(self.constructor, politica.copia(), numero)
+                      for politica, numero in self.tareas()]
+            lote = max(len(self.politicas) // (self.procesos * 4), 1)
+            for fragmento in pool.imap(construir, tareas, lote):
+                yield fragmento
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __iter__(self):
+        fragmentos = self.construidos()
+        if self.metricas is None:
+            for fragmento in fragmentos:
+                yield fragmento
+            return
+        while True:
+            with self.metricas.etapa('construccion'):
+                fragmento = next(fragmentos, None)
+            if fragmento is None:
+                return
+            self.metricas.contar('reglas', len([
+                objeto for objeto in fragmento.objetos
+                if isinstance(objeto, Regla)
+            ]))
+            yield fragmento
+
+    def conjuntos(self):
+        '''
+        Devuelve los conjuntos de ipset que utilizan las reglas de las
+        politicas, sin construir sus reglas.
+        '''
+        for politica in self.politicas:
+            for conjunto in self.constructor.conjuntos(politica):
+                yield conjunto
+
+
+def construir(tarea):
+    '''
+    Construye el fragmento de una tarea (constructor, politica, numero) en un
+    proceso del pool.
+    '''
+    constructor, politica, numero = tarea
+    return constructor.politica(politica, numero)
+
+
+class Configuracion:
+    '''
+    Configuracion completa del kernel: los objetos que inicializan el firewall
+    y el tc, los fragmentos de cada politica y los objetos finales.
+    '''
+
+    def __init__(self, inicio, fragmentos, fin):
+        '''
+        El inicio es una lista de pares (objeto, borrar), ya que la
+        inicializacion elimina la configuracion anterior. Los fragmentos y los
+        objetos finales siempre se agregan.
+
+        Los fragmentos pueden ser una lista o un objeto Fragmentos, que los
+        construye cada vez que se recorren.
+        '''
+        self.inicio = inicio
+        self.fragmentos = fragmentos
+        self.fin = fin
+
+    def operaciones(self):
+        '''
+        Devuelve un flujo de pares (objeto, borrar) que aplica la
+        configuracion completa.
+        '''
+        return Flujo(self.__operaciones)
+
+    def __operaciones(self):
+        for operacion in self.inicio:
+            yield operacion
+        for fragmento in self.fragmentos:
+            for objeto in fragmento.objetos:
+                yield objeto, False
+        for objeto in self.fin:
+            yield objeto, False
+
+    def objetos(self):
+        '''
+        Devuelve los objetos que quedan aplicados luego de la configuracion.
+        '''
+        return [objeto for objeto, borrar in self.operaciones()
+                if not borrar]
+
+    def conjuntos(self):
+        '''
+        Devuelve los conjuntos de ipset que utilizan las reglas.
+        '''
+        if isinstance(self.fragmentos, Fragmentos):
+            return Flujo(self.fragmentos.conjuntos)
+        return [c for fragmento in self.fragmentos
+                for c in fragmento.conjuntos]
+
+
+class Constructor:
+    '''
+    Construye la representacion intermedia de las politicas.
+
+    Las politicas de tc siempre son para trafico saliente, por lo que el
+    trafico de bajada se configura en la interfaz inside y el de subida en la
+    interfaz outside.
+    '''
+
+    def __init__(self, if_outside, if_inside, bw_bajada=100, bw_subida=100,
+                 cant_alta_prioridad=0, usar_cadenas=False, usar_ipset=False,
+                 usar_connmark=False):
+        '''
+        Las velocidades de bajada y subida de las interfaces son en mbit.
+        '''
+        self.if_outside = if_outside
+        self.if_inside = if_inside
+        self.bw_bajada = bw_bajada
+        self.bw_subida = bw_subida
+        self.cant_alta_prioridad = cant_alta_prioridad
+        self.usar_cadenas = usar_cadenas
+        self.usar_ipset = usar_ipset
+        self.usar_connmark = usar_connmark
+
+    def interfaces(self):
+        '''
+        Devuelve tuplas (nombre, interfaz, velocidad en mbit) de las
+        interfaces de subida y bajada.
+        '''
+        return (('OUTSIDE', self.if_outside, self.bw_subida),
+                ('INSIDE', self.if_inside, self.bw_bajada))
+
+    def inicio(self):
+        '''
+        Devuelve los pares (objeto, borrar) que eliminan la configuracion
+        anterior e inicializan el firewall y el tc.
+        '''
+        inicio = [
+            (Comentario('Limpia reglas previas'), False),
+            (PoliticaCadena(FILTER, FORWARD, ACCEPT), False),
+            (Vaciado(FILTER, self.usar_cadenas), False),
+            (Vaciado(MANGLE, self.usar_cadenas), False),
+            (Regla(FILTER, FORWARD, [('-i', 'lo')], ACCEPT), False),
+        ]
+        if self.usar_connmark:
+            # los paquetes de una conexion ya clasificada recuperan la marca
+            # de su clase y no recorren las reglas de las politicas
+            inicio.extend([
+                (Regla(MANGLE, FORWARD, [], RESTAURAR_MARCA), False),
+                (Regla(MANGLE, FORWARD, [(Flag.MARCA, '%#x/%#x' % (
+                    MARCA_CLASE, MARCA_CLASE))], RETURN), False),
+            ])
+        interfaces = self.interfaces()
+        for nombre, interfaz, velocidad in interfaces:
+            inicio.append((self.raiz(interfaz), True))
+        for nombre, interfaz, velocidad in interfaces:
+            inicio.append((Comentario('Configuracion interfaz %s' % nombre),
+                           False))
+            inicio.extend((objeto, False) for objeto in [
+                self.raiz(interfaz),
+                Clase(interfaz, '1:', '1:%d' % COLA_RAIZ,
+                      '%smbit' % velocidad),
+                Clase(interfaz, '1:%d' % COLA_RAIZ, '1:%d' % COLA_DEFAULT,
+                      '1kbit', '%smbit' % velocidad, Politica.PRIO_NORMAL),
+                Qdisc(interfaz, '1:%d' % COLA_DEFAULT, '%d:' % COLA_DEFAULT,
+                      'sfq perturb 10'),
+                # un unico filtro clasifica los paquetes de todas las
+                # politicas segun su marca
+                Filtro(interfaz, '1:', PRIORIDAD_FILTRO),
+            ])
+        return inicio
+
+    def raiz(self, interfaz):
+        '''
+        Disciplina de colas raiz de la interfaz.
+        '''
+        return Qdisc(interfaz, 'root', '1:', 'htb default %d' % COLA_DEFAULT)
+
+    def fin(self):
+        '''
+        Objetos finales: por defecto se acepta todo el trafico.
+
+        Con connmark las conexiones que no captura ninguna politica guardan la
+        marca sin clase, de manera que sus paquetes siguientes tampoco
+        recorren las reglas de las politicas.
+        '''
+        fin = list()
+        if self.usar_connmark:
+            fin.extend([
+                Regla(MANGLE, FORWARD, [], MARK, MARCA_SIN_CLASE),
+                Regla(MANGLE, FORWARD, [], GUARDAR_MARCA),
+            ])
+        return fin + [PoliticaCadena(FILTER, cadena, ACCEPT)
+                      for cadena in ('INPUT', FORWARD, 'OUTPUT')]
+
+    def configuracion(self, politicas, numeros=None, perezosa=False,
+                      metricas=None, procesos=None):
+        '''
+        Construye la configuracion completa de las politicas pasadas por
+        parametro.
+
+        Si se pasa un diccionario con el numero de cada politica se utiliza
+        para las clases del tc en lugar de la posicion en la lista.
+
+        En una configuracion perezosa los fragmentos de las politicas se
+        construyen a medida que se recorren las operaciones, de manera que la
+        memoria no depende de la cantidad de reglas.
+
+        Con mas de un proceso las politicas se construyen en paralelo.
+        '''
+        fragmentos = Fragmentos(self, politicas, numeros, metricas, procesos)
+        if not perezosa:
+            fragmentos = list(fragmentos)
+        return Configuracion(self.inicio(), fragmentos, self.fin())
+
+    def politica(self, politica, numero):
+        '''
+        Construye el fragmento de una politica segun su tipo.
+        '''
+        tipo = tipo_politica(politica)
+        if tipo == 'priorizacion':
+            objetos = self.priorizacion(politica, numero)
+        elif tipo == 'limitacion':
+            objetos = self.limitacion(politica, numero)
+        else:
+            objetos = self.restriccion(politica)
+        conjuntos = politica.conjuntos() if self.usar_ipset else []
+        return Fragmento(politica.id_politica, numero, objetos, conjuntos)
+
+    def conjuntos(self, politica):
+        '''
+        Devuelve los conjuntos de ipset que utilizan las reglas de la
+        politica.
+        '''
+        if not self.usar_ipset:
+            return []
+        for objetivo in politica.objetivos:
+            objetivo.obtener_parametros(politica)
+        return politica.conjuntos()
+
+    def clase(self, politica, numero, interfaz, velocidad, maxima,
+              prioridad):
+        '''
+        Devuelve la clase de la politica en la interfaz. El filtro de la
+        interfaz le asigna los paquetes con la marca de la clase.
+        '''
+        return [
+            Clase(interfaz, '1:%d' % COLA_RAIZ, '1:%d' % numero, velocidad,
+                  maxima, prioridad),
+        ]
+
+    def priorizacion(self, politica, numero):
+        '''
+        Las politicas de prioridad alta reparten la velocidad de la interfaz
+        como velocidad garantizada. El resto tiene garantizado 1kbit.
+
+        En el tc un mbit son 1000 kbit, por lo que la velocidad garantizada
+        nunca supera la velocidad de la interfaz.
+        '''
+        objetos = [Comentario('priorizacion %d' % politica.id_politica)]
+        for nombre, interfaz, velocidad in self.interfaces():
+            if politica.prioridad == Politica.PRIO_ALTA:
+                minima = "%dkbit" % (int(velocidad) * 1000 //
+                                     max(self.cant_alta_prioridad, 1))
+            else:
+                minima = '1kbit'
+            objetos.extend(self.clase(politica, numero, interfaz, minima,
+                                      '%smbit' % velocidad,
+                                      politica.prioridad))
+        return objetos + self.marcado(politica, numero)
+
+    def limitacion(self, politica, numero):
+        '''
+        Las politicas de limitacion tienen como velocidad maxima la velocidad
+        de subida y bajada de la politica, en kbit.
+        '''
+        objetos = [Comentario('limitacion %d' % politica.id_politica)]
+        if politica.velocidad_subida:
+            objetos.extend(self.clase(politica, numero, self.if_outside,
+                                      '1kbit',
+                                      '%skbit' % politica.velocidad_subida,
+                                      Politica.PRIO_NORMAL))
+        if politica.velocidad_bajada:
+            objetos.extend(self.clase(politica, numero, self.if_inside,
+                                      '1kbit',
+                                      '%skbit' % politica.velocidad_bajada,
+                                      Politica.PRIO_NORMAL))
+        return objetos + self.marcado(politica, numero)
+
+    def restriccion(self, politica):
+        '''
+        Las politicas de restriccion rechazan los paquetes que capturan.
+        '''
+        objetos = [Comentario('restriccion %d' % politica.id_politica)]
+        return objetos + self.reglas(politica, FILTER, [REJECT])
+
+    def marcado(self, politica, numero):
+        '''
+        Marca los paquetes de una politica de priorizacion o limitacion con la
+        marca de su clase, para que el tc los asigne a la clase de la
+        politica. Luego de marcar el paquete se termina el recorrido de la
+        tabla.
+
+        Con connmark la marca tambien se guarda en la conexion, de manera que
+        solo se clasifica el primer paquete de cada conexion.
+        '''
+        destinos = [MARK, RETURN]
+        if self.usar_connmark:
+            destinos = [MARK, GUARDAR_MARCA, RETURN]
+        return self.reglas(politica, MANGLE, destinos, marca_clase(numero))
+
+    def reglas(self, politica, tabla, destinos, marca=None):
+        '''
+        Devuelve las reglas que aplican los destinos pasados por parametro a
+        los paquetes que captura la politica. La marca se asigna en el destino
+        MARK.
+
+        Con cadenas por politica las reglas se agregan a una cadena propia de
+        la politica, a la que se entra con un unico salto desde FORWARD. En la
+        cadena propia se termina el recorrido de la tabla mangle con ACCEPT,
+        igual que con RETURN en FORWARD.
+
+        Los flags de las reglas se recorren como un flujo, sin guardar la
+        lista completa de combinaciones.
+        '''
+        lista = politica.iter_flags()
+        cadena = FORWARD
+        objetos = list()
+        if self.usar_cadenas and lista:
+            cadena = politica.cadena
+            objetos.append(Cadena(tabla, cadena))
+            destinos = [ACCEPT if d == RETURN else d for d in destinos]
+        # flags que comparten todas las reglas, para el salto a la cadena
+        comunes = None
+        for flags in lista:
+            comunes = flags if comunes is None else comunes.comunes(flags)
+            flags = pares_flags(flags)
+            for destino in destinos:
+                objetos.append(Regla(tabla, cadena, flags, destino,
+                                     marca if destino == MARK else None))
+        if cadena != FORWARD:
+            comunes = politica.flags_comunes([comunes])
+            objetos.append(Regla(tabla, FORWARD, pares_flags(comunes),
+                                 cadena))
+        return objetos
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Vigencia del ultimo despacho: la version de las tablas de politicas y la
+fecha del proximo cambio de politicas activas por sus rangos horarios.
+
+Mientras no cambie la version, ni las opciones del despachante y la
+configuracion, ni llegue la fecha del proximo cambio, el despacho sigue
+vigente. Este modulo no carga los modelos ni el despachante,
+de manera que el despacho temporizado puede terminar sin importarlos cuando
+no hay nada que despachar.
+'''
+import hashlib
+import json
+import time
+
+# Archivo con la vigencia del ultimo despacho
+ARCHIVO = '/tmp/netcop-despachar-version'
+
+# Version de las politicas, la suma de las versiones de sus tablas
+CONSULTA = 'SELECT sum(version) FROM version_tabla'
+
+# Opciones del despachante que cambian las reglas despachadas
+OPCIONES = ('iptables_restore', 'tc_batch', 'ipset', 'multiport',
+            'incremental', 'cadenas', 'horario_kernel', 'nftables',
+            'agregacion', 'directo', 'paralelo', 'connmark')
+
+
+def leer(archivo=ARCHIVO):
+    '''
+    Devuelve la vigencia del ultimo despacho, un diccionario con la version y
+    la fecha del proximo cambio en segundos desde la epoca, o None si no se
+    encontro.
+    '''
+    try:
+        with open(archivo) as f:
+            datos = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(datos, dict) or datos.get('version') is None:
+        return None
+    return datos
+
+
+def contexto(opciones):
+    '''
+    Devuelve el hash de las opciones del despachante y de la configuracion de
+    netcop y del despachante. Las opciones que no estan en el diccionario o
+    son None se leen del archivo de configuracion, como en el despachante.
+    '''
+    from . import config
+    valores = dict()
+    for nombre in OPCIONES:
+        valor = opciones.get(nombre)
+        if valor is None:
+            valor = config.habilitada('DESPACHANTE', nombre)
+        valores[nombre] = bool(valor)
+    # con nftables el despachante no aplica el despacho incremental
+    if valores['nftables']:
+        valores['incremental'] = False
+    datos = {
+        'opciones': valores,
+        'netcop': config.NETCOP,
+        'despachante': config.DESPACHANTE,
+    }
+    texto = json.dumps(datos, sort_keys=True)
+    return hashlib.sha1(texto.encode('utf-8')).hexdigest()
+
+
+def guardar(archivo, version, proximo, contexto=None):
+    '''
+    Guarda la version de las politicas despachada, la fecha del proximo
+    cambio, un datetime o None si no hay cambios programados, y el hash de
+    las opciones y la configuracion con que se despacho.
+    '''
+    if proximo is not None:
+        proximo = time.mktime(proximo.timetuple())
+    with open(archivo, 'w') as f:
+        json.dump({'version': version, 'proximo': proximo,
+                   'contexto': contexto}, f)
+
+
+def vencida(datos, ahora=None):
+    '''
+    Devuelve verdadero si llego la fecha del proximo cambio de la vigencia.
+    '''
+    ahora = time.time() if ahora is None else ahora
+    return datos['proximo'] is not None and ahora >= datos['proximo']
+
+
+def version_actual():
+    '''
+    Devuelve la version de las politicas consultando directamente la base de
+    datos con psycopg2, o None si no se pudo obtener.
+    '''
+    import psycopg2
+    from . import config
+    try:
+        conexion = psycopg2.connect(
+            database=config.DATABASE['database'],
+            host=config.DATABASE['host'],
+            user=config.DATABASE['user'],
+            password=config.DATABASE['password'],
+        )
+    except psycopg2.Error:
+        return None
+    try:
+        cursor = conexion.cursor()
+        cursor.execute(CONSULTA)
+        version = cursor.fetchone()[0]
+        return int(version) if version is not None else None
+    except psycopg2.Error:
+        return None
+    finally:
+        conexion.close()
+
+
+def vigente(archivo=ARCHIVO, contexto=None):
+    '''
+    Devuelve verdadero si el ultimo despacho sigue vigente, sin cargar los
+    modelos. El contexto es el hash de las opciones y la configuracion del
+    despacho actual, que debe ser el del ultimo despacho. La base de datos
+    solo se consulta si no llego la fecha del proximo cambio.
+    '''
+    datos = leer(archivo)
+    if (datos is None or datos.get('contexto') != contexto or
+            vencida(datos)):
+        return False
+    return version_actual() == datos['version']
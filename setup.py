@@ -6,19 +6,14 @@ setup(
     author='Yonatan Romero',
     author_email='yromero@openmailbox.org',
     keywords='netcop despachante',
-    packages=['netcop', 'netcop.despachante', 'netcop.despachante.templates'],
+    packages=['netcop', 'netcop.despachante'],
     url='https://github.com/grupo106/despachante',
     namespace_packages=['netcop'],
     description='Despachante de politicas de usuario',
     long_description=open('README.md').read(),
-    package_data={
-        # Incluir templates de Jinja2
-        '': ['*.jinja'],
-    },
     install_requires=[
         'peewee>=2.8.1',
         'psycopg2>=2.6.2',
-        'Jinja2>=2.8',
     ],
     scripts=["scripts/despachar"],
     test_suite="tests",
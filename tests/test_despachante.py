@@ -2,15 +2,26 @@
 '''
 Pruebas del despachante de clases de trafico.
 '''
+import os
+import sys
+import json
+import shutil
+import tempfile
 import unittest
+import subprocess
 import mock
-import jinja2
-from datetime import datetime, timedelta
+import peewee
+import psycopg2
+from datetime import datetime, timedelta, time
 from mock import Mock
 
-from netcop.despachante import models, Despachante
+from netcop.despachante import (models, config, comandos, reglas,
+                                vigencia, aplicacion, notificaciones,
+                                Despachante)
 from netcop.despachante.models import Flag, Param
-from jinja2 import Environment, PackageLoader
+from netcop.despachante.demonio import Demonio
+from netcop.despachante.plan import Plan
+from netcop.despachante.instantanea import Instantanea
 
 
 class DespachanteTests(unittest.TestCase):
@@ -467,9 +478,9 @@ class DespachanteTests(unittest.TestCase):
                 assert 53 == item[Flag.PUERTO_ORIGEN]
                 assert 137 == item[Flag.PUERTO_DESTINO]
 
-    def test_template_restriccion(self):
+    def test_script_restriccion(self):
         '''
-        Prueba la generacion del template de restriccion.
+        Prueba la generacion del script de restriccion.
         '''
         # preparo datos
         objetivo_mac = Mock()
@@ -501,12 +512,9 @@ class DespachanteTests(unittest.TestCase):
         politica4 = models.Politica(id_politica=64,
                                     prioridad=1)
         politica4.objetivos = [objetivo_mac, objetivo_ip, objetivo_puerto]
-        env = Environment(loader=PackageLoader('netcop.despachante'))
-        template = env.get_template("main.jinja")
-        script = template.render(politicas=[politica1, politica2, politica3,
-                                            politica4],
-                                 if_outside='eth0',
-                                 if_inside='eth1')
+        script = "\n".join(Despachante().generar_script(
+            [politica1, politica2, politica3, politica4]
+        ))
         assert '1mbit' in script
         assert '2048kbit' in script
         assert '512kbit' in script
@@ -619,9 +627,9 @@ class DespachanteTests(unittest.TestCase):
             politica=politica)
         assert parametro == models.Param.TCP_ORIGEN
 
-    def test_template_limitacion_puerto(self):
+    def test_script_limitacion_puerto(self):
         '''
-        Prueba la generacion del template de limitacion de puertos.
+        Prueba la generacion del script de limitacion de puertos.
         '''
         # preparo datos
         objetivo_puerto = Mock()
@@ -632,11 +640,7 @@ class DespachanteTests(unittest.TestCase):
                                      velocidad_bajada='2048',
                                      velocidad_subida='512')
         limitacion.objetivos = [objetivo_puerto]
-        template = (Environment(loader=PackageLoader('netcop.despachante'))
-                    .get_template("main.jinja"))
-        script = template.render(politicas=[limitacion],
-                                 if_outside='eth0',
-                                 if_inside='eth1')
+        script = "\n".join(Despachante().generar_script([limitacion]))
         assert '2048kbit' in script
         assert '512kbit' in script
         assert 'MARK' in script
@@ -645,49 +649,6 @@ class DespachanteTests(unittest.TestCase):
         assert models.Flag.PUERTO_DESTINO + ' 80' in script
         assert models.Flag.PUERTO_DESTINO + ' 443' in script
 
-    @mock.patch('os.path.getmtime')
-    def test_sin_ultimo_despacho(self, mock):
-        '''
-        Prueba obtener la fecha de ultimo despacho, sin despachos anteriores.
-        Debe devolver None.
-        '''
-        despachante = Despachante()
-        mock.side_effect = OSError()
-        assert despachante.fecha_ultimo_despacho is None
-        assert mock.called
-
-    @mock.patch('os.path.getmtime')
-    def test_ultimo_despacho(self, mock):
-        '''
-        Prueba obtener la fecha de ultimo despacho.
-        '''
-        despachante = Despachante()
-        mock.return_value = 1471446575
-        assert (despachante.fecha_ultimo_despacho.isoformat() ==
-                '2016-08-17T12:09:35')
-        assert mock.called
-
-    @mock.patch('netcop.despachante.models.RangoHorario.select')
-    def test_hay_reglas_temporales(self, mock_select):
-        '''
-        Prueba que devuelva verdadero cuando haya reglas que dependan del
-        tiempo.
-        '''
-        # preparo los mocks
-        despachante = Despachante()
-        mock_exists = Mock()
-        mock_select.return_value = Mock()
-        mock_select.return_value.exists = mock_exists
-        # pruebo en caso de que no existan reglas temporales
-        mock_exists.return_value = False
-        assert not despachante.hay_reglas_temporales()
-        assert mock_exists.called
-        # pruebo en caso de que si existan reglas temporales
-        mock_exists.reset_mock()
-        mock_exists.return_value = True
-        assert despachante.hay_reglas_temporales()
-        assert mock_exists.called
-
     def test_politicas_activas_actual(self):
         '''
         Obtiene lista de politicas activas en tiempo actual.
@@ -786,59 +747,156 @@ class DespachanteTests(unittest.TestCase):
             assert [_ for _ in politicas if _.nombre == 'politica3']
             transaction.rollback()
 
-    @mock.patch.object(Despachante, 'fecha_ultimo_despacho')
-    def test_hay_cambio_politicas(self, mock):
+    def test_hay_cambio_politicas(self):
         '''
-        Prueba la verificacion de cambios de politicas por rango horario.
+        Prueba la verificacion de cambios de politicas comparando la huella de
+        las reglas generadas con la del ultimo despacho.
         '''
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante()
+        despachante.HUELLA_FILE = os.path.join(directorio, 'huella')
         with models.db.atomic() as transaction:
-            now = datetime.now()
-            models.Politica.create(nombre='politica1')
-            politica2 = models.Politica.create(nombre='politica2')
-            models.RangoHorario.create(
-                politica=politica2,
-                dia=now.weekday(),
-                hora_inicial=(now - timedelta(hours=1)).time(),
-                hora_fin=now.time(),
-            )
-            # pruebo en caso verdadero
-            ultimo = now - timedelta(minutes=1)
-            mock.__get__ = Mock(return_value=ultimo)
-            despachante = Despachante()
+            clase = models.ClaseTrafico.create(nombre='web')
+            red = models.CIDR.create(direccion='10.0.0.0', prefijo=8)
+            models.ClaseCIDR.create(clase=clase, cidr=red,
+                                    grupo=models.OUTSIDE)
+            politica = models.Politica.create(nombre='politica1',
+                                              velocidad_bajada=512)
+            models.Objetivo.create(politica=politica, clase=clase,
+                                   tipo=models.Objetivo.DESTINO)
+            despachante.guardar_huella(despachante.calcular_huella(
+                despachante.obtener_politicas()
+            ))
+            # sin cambios
+            assert despachante.hay_cambio_de_politicas() is False
+            # cambio de velocidad de la politica
+            politica.velocidad_bajada = 1024
+            politica.save()
             assert despachante.hay_cambio_de_politicas() is True
-            # pruebo en caso falso
-            ultimo = now - timedelta(hours=2)
-            mock.__get__ = Mock(return_value=ultimo)
+            politica.velocidad_bajada = 512
+            politica.save()
             assert despachante.hay_cambio_de_politicas() is False
+            # cambio de las redes de un objetivo
+            red.prefijo = 16
+            red.save()
+            assert despachante.hay_cambio_de_politicas() is True
             transaction.rollback()
+        shutil.rmtree(directorio)
 
-    @mock.patch.object(Despachante, 'fecha_ultimo_despacho')
-    def test_hay_cambio_politicas_sin_despacho_anterior(self, mock):
+    def test_hay_cambio_politicas_sin_despacho_anterior(self):
         '''
-        Prueba la verificacion de cambios de politicas por rango horario en
-        caso de que no haya despacho anterior.
+        Prueba la verificacion de cambios de politicas en caso de que no haya
+        despacho anterior.
         '''
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante()
+        despachante.HUELLA_FILE = os.path.join(directorio, 'huella')
         with models.db.atomic() as transaction:
-            now = datetime.now()
             models.Politica.create(nombre='politica1')
-            politica2 = models.Politica.create(nombre='politica2')
-            models.RangoHorario.create(
-                politica=politica2,
-                dia=now.weekday(),
-                hora_inicial=(now - timedelta(hours=1)).time(),
-                hora_fin=now.time(),
-            )
-            mock.__get__ = Mock(return_value=None)
-            despachante = Despachante()
             assert despachante.hay_cambio_de_politicas() is True
             transaction.rollback()
+        shutil.rmtree(directorio)
+
+    @mock.patch('subprocess.Popen')
+    def test_despachar_sin_cambios(self, mock_popen):
+        '''
+        Prueba que el despacho no forzado no aplique las reglas si son iguales
+        a las del ultimo despacho, y que la huella se guarde recien cuando se
+        aplicaron.
+        '''
+        mock_popen.return_value.wait.return_value = 0
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante()
+        for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'BUENO_FILE'):
+            setattr(despachante, nombre, os.path.join(directorio, nombre))
+        with models.db.atomic() as transaction:
+            politica = models.Politica.create(nombre='politica1',
+                                              velocidad_bajada=512)
+            assert despachante.despachar(forzar=False) is True
+            assert mock_popen.call_count == 1
+            assert despachante.despachar(forzar=False) is False
+            assert mock_popen.call_count == 1
+            # el despacho forzado se aplica siempre
+            assert despachante.despachar() is True
+            assert mock_popen.call_count == 2
+            politica.velocidad_bajada = 1024
+            politica.save()
+            assert despachante.despachar(forzar=False) is True
+            assert mock_popen.call_count == 3
+            # si la aplicacion se interrumpe se descarta la huella y el
+            # proximo despacho vuelve a aplicar las reglas
+            politica.velocidad_bajada = 2048
+            politica.save()
+            mock_popen.side_effect = RuntimeError('interrumpido')
+            with self.assertRaises(RuntimeError):
+                despachante.despachar(forzar=False)
+            assert despachante.leer_huella() is None
+            mock_popen.side_effect = None
+            assert despachante.despachar(forzar=False) is True
+            assert despachante.leer_huella() is not None
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_huella_estable(self):
+        '''
+        Prueba que la huella de las reglas y el despacho incremental no
+        dependan del orden de los conjuntos de cada proceso, que cambia con
+        PYTHONHASHSEED.
+        '''
+        directorio = tempfile.mkdtemp()
+        raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        codigo = '\n'.join([
+            'from netcop.despachante import Despachante, models',
+            'from netcop.despachante.models import Param',
+            'politicas = list()',
+            'for numero in range(1, 4):',
+            '    politica = models.Politica(id_politica=numero,',
+            '                               velocidad_bajada=512 * numero)',
+            '    politica.objetivos = []',
+            '    politica.parametros[Param.MAC].update(',
+            '        "00:00:00:00:00:%02x" % i for i in range(8))',
+            '    politica.parametros[Param.IP_DESTINO].update(',
+            '        "10.%d.0.0/16" % i for i in range(8))',
+            '    politica.parametros[Param.TCP_DESTINO].update(',
+            '        1000 + 7 * i for i in range(8))',
+            '    politicas.append(politica)',
+            'huellas = [Despachante().calcular_huella(politicas)]',
+            'despachante = Despachante(incremental=True)',
+            'despachante.ESTADO_FILE = %r' % os.path.join(directorio,
+                                                          'estado'),
+            'operaciones, conjuntos, completa, estado, configuracion = \\',
+            '    despachante.generar_incremental(politicas)',
+            'huellas.append(str(len(list(operaciones))))',
+            'despachante.guardar_estado(estado)',
+            'print(" ".join(huellas))',
+        ])
+        salidas = list()
+        for semilla in ('1', '2', '3'):
+            entorno = dict(os.environ)
+            entorno['PYTHONHASHSEED'] = semilla
+            entorno['PYTHONPATH'] = os.pathsep.join(
+                [raiz] + [x for x in [entorno.get('PYTHONPATH')] if x]
+            )
+            proceso = subprocess.Popen([sys.executable, '-c', codigo],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, env=entorno)
+            salida, error = proceso.communicate()
+            assert proceso.returncode == 0, error
+            salidas.append(salida.decode('utf-8').split())
+        # la misma huella en todos los procesos
+        assert len(set(huella for huella, cantidad in salidas)) == 1
+        # el primer despacho incremental es completo y los siguientes no
+        # tienen operaciones, aunque cambie el orden de los conjuntos
+        assert salidas[0][1] != '0'
+        assert [cantidad for huella, cantidad in salidas[1:]] == ['0', '0']
+        shutil.rmtree(directorio)
 
     @mock.patch('subprocess.Popen')
-    @mock.patch.object(jinja2.environment.Template, 'render')
-    def test_despachar(self, mock_render, mock_popen):
+    def test_despachar(self, mock_popen):
         '''
         Prueba la creacion y ejecucion del script de politicas.
         '''
+        mock_popen.return_value.wait.return_value = 0
         with models.db.atomic() as transaction:
             models.Politica.create(nombre='politica1')
             models.Politica.create(nombre='politica2')
@@ -846,20 +904,20 @@ class DespachanteTests(unittest.TestCase):
             mock_open = mock.mock_open()
             with mock.patch('netcop.despachante.despachante.open', mock_open):
                 despachante.despachar()
-            assert mock_render.called
             assert mock_open.called
             assert mock_popen.called
-            mock_open.assert_called_with(Despachante.SCRIPT_FILE, 'w')
-            mock_popen.assert_called_with(['/bin/sh', Despachante.SCRIPT_FILE])
+            mock_open.assert_any_call(Despachante.SCRIPT_FILE, 'w')
+            assert mock_popen.call_args[0][0] == ['/bin/sh',
+                                                  Despachante.SCRIPT_FILE]
             transaction.rollback()
 
     @mock.patch('subprocess.Popen')
-    @mock.patch.object(jinja2.environment.Template, 'render')
-    def test_politica_utf8(self, mock_render, mock_popen):
+    def test_politica_utf8(self, mock_popen):
         '''
         Prueba la creacion y ejecucion del script de politicas con nombres en
         utf-8
         '''
+        mock_popen.return_value.wait.return_value = 0
         with models.db.atomic() as transaction:
             models.Politica.create(nombre=u'ñandú')
             models.Politica.create(nombre=u'voçé')
@@ -867,9 +925,1492 @@ class DespachanteTests(unittest.TestCase):
             mock_open = mock.mock_open()
             with mock.patch('netcop.despachante.despachante.open', mock_open):
                 despachante.despachar()
-            assert mock_render.called
             assert mock_open.called
             assert mock_popen.called
-            mock_open.assert_called_with(Despachante.SCRIPT_FILE, 'w')
-            mock_popen.assert_called_with(['/bin/sh', Despachante.SCRIPT_FILE])
+            mock_open.assert_any_call(Despachante.SCRIPT_FILE, 'w')
+            assert mock_popen.call_args[0][0] == ['/bin/sh',
+                                                  Despachante.SCRIPT_FILE]
+            transaction.rollback()
+
+    def test_script_restore(self):
+        '''
+        Prueba que el script en formato iptables-restore contenga las mismas
+        reglas que el script que ejecuta un comando por regla.
+        '''
+        # preparo datos
+        objetivo_ip = Mock()
+        objetivo_ip.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_ORIGEN: ['192.168.0.0/24'],
+        })
+        objetivo_puerto = Mock()
+        objetivo_puerto.obtener_parametros = lambda x: x.parametros.update({
+            Param.TCP_DESTINO: [80, 443],
+        })
+        restriccion = models.Politica(id_politica=71)
+        restriccion.objetivos = [objetivo_ip, objetivo_puerto]
+        limitacion = models.Politica(id_politica=72, velocidad_bajada=2048)
+        limitacion.objetivos = [objetivo_ip, objetivo_puerto]
+        # genero ambos scripts
+        script = Despachante(iptables_restore=False).generar_script(
+            [restriccion, limitacion])
+        restore = Despachante(iptables_restore=True).generar_script(
+            [restriccion, limitacion])
+        # verifico que no se ejecute iptables por cada regla
+        assert not [x for x in restore if x.startswith('$IPTABLES ')]
+        assert "$IPTABLES_RESTORE <<'EOF'" in restore
+        assert restore[-1] == 'EOF'
+        # verifico que esten todas las reglas en su tabla
+        filtro = restore[restore.index('*filter'):restore.index('*mangle')]
+        mangle = restore[restore.index('*mangle'):]
+        for linea in script:
+            if linea.startswith('$IPTABLES -A FORWARD -t mangle'):
+                regla = linea.replace('$IPTABLES ', '').replace(' -t mangle',
+                                                                '')
+                assert " ".join(regla.split()) in mangle
+            elif linea.startswith('$IPTABLES -A'):
+                regla = linea.replace('$IPTABLES ', '')
+                assert " ".join(regla.split()) in filtro
+        assert ':FORWARD ACCEPT [0:0]' in filtro
+        assert filtro[-1] == 'COMMIT'
+        assert mangle[-2:] == ['COMMIT', 'EOF']
+        # verifico que se mantengan los comandos de tc
+        assert ([x for x in script if x.startswith('$TC')] ==
+                [x for x in restore if x.startswith('$TC')])
+
+    def test_despachar_tc_batch(self):
+        '''
+        Prueba que en modo tc -batch se aplique una unica llamada a tc por
+        interfaz y se informe la duracion de cada etapa.
+        '''
+        with models.db.atomic() as transaction:
+            models.Politica.create(nombre='politica1', velocidad_bajada=512,
+                                   velocidad_subida=256)
+            models.Politica.create(nombre='politica2', prioridad=1)
+            despachante = Despachante(tc_batch=True)
+            limpieza = [Despachante.TC, 'qdisc', 'del', 'dev']
+            # la interfaz outside todavia tiene la disciplina por defecto
+            despachante.ejecutor = aplicacion.Grabador(fallas=[
+                limpieza + [config.NETCOP['outside'], 'root'],
+            ])
+            mock_open = mock.mock_open()
+            with mock.patch('netcop.despachante.despachante.open', mock_open):
+                assert despachante.despachar() is True
+            outside = Despachante.TC_BATCH_FILE % config.NETCOP['outside']
+            inside = Despachante.TC_BATCH_FILE % config.NETCOP['inside']
+            mock_open.assert_any_call(Despachante.SCRIPT_FILE, 'w')
+            mock_open.assert_any_call(outside, 'w')
+            mock_open.assert_any_call(inside, 'w')
+            # verifico que no queden comandos de tc en el script
+            escrito = "".join(c[0][0] for c in mock_open().write.call_args_list
+                              if c[0][0].startswith('$'))
+            assert '$TC' not in escrito
+            # la disciplina raiz se elimina fuera de tc -batch, ya que falla
+            # si la interfaz tiene la disciplina por defecto
+            escrito = "".join(c[0][0]
+                              for c in mock_open().write.call_args_list)
+            assert 'qdisc del' not in escrito
+            assert despachante.ejecutor.comandos == [
+                limpieza + [config.NETCOP['outside'], 'root'],
+                [Despachante.TC, '-force', '-batch', outside],
+                limpieza + [config.NETCOP['inside'], 'root'],
+                [Despachante.TC, '-force', '-batch', inside],
+                ['/bin/sh', Despachante.SCRIPT_FILE],
+            ]
+            for etapa in ('obtener_politicas', 'generar_script', 'escribir',
+                          'tc %s' % config.NETCOP['outside'],
+                          'tc %s' % config.NETCOP['inside'], 'script'):
+                assert etapa in despachante.tiempos
+            transaction.rollback()
+
+    def test_acumulador(self):
+        '''
+        Prueba que el acumulador de lineas pase a un archivo temporal al
+        superar el limite de memoria y se pueda recorrer mas de una vez.
+        '''
+        with mock.patch.object(comandos, 'MAX_MEMORIA', 1024):
+            acumulador = comandos.Acumulador()
+        lineas = ['-A FORWARD -j netcop_%d' % i for i in range(100)]
+        for linea in lineas:
+            acumulador.agregar(linea)
+        assert acumulador.archivo._rolled
+        assert list(acumulador) == lineas
+        acumulador.agregar('COMMIT')
+        assert list(acumulador) == lineas + ['COMMIT']
+
+    @mock.patch('subprocess.Popen')
+    def test_despachar_directo(self, mock_popen):
+        '''
+        Prueba que en modo directo las lineas se escriban en la entrada de tc
+        e iptables-restore sin generar el script, y que no se vuelva a aplicar
+        el mismo conjunto de reglas.
+        '''
+        directorio = tempfile.mkdtemp()
+        with models.db.atomic() as transaction:
+            models.Politica.create(nombre='politica1', velocidad_bajada=512)
+            mock_popen.return_value.wait.return_value = 0
+            despachante = Despachante(directo=True)
+            for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'BUENO_FILE'):
+                setattr(despachante, nombre, os.path.join(directorio, nombre))
+            assert despachante.despachar(forzar=False) is True
+            outside = config.NETCOP['outside']
+            inside = config.NETCOP['inside']
+            assert [c[0][0] for c in mock_popen.call_args_list] == [
+                [Despachante.TC, 'qdisc', 'del', 'dev', outside, 'root'],
+                [Despachante.TC, '-force', '-batch', '-'],
+                [Despachante.TC, 'qdisc', 'del', 'dev', inside, 'root'],
+                [Despachante.TC, '-force', '-batch', '-'],
+                [Despachante.IPTABLES_RESTORE],
+            ]
+            escrito = b"".join(c[0][0] for c in
+                               mock_popen.return_value.stdin.write
+                               .call_args_list).decode('utf-8')
+            assert 'qdisc add dev %s root' % outside in escrito
+            assert '*mangle\n' in escrito and 'COMMIT\n' in escrito
+            assert not os.path.exists(despachante.SCRIPT_FILE)
+            for etapa in ('tc %s' % outside, 'iptables-restore'):
+                assert etapa in despachante.tiempos
+            # las lineas aplicadas se guardan para restaurarlas
+            bueno = despachante.leer_bueno()
+            assert [p.comando for p in bueno] == [
+                c[0][0] for c in mock_popen.call_args_list
+            ]
+            assert '*mangle' in list(bueno[-1].lineas)
+            # sin cambios no se vuelve a aplicar
+            assert despachante.despachar(forzar=False) is False
+            assert mock_popen.call_count == 5
+            # las lineas que se restauran luego de un fallo se cuentan aparte
+            # de las del despacho
+            grabador = aplicacion.Grabador()
+            fallas = [True]
+
+            def ejecutar(comando, lineas=None):
+                codigo, salida = grabador.ejecutar(comando, lineas)
+                if comando == [Despachante.IPTABLES_RESTORE] and fallas:
+                    fallas.pop()
+                    return 1, "error simulado\n"
+                return codigo, salida
+
+            despachante.ejecutor = Mock(ejecutar=ejecutar)
+            self.assertRaises(aplicacion.ErrorAplicacion,
+                              despachante.despachar)
+            contadores = despachante.metricas.contadores
+            assert contadores['lineas'] == sum(
+                len(x) for x in grabador.entradas[:5] if x is not None
+            )
+            assert contadores['lineas_restauradas'] == sum(
+                len(x) for x in grabador.entradas[5:] if x is not None
+            )
+            assert contadores['lineas_restauradas'] > 0
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_metricas(self):
+        '''
+        Prueba que se exporten las metricas de cada etapa del despacho en
+        formato de Prometheus y se agreguen al historial.
+        '''
+        directorio = tempfile.mkdtemp()
+        with models.db.atomic() as transaction:
+            models.Politica.create(nombre='politica1', velocidad_bajada=512)
+            models.Politica.create(nombre='politica2', prioridad=1)
+            models.Politica.create(nombre='politica3')
+            despachante = Despachante(tc_batch=True)
+            despachante.ejecutor = aplicacion.Grabador()
+            for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'BUENO_FILE'):
+                setattr(despachante, nombre, os.path.join(directorio, nombre))
+            despachante.TC_BATCH_FILE = os.path.join(directorio, 'tc-%s')
+            despachante.archivo_metricas = os.path.join(directorio, 'prom')
+            despachante.archivo_historial = os.path.join(directorio, 'json')
+            despachante.despachar()
+            despachante.despachar(forzar=False)
+            transaction.rollback()
+        with open(despachante.archivo_metricas) as f:
+            prometheus = f.read().splitlines()
+        for etapa in ('cargar_politicas', 'evaluar_actividad',
+                      'construccion', 'escribir', 'total'):
+            assert any(x.startswith('netcop_despacho_etapa_segundos'
+                                    '{etapa="%s"} ' % etapa)
+                       for x in prometheus)
+        assert 'netcop_despacho_politicas{tipo="limitacion"} 1' in prometheus
+        assert 'netcop_despacho_politicas{tipo="restriccion"} 1' in prometheus
+        assert 'netcop_despacho_aplicado 0' in prometheus
+        assert 'netcop_despacho_error 0' in prometheus
+        with open(despachante.archivo_historial) as f:
+            historial = json.load(f)
+        assert len(historial) == 2
+        assert historial[0]['contadores']['aplicado'] == 1
+        assert historial[0]['contadores']['consultas'] > 0
+        assert historial[0]['contadores']['lineas'] > 0
+        assert historial[0]['politicas']['priorizacion'] == 1
+        shutil.rmtree(directorio)
+
+    @mock.patch('subprocess.Popen')
+    def test_plan(self, mock_popen):
+        '''
+        Prueba que el plan informe el costo de cada politica y las diferencias
+        con el ultimo despacho sin ejecutar ningun comando.
+        '''
+        mock_popen.return_value.wait.return_value = 0
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante(incremental=True)
+        despachante.SCRIPT_FILE = os.path.join(directorio, 'script')
+        despachante.ESTADO_FILE = os.path.join(directorio, 'estado.json')
+        despachante.HUELLA_FILE = os.path.join(directorio, 'huella')
+        with models.db.atomic() as transaction:
+            clase = models.ClaseTrafico.create(nombre='web')
+            for numero in (80, 443):
+                puerto = models.Puerto.create(numero=numero, protocolo=6)
+                models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                          grupo=models.OUTSIDE)
+            restriccion = models.Politica.create(nombre='restriccion')
+            limitacion = models.Politica.create(nombre='limitacion',
+                                                velocidad_bajada=512)
+            for politica in (restriccion, limitacion):
+                models.Objetivo.create(politica=politica, clase=clase,
+                                       tipo=models.Objetivo.DESTINO)
+            plan = Plan(despachante).calcular()
+            assert not mock_popen.called
+            assert not os.path.exists(despachante.ESTADO_FILE)
+            assert plan.diferencias is None
+            datos = dict((d['nombre'], d) for d in plan.politicas)
+            assert datos['restriccion']['tipo'] == 'restriccion'
+            assert datos['restriccion']['reglas'] == 2
+            assert list(datos['restriccion']['factores'].values()) == \
+                [0, 2, 0, 1, 1]
+            # las reglas de bajada se duplican, con MARK y RETURN cada una
+            assert datos['limitacion']['reglas'] == 8
+            assert datos['limitacion']['clases'] == 1
+            # los paquetes se asignan a la clase con el filtro de la interfaz
+            assert datos['limitacion']['filtros'] == 0
+            assert list(datos['limitacion']['factores'].values()) == \
+                [0, 2, 0, 2, 1]
+            assert plan.tablas == {'mangle': 8, 'filter': 3}
+            assert datos['limitacion']['recorrido'] == 8
+            # diferencias con el despacho anterior
+            despachante.despachar()
+            limitacion.velocidad_bajada = 1024
+            limitacion.save()
+            mock_popen.reset_mock()
+            plan = Plan(despachante).calcular()
+            assert not mock_popen.called
+            datos = dict((d['nombre'], d) for d in plan.politicas)
+            assert datos['restriccion']['cambio'] == 'sin cambios'
+            assert datos['limitacion']['cambio'] == 'modificada'
+            assert plan.diferencias['agregados'] == 1
+            assert plan.diferencias['quitados'] == 1
+            assert any(linea.startswith('Diferencias con')
+                       for linea in plan.lineas())
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    @mock.patch('subprocess.Popen')
+    def test_plan_directo(self, mock_popen):
+        '''
+        Prueba que en modo directo el plan informe las diferencias con el
+        ultimo despacho correcto, cuente las reglas de connmark y no guarde la
+        instantanea local.
+        '''
+        mock_popen.return_value.wait.return_value = 0
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante(directo=True, connmark=True,
+                                  incremental=False)
+        for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'BUENO_FILE',
+                       'VERSION_FILE', 'NUMEROS_FILE', 'CERROJO_FILE'):
+            setattr(despachante, nombre, os.path.join(directorio, nombre))
+        archivo = os.path.join(directorio, 'instantanea')
+        despachante.instantanea = Instantanea(archivo)
+        with models.db.atomic() as transaction:
+            clase = models.ClaseTrafico.create(nombre='web')
+            puerto = models.Puerto.create(numero=80, protocolo=6)
+            models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                      grupo=models.OUTSIDE)
+            limitacion = models.Politica.create(nombre='limitacion',
+                                                velocidad_bajada=512)
+            models.Objetivo.create(politica=limitacion, clase=clase,
+                                   tipo=models.Objetivo.DESTINO)
+            plan = Plan(despachante).calcular()
+            assert not mock_popen.called
+            assert not os.path.exists(archivo)
+            assert plan.diferencias is None
+            datos, = plan.politicas
+            # las reglas iniciales recuperan la marca de la conexion y las
+            # finales guardan la marca sin clase
+            assert plan.conexion == 2
+            assert datos['recorrido'] == 2 + datos['reglas']
+            assert plan.tablas['mangle'] == 2 + datos['reglas'] + 2
+            # diferencias con el ultimo despacho correcto
+            despachante.despachar()
+            assert os.path.exists(archivo)
+            os.remove(archivo)
+            plan = Plan(despachante).calcular()
+            assert plan.diferencias['referencia'] == despachante.BUENO_FILE
+            assert plan.diferencias['agregados'] == 0
+            assert plan.diferencias['quitados'] == 0
+            limitacion.velocidad_bajada = 1024
+            limitacion.save()
+            plan = Plan(despachante).calcular()
+            assert plan.diferencias['agregados'] == 1
+            assert plan.diferencias['quitados'] == 1
+            assert not os.path.exists(archivo)
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_construccion_paralela(self):
+        '''
+        Prueba que construir las politicas en paralelo genere el mismo script
+        y los mismos numeros de politica que construirlas en serie.
+        '''
+        with models.db.atomic() as transaction:
+            for numero in range(6):
+                clase = models.ClaseTrafico.create(nombre='clase%d' % numero)
+                cidr = models.CIDR.create(direccion='10.0.%d.0' % numero,
+                                          prefijo=24)
+                models.ClaseCIDR.create(clase=clase, cidr=cidr,
+                                        grupo=models.OUTSIDE)
+                puerto = models.Puerto.create(numero=1000 + numero,
+                                              protocolo=6)
+                models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                          grupo=models.OUTSIDE)
+                politica = models.Politica.create(
+                    nombre='politica%d' % numero,
+                    velocidad_bajada=512 if numero % 3 == 1 else None,
+                    prioridad=1 if numero % 3 == 2 else None,
+                )
+                models.Objetivo.create(politica=politica, clase=clase,
+                                       tipo=models.Objetivo.DESTINO)
+                models.Objetivo.create(politica=politica,
+                                       direccion_fisica='aa:bb:cc:dd:ee:%02d'
+                                       % numero)
+                models.RangoHorario.create(politica=politica, dia=numero,
+                                           hora_inicial=time(8),
+                                           hora_fin=time(12))
+            opciones = dict(cadenas=True, ipset=True, horario_kernel=True)
+            serie = Despachante(**opciones)
+            paralelo = Despachante(paralelo=True, **opciones)
+            paralelo.procesos = 3
+            assert (paralelo.generar_script(paralelo.obtener_politicas()) ==
+                    serie.generar_script(serie.obtener_politicas()))
+            numeros = dict((p.id_politica, 10 - p.id_politica)
+                           for p in serie.obtener_politicas())
+            fragmentos = paralelo.configuracion(paralelo.obtener_politicas(),
+                                                numeros).fragmentos
+            assert [(f.politica, f.numero) for f in fragmentos] == \
+                sorted(numeros.items())
+            transaction.rollback()
+
+    def test_instantanea(self):
+        '''
+        Prueba que mientras no cambie la version de las tablas de politicas
+        se armen desde la instantanea local sin consultas, generando el mismo
+        script, y que se utilice la instantanea si la base de datos no
+        responde, tambien al despachar.
+        '''
+        directorio = tempfile.mkdtemp()
+        with models.db.atomic() as transaction:
+            clase = models.ClaseTrafico.create(nombre='clase')
+            cidr = models.CIDR.create(direccion='10.0.0.0', prefijo=24)
+            models.ClaseCIDR.create(clase=clase, cidr=cidr,
+                                    grupo=models.OUTSIDE)
+            puerto = models.Puerto.create(numero=80, protocolo=6)
+            models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                      grupo=models.OUTSIDE)
+            politica = models.Politica.create(nombre='foo',
+                                              velocidad_bajada=512)
+            models.Objetivo.create(politica=politica, clase=clase,
+                                   tipo=models.Objetivo.DESTINO)
+            models.Objetivo.create(politica=politica,
+                                   direccion_fisica='00:00:00:00:00:01')
+            models.RangoHorario.create(politica=politica,
+                                       dia=datetime.now().weekday(),
+                                       hora_inicial=time(0),
+                                       hora_fin=time(23, 59, 59))
+            despachante = Despachante()
+            archivo = os.path.join(directorio, 'politicas.pickle')
+            despachante.instantanea = Instantanea(archivo)
+            with mock.patch.object(models.VersionTabla, 'consultar',
+                                   return_value=1) as consultar:
+                script = despachante.generar_script(
+                    despachante.obtener_politicas()
+                )
+                assert not despachante.instantanea.usada
+                assert os.path.exists(archivo)
+                despachante = Despachante()
+                despachante.instantanea = Instantanea(archivo)
+                with mock.patch.object(models.db, 'execute_sql') as mock_sql:
+                    politicas = despachante.obtener_politicas()
+                    assert not mock_sql.called
+                assert despachante.instantanea.usada
+                assert despachante.generar_script(politicas) == script
+                # si se descarta la instantanea se consulta la base de datos
+                despachante.descartar_instantanea()
+                despachante.obtener_politicas()
+                assert not despachante.instantanea.usada
+                # si cambia la version se consulta la base de datos
+                consultar.return_value = 2
+                despachante.obtener_politicas()
+                assert not despachante.instantanea.usada
+                assert despachante.instantanea.leer()['tablas'] == 2
+                # si la base de datos no responde se usa la instantanea
+                consultar.side_effect = peewee.OperationalError()
+                politicas = despachante.obtener_politicas()
+                assert despachante.instantanea.usada
+                assert despachante.generar_script(politicas) == script
+                # el despacho no se interrumpe al leer la version
+                assert models.VersionTabla.actual() is None
+                for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'VERSION_FILE',
+                               'BUENO_FILE', 'CERROJO_FILE'):
+                    setattr(despachante, nombre,
+                            os.path.join(directorio, nombre))
+                despachante.ejecutor = aplicacion.Grabador()
+                assert despachante.despachar() is True
+                assert despachante.instantanea.usada
+                assert despachante.leer_version() is None
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_version_tabla(self):
+        '''
+        Prueba que la version de las politicas sea None si no se instalaron
+        las versiones o si la base de datos no responde, deshaciendo la
+        transaccion de la consulta fallida.
+        '''
+        db = mock.MagicMock(spec=peewee.PostgresqlDatabase)
+        with mock.patch.object(models, 'db', db), \
+                mock.patch.object(models.VersionTabla, 'select') as select:
+            select.return_value.scalar.return_value = 12
+            assert models.VersionTabla.actual() == 12
+            # la tabla de versiones no existe
+            select.return_value.scalar.side_effect = \
+                peewee.ProgrammingError()
+            assert models.VersionTabla.consultar() is None
+            assert models.VersionTabla.actual() is None
+            salida = db.atomic.return_value.__exit__
+            assert salida.call_args[0][0] is peewee.ProgrammingError
+            # la base de datos no responde
+            for error in (peewee.OperationalError, peewee.InterfaceError):
+                select.return_value.scalar.side_effect = error()
+                self.assertRaises(error, models.VersionTabla.consultar)
+                assert models.VersionTabla.actual() is None
+
+    @mock.patch('subprocess.Popen')
+    def test_despachar_sin_cambio_de_version(self, mock_popen):
+        '''
+        Prueba que el despacho no forzado termine sin cargar las politicas si
+        la version de las tablas no cambio desde el ultimo despacho y no llego
+        el proximo cambio por rangos horarios.
+        '''
+        mock_popen.return_value.wait.return_value = 0
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante()
+        despachante.SCRIPT_FILE = os.path.join(directorio, 'script')
+        despachante.HUELLA_FILE = os.path.join(directorio, 'huella')
+        despachante.VERSION_FILE = os.path.join(directorio, 'version')
+        with models.db.atomic() as transaction, \
+                mock.patch.object(models.VersionTabla, 'actual',
+                                  return_value=7) as actual:
+            politica = models.Politica.create(nombre='politica1',
+                                              velocidad_bajada=512)
+            models.RangoHorario.create(politica=politica,
+                                       dia=datetime.now().weekday(),
+                                       hora_inicial=time(0),
+                                       hora_fin=time(23, 59, 59))
+            assert despachante.despachar(forzar=False) is True
+            assert despachante.leer_version() == 7
+            # el proximo cambio es el fin del rango horario de hoy
+            assert despachante.leer_proximo() == datetime.combine(
+                datetime.now().date(), time(23, 59, 59)
+            )
+            with mock.patch.object(despachante,
+                                   'obtener_politicas') as obtener:
+                assert despachante.despachar(forzar=False) is False
+                assert not obtener.called
+            # la vigencia se consulta sin cargar el despachante
+            contexto = despachante.huella_opciones()
+            with mock.patch.object(vigencia, 'version_actual',
+                                   return_value=7):
+                assert vigencia.vigente(despachante.VERSION_FILE, contexto)
+                assert not vigencia.vigente(despachante.VERSION_FILE)
+            # si cambian las opciones o la configuracion se vuelve a
+            # despachar
+            despachante.ipset = not despachante.ipset
+            assert not despachante.sin_cambios(7)
+            despachante.ipset = not despachante.ipset
+            with mock.patch.dict(config.NETCOP, {'outside': 'eth9'}):
+                assert not despachante.sin_cambios(7)
+                assert vigencia.contexto({}) != contexto
+            assert vigencia.contexto({}) == contexto
+            assert despachante.sin_cambios(7)
+            # al llegar el proximo cambio se cargan las politicas
+            despachante.guardar_version(7, datetime.now() -
+                                        timedelta(seconds=1))
+            assert not despachante.sin_cambios(7)
+            assert not vigencia.vigente(despachante.VERSION_FILE, contexto)
+            # un despacho fallido elimina la version
+            actual.return_value = 8
+            with mock.patch.object(despachante, 'aplicar',
+                                   side_effect=OSError()):
+                self.assertRaises(OSError, despachante.despachar)
+            assert despachante.leer_version() is None
             transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_temporizado_vigente(self):
+        '''
+        Prueba que el despacho temporizado termine sin importar peewee ni el
+        despachante si el ultimo despacho sigue vigente, y que no siga vigente
+        si las opciones son otras.
+        '''
+        directorio = tempfile.mkdtemp()
+        archivo = os.path.join(directorio, 'version')
+        vigencia.guardar(archivo, 7, datetime.now() + timedelta(hours=1),
+                         vigencia.contexto({}))
+        raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        entorno = dict(os.environ)
+        entorno['PYTHONPATH'] = os.pathsep.join(
+            [raiz] + [x for x in [entorno.get('PYTHONPATH')] if x]
+        )
+        # con ipset habilitado en la configuracion la opcion no cambia nada
+        ipset = '0' if config.habilitada('DESPACHANTE', 'ipset') else '2'
+        for argumentos, codigo_salida in ((['-t', '-d'], '0'),
+                                          (['-t', '-d', '-s'], ipset)):
+            # si no esta vigente se termina antes de despachar
+            codigo = '\n'.join([
+                'import sys, runpy',
+                'from netcop.despachante import vigencia',
+                'vigente = vigencia.vigente',
+                'def vigencia_prueba(archivo=None, contexto=None):',
+                '    if not vigente(%r, contexto):' % archivo,
+                '        sys.exit(2)',
+                '    return True',
+                'vigencia.vigente = vigencia_prueba',
+                'vigencia.version_actual = lambda: 7',
+                'sys.argv = ["despachar"] + %r' % argumentos,
+                'try:',
+                '    runpy.run_path(%r, run_name="__main__")' %
+                os.path.join(raiz, 'scripts', 'despachar'),
+                'except SystemExit as e:',
+                '    print(e.code)',
+                'print("peewee" in sys.modules)',
+                'print("netcop.despachante.despachante" in sys.modules)',
+            ])
+            proceso = subprocess.Popen([sys.executable, '-c', codigo],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, env=entorno)
+            salida, error = proceso.communicate()
+            assert salida.decode('utf-8').split() == [codigo_salida, 'False',
+                                                      'False'], error
+        shutil.rmtree(directorio)
+
+    def test_aplicar_restaura_despacho_correcto(self):
+        '''
+        Prueba que si falla un comando del script se detenga el despacho, se
+        restauren las reglas del ultimo despacho correcto y se descarte la
+        huella, para volver a aplicarlo en el proximo despacho. El error al
+        eliminar la disciplina raiz de una interfaz se ignora.
+        '''
+        directorio = tempfile.mkdtemp()
+        registro = os.path.join(directorio, 'registro')
+        # iptables y tc falsos que registran sus argumentos, sin disciplinas
+        # raiz previas y que rechazan la velocidad de 1024kbit
+        for programa in ('iptables', 'tc'):
+            archivo = os.path.join(directorio, programa)
+            with open(archivo, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        'echo "%s $*" >> %s\n'
+                        'case "$*" in\n'
+                        '*"qdisc del"*) echo "No such file" >&2; exit 2;;\n'
+                        '*"ceil 1024kbit"*) echo "Invalid" >&2; exit 2;;\n'
+                        'esac\n' % (programa, registro))
+            os.chmod(archivo, 0o755)
+        cabecera = ['#!/bin/sh', 'set -e',
+                    'IPTABLES="%s/iptables"' % directorio,
+                    'TC="%s/tc"' % directorio]
+        with models.db.atomic() as transaction, \
+                mock.patch.object(comandos, 'CABECERA', cabecera):
+            politica = models.Politica.create(nombre='politica1',
+                                              velocidad_bajada=512)
+            despachante = Despachante(iptables_restore=False, tc_batch=False,
+                                      directo=False)
+            for nombre in ('SCRIPT_FILE', 'HUELLA_FILE', 'BUENO_FILE',
+                           'CERROJO_FILE'):
+                setattr(despachante, nombre, os.path.join(directorio, nombre))
+            assert despachante.despachar() is True
+            with open(registro) as f:
+                correcto = f.read().splitlines()
+            assert [x for x in correcto if 'qdisc del' in x]
+            assert [p.comando for p in despachante.leer_bueno()] == [
+                ['/bin/sh', despachante.SCRIPT_FILE + '.bueno']
+            ]
+            # falla un unico comando del script del siguiente despacho
+            os.remove(registro)
+            politica.velocidad_bajada = 1024
+            politica.save()
+            with self.assertRaises(aplicacion.ErrorAplicacion) as error:
+                despachante.despachar()
+            assert error.exception.restaurado
+            fallo, = error.exception.fallos
+            assert fallo.comando == ['/bin/sh', despachante.SCRIPT_FILE]
+            assert fallo.codigo == 2
+            assert 'Invalid' in str(error.exception)
+            with open(registro) as f:
+                ejecutados = f.read().splitlines()
+            # el script se detiene en el comando que falla y luego se vuelve
+            # a aplicar el despacho correcto completo
+            fallido = [i for i, x in enumerate(ejecutados)
+                       if 'ceil 1024kbit' in x]
+            assert len(fallido) == 1
+            assert ejecutados[fallido[0] + 1:] == correcto
+            assert despachante.leer_huella() is None
+            assert despachante.metricas.contadores['fallos'] == 1
+            transaction.rollback()
+        # los comandos que superan el tiempo maximo se terminan
+        ejecutor = aplicacion.Ejecutor(tiempo_maximo=0.2)
+        assert ejecutor.ejecutar(['sh', '-c', 'sleep 5']) == (None, '')
+        assert ejecutor.ejecutar(['sh', '-c', 'cat >&2; exit 3'],
+                                 ['linea']) == (3, 'linea\n')
+        assert ejecutor.ejecutar([os.path.join(directorio, 'no-existe')])[0] \
+            == 127
+
+        # si fallan las lineas el comando se termina sin recibir el fin de su
+        # entrada, de manera que no aplica las lineas incompletas
+        def lineas():
+            yield 'linea'
+            raise ValueError('lineas rotas')
+
+        marca = os.path.join(directorio, 'marca')
+        codigo, texto = ejecutor.ejecutar(
+            ['sh', '-c', 'cat >/dev/null; touch %s' % marca], lineas()
+        )
+        assert codigo == 1
+        assert 'lineas rotas' in texto
+        assert not os.path.exists(marca)
+        shutil.rmtree(directorio)
+
+    def test_filtro_unico(self):
+        '''
+        Prueba que los paquetes se asignen a las clases con un unico filtro fw
+        por interfaz, marcandolos con el classid de la clase de la politica.
+        '''
+        # los numeros de clase del tc son hexadecimales
+        assert reglas.marca_clase(2) == 0x10002
+        assert reglas.marca_clase(10) == 0x10010
+        assert reglas.marca_clase(9997) == 0x19997
+        politicas = list()
+        for numero in range(1, 13):
+            objetivo = Mock()
+            objetivo.obtener_parametros = lambda x: x.parametros.update({
+                Param.TCP_DESTINO: [80],
+            })
+            politica = models.Politica(id_politica=100 + numero,
+                                       velocidad_bajada=512,
+                                       velocidad_subida=256)
+            politica.objetivos = [objetivo]
+            politicas.append(politica)
+        script = Despachante().generar_script(politicas)
+        filtros = [x for x in script if x.startswith('$TC filter')]
+        assert filtros == [
+            '$TC filter add dev %s parent 1: prio 1 protocol ip fw' %
+            interfaz for interfaz in (config.NETCOP['outside'],
+                                      config.NETCOP['inside'])
+        ]
+        assert '$TC class add dev %s parent 1:9999 classid 1:12 htb rate ' \
+            '1kbit ceil 512kbit prio 3' % config.NETCOP['inside'] in script
+        assert any(x.endswith('-j MARK --set-mark %d' % 0x10012)
+                   for x in script)
+
+    def test_velocidades_clases(self):
+        '''
+        Prueba las velocidades de las clases del tc: en kbit enteros, la
+        velocidad garantizada de la interfaz inside a partir de la velocidad
+        de bajada y la velocidad maxima de la clase por defecto a partir de la
+        velocidad de cada interfaz.
+        '''
+        constructor = reglas.Constructor('eth0', 'eth1', bw_bajada=30,
+                                         bw_subida=10, cant_alta_prioridad=3)
+        alta = models.Politica(id_politica=1,
+                               prioridad=models.Politica.PRIO_ALTA)
+        baja = models.Politica(id_politica=2,
+                               prioridad=models.Politica.PRIO_BAJA)
+        clases = list()
+        for numero, politica in enumerate((alta, baja), 1):
+            politica.objetivos = []
+            clases.extend(comandos.tc(x) for x in
+                          constructor.priorizacion(politica, numero)
+                          if isinstance(x, reglas.Clase))
+        clases.extend(comandos.tc(x) for x, borrar in constructor.inicio()
+                      if isinstance(x, reglas.Clase))
+        # la velocidad de cada interfaz se reparte entre las politicas de
+        # prioridad alta, 10 * 1000 / 3 en outside y 30 * 1000 / 3 en inside
+        assert ('class add dev eth0 parent 1:9999 classid 1:1 htb rate '
+                '3333kbit ceil 10mbit prio 1') in clases
+        assert ('class add dev eth1 parent 1:9999 classid 1:1 htb rate '
+                '10000kbit ceil 30mbit prio 1') in clases
+        # el resto tiene garantizado 1kbit, no 0mbit
+        assert ('class add dev eth1 parent 1:9999 classid 1:2 htb rate '
+                '1kbit ceil 30mbit prio 7') in clases
+        assert not [x for x in clases if '.' in x or ' 0mbit' in x]
+        # la clase por defecto de cada interfaz llega a su propia velocidad
+        assert ('class add dev eth0 parent 1:9999 classid 1:9998 htb rate '
+                '1kbit ceil 10mbit prio 3') in clases
+        assert ('class add dev eth1 parent 1:9999 classid 1:9998 htb rate '
+                '1kbit ceil 30mbit prio 3') in clases
+
+        def kbit(texto):
+            # en el tc un mbit son 1000 kbit
+            if texto.endswith('mbit'):
+                return int(texto[:-4]) * 1000
+            return int(texto[:-4])
+
+        # la velocidad garantizada nunca supera la maxima de la clase ni la
+        # de la interfaz, aunque haya una unica politica de prioridad alta
+        constructor.cant_alta_prioridad = 1
+        clases.extend(comandos.tc(x) for x in
+                      constructor.priorizacion(alta, 1)
+                      if isinstance(x, reglas.Clase))
+        for clase in clases:
+            argumentos = clase.split()
+            if 'ceil' in argumentos:
+                assert kbit(argumentos[argumentos.index('rate') + 1]) <= \
+                    kbit(argumentos[argumentos.index('ceil') + 1]), clase
+        assert ('class add dev eth1 parent 1:9999 classid 1:1 htb rate '
+                '30000kbit ceil 30mbit prio 1') in clases
+
+    def test_separacion_flags(self):
+        '''
+        Prueba que los argumentos de las reglas esten separados por un unico
+        espacio.
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_DESTINO: ['10.0.0.0/24'],
+            Param.TCP_DESTINO: [80],
+        })
+        politica = models.Politica(id_politica=1, velocidad_bajada=512)
+        politica.objetivos = [objetivo]
+        script = Despachante().generar_script([politica])
+        reglas_script = [x for x in script if x.startswith('$IPTABLES -A')]
+        assert ('$IPTABLES -A FORWARD -t mangle -p tcp --destination '
+                '10.0.0.0/24 --destination-port 80 -j RETURN') in reglas_script
+        assert not [x for x in script if '  ' in x or x != x.strip()]
+
+    def test_connmark(self):
+        '''
+        Prueba que con connmark solo se clasifique el primer paquete de cada
+        conexion, guardando su marca para los paquetes siguientes.
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.TCP_DESTINO: [80],
+        })
+        politica = models.Politica(id_politica=101, velocidad_subida=512)
+        politica.objetivos = [objetivo]
+        script = Despachante().generar_script([politica])
+        assert not [x for x in script if 'CONNMARK' in x]
+        script = Despachante(connmark=True).generar_script([politica])
+        mangle = [x for x in script
+                  if x.startswith('$IPTABLES -A FORWARD -t mangle')]
+        # las reglas iniciales restauran la marca y terminan el recorrido de
+        # los paquetes de conexiones ya clasificadas
+        assert mangle[:2] == [
+            '$IPTABLES -A FORWARD -t mangle -j CONNMARK --restore-mark',
+            '$IPTABLES -A FORWARD -t mangle -m mark --mark 0x10000/0x10000 '
+            '-j RETURN',
+        ]
+        marcas = [i for i, x in enumerate(mangle) if '-j MARK' in x]
+        assert marcas
+        for i in marcas[:-1]:
+            assert mangle[i + 1].endswith('-j CONNMARK --save-mark')
+            assert mangle[i + 2].endswith('-j RETURN')
+        # las conexiones que no captura ninguna politica guardan la marca sin
+        # clase, que tambien termina el recorrido pero no es una clase del tc
+        assert mangle[-2:] == [
+            '$IPTABLES -A FORWARD -t mangle -j MARK --set-mark %d' %
+            reglas.MARCA_SIN_CLASE,
+            '$IPTABLES -A FORWARD -t mangle -j CONNMARK --save-mark',
+        ]
+        assert reglas.MARCA_SIN_CLASE & reglas.MARCA_CLASE
+        assert reglas.MARCA_SIN_CLASE not in [
+            reglas.marca_clase(numero)
+            for numero in range(1, Despachante.MAX_NUMERO_POLITICA + 1)
+        ]
+        # en nftables las marcas se guardan en la conexion con ct mark
+        script = Despachante(connmark=True,
+                             nftables=True).generar_script([politica])
+        assert 'meta mark set ct mark' in script
+        assert 'meta mark & 0x10000 == 0x10000 return' in script
+        assert 'tcp dport 80 ct mark set meta mark' in script
+        assert 'meta mark set %d' % reglas.MARCA_SIN_CLASE in script
+
+    def test_connmark_numeros_estables(self):
+        '''
+        Prueba que con connmark cada politica conserve el numero de sus clases
+        entre despachos completos, aunque se quiten politicas anteriores.
+        '''
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante(connmark=True, incremental=False)
+        for nombre in ('NUMEROS_FILE', 'BUENO_FILE'):
+            setattr(despachante, nombre, os.path.join(directorio, nombre))
+        politicas = list()
+        for numero in (101, 102, 103):
+            politica = models.Politica(id_politica=numero,
+                                       velocidad_subida=512)
+            politica.objetivos = []
+            politicas.append(politica)
+        despachante.preparar(politicas)
+        assert despachante.numeros == {101: 1, 102: 2, 103: 3}
+        despachante.aplicar([])
+        # al quitar la primera politica las demas mantienen su numero
+        lineas, batch, estado = despachante.compilar(politicas[1:])
+        assert despachante.numeros == {102: 2, 103: 3}
+        clases = [x.split()[8] for x in lineas
+                  if x.startswith('$TC class add dev eth0 parent 1:9999 ')]
+        assert clases == ['1:9998', '1:2', '1:3']
+        # sin connmark se numeran por su posicion
+        assert Despachante(connmark=False,
+                           incremental=False).numerar(politicas) is None
+        shutil.rmtree(directorio)
+
+    def test_obtener_politicas_consultas_fijas(self):
+        '''
+        Prueba que la cantidad de consultas para obtener las politicas y sus
+        flags no dependa de la cantidad de politicas ni de clases.
+        '''
+        def crear_politica(numero):
+            politica = models.Politica.create(nombre='politica%d' % numero,
+                                              velocidad_bajada=512)
+            clase = models.ClaseTrafico.create(nombre='clase%d' % numero)
+            cidr = models.CIDR.create(direccion='10.0.%d.0' % numero,
+                                      prefijo=24)
+            puerto = models.Puerto.create(numero=1000 + numero, protocolo=6)
+            models.ClaseCIDR.create(clase=clase, cidr=cidr,
+                                    grupo=models.OUTSIDE)
+            models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                      grupo=models.OUTSIDE)
+            models.Objetivo.create(politica=politica, clase=clase,
+                                   tipo=models.Objetivo.DESTINO)
+            models.Objetivo.create(politica=politica,
+                                   direccion_fisica='00:00:00:00:00:%02d' %
+                                   numero,
+                                   tipo=models.Objetivo.ORIGEN)
+            models.RangoHorario.create(politica=politica,
+                                       dia=datetime.now().weekday(),
+                                       hora_inicial='00:00:00',
+                                       hora_fin='23:59:59')
+
+        def contar_consultas():
+            with mock.patch.object(models.db, 'execute_sql',
+                                   wraps=models.db.execute_sql) as mock_sql:
+                politicas = Despachante().obtener_politicas()
+                flags = [p.flags() for p in politicas]
+            return mock_sql.call_count, politicas, flags
+
+        with models.db.atomic() as transaction:
+            crear_politica(1)
+            consultas, politicas, flags = contar_consultas()
+            assert len(politicas) == 1
+            assert flags[0]
+            for numero in range(2, 6):
+                crear_politica(numero)
+            assert contar_consultas()[0] == consultas
+            transaction.rollback()
+
+    def test_script_ipset(self):
+        '''
+        Prueba que en modo ipset las redes de cada clase y las mac-address de
+        cada politica se carguen en conjuntos y se genere una cantidad fija de
+        reglas por politica.
+        '''
+        with models.db.atomic() as transaction:
+            politica = models.Politica.create(id_politica=81, nombre='foo')
+            for numero in (1, 2):
+                clase = models.ClaseTrafico.create(
+                    id_clase=80808080 + numero,
+                    nombre='clase%d' % numero,
+                )
+                for red in range(20):
+                    cidr = models.CIDR.create(
+                        direccion='10.%d.%d.0' % (numero, red),
+                        prefijo=24,
+                    )
+                    models.ClaseCIDR.create(clase=clase, cidr=cidr,
+                                            grupo=models.OUTSIDE)
+                models.Objetivo.create(politica=politica, clase=clase,
+                                       tipo=models.Objetivo.DESTINO)
+            for mac in range(10):
+                models.Objetivo.create(politica=politica,
+                                       direccion_fisica='00:00:00:00:00:%02d' %
+                                       mac,
+                                       tipo=models.Objetivo.ORIGEN)
+            despachante = Despachante(ipset=True)
+            script = despachante.generar_script(
+                despachante.obtener_politicas()
+            )
+            # verifico que se carguen los conjuntos antes de las reglas
+            inicio = script.index("$IPSET restore <<'EOF'")
+            assert inicio < min(i for i, x in enumerate(script)
+                                if x.startswith('$IPTABLES'))
+            ipset = script[inicio:script.index('EOF', inicio)]
+            assert 'create netcop-c80808081 hash:net -exist' in ipset
+            assert 'add netcop-c80808082-t 10.2.19.0/24 -exist' in ipset
+            assert 'create netcop-p81-d-lista list:set -exist' in ipset
+            assert ('add netcop-p81-d-lista-t netcop-c80808081 -exist'
+                    in ipset)
+            assert 'create netcop-p81-mac hash:mac -exist' in ipset
+            assert ipset.index('swap netcop-c80808082-t netcop-c80808082') < \
+                ipset.index('create netcop-p81-d-lista-t list:set -exist')
+            # los elementos se cargan en un conjunto temporal que se
+            # intercambia por el que utilizan las reglas
+            temporal = ipset.index('create netcop-p81-mac-t hash:mac -exist')
+            assert ipset[temporal + 1] == 'flush netcop-p81-mac-t'
+            swap = ipset.index('swap netcop-p81-mac-t netcop-p81-mac')
+            assert ipset[swap - 1] == 'create netcop-p81-mac hash:mac -exist'
+            assert ipset[swap + 1] == 'destroy netcop-p81-mac-t'
+            assert not [x for x in ipset if x.startswith('flush') and
+                        not x.endswith('-t')]
+            # los conjuntos que ya no se utilizan se eliminan al final
+            assert script[-1] == comandos.limpieza_ipset()
+            assert "grep '^netcop-'" in script[-1]
+            # una unica regla sin importar la cantidad de redes y macs
+            reglas = [x for x in script if x.startswith('$IPTABLES -A') and
+                      'REJECT' in x]
+            assert len(reglas) == 1
+            assert ('-m set --match-set netcop-p81-mac src' in reglas[0])
+            assert ('-m set --match-set netcop-p81-d-lista dst' in reglas[0])
+            assert '10.1.0.0/24' not in reglas[0]
+            # en el modo directo la limpieza es el ultimo paso y es tolerante
+            configuracion = despachante.configuracion(
+                despachante.obtener_politicas()
+            )
+            pasos = despachante.partes(configuracion.operaciones(),
+                                       configuracion.conjuntos())
+            assert [p.nombre for p in pasos[-3:]] == \
+                ['ipset', 'iptables-restore', 'limpieza ipset']
+            assert pasos[-1].tolerante
+            assert pasos[-1].comando[-1] == \
+                comandos.limpieza_ipset(despachante.IPSET)
+            transaction.rollback()
+
+    def test_listas_multiport(self):
+        '''
+        Prueba agrupar puertos consecutivos en rangos y en listas de hasta 15
+        lugares.
+        '''
+        assert models.rangos_puertos([22, 80, 81, 82, 443, 21]) == \
+            [(21, 22), (80, 82), (443, 443)]
+        assert models.listas_multiport([22, 80, 81, 82, 443, 21]) == \
+            ['21:22,80:82,443']
+        listas = models.listas_multiport(range(1, 60, 2))
+        assert len(listas) == 2
+        assert len(listas[0].split(',')) == models.MULTIPORT_MAX
+
+    def test_flags_multiport(self):
+        '''
+        Prueba que con multiport se generen menos reglas que con un puerto por
+        regla y que la cantidad informada coincida con la generada.
+        '''
+        objetivo_puerto = Mock()
+        objetivo_puerto.obtener_parametros = lambda x: x.parametros.update({
+            Param.TCP_ORIGEN: set(range(1000, 1050)),
+            Param.TCP_DESTINO: set(range(2000, 2100, 2)),
+            Param.UDP_DESTINO: set([53]),
+        })
+        politica = models.Politica(id_politica=91, velocidad_bajada=1024)
+        politica.objetivos = [objetivo_puerto]
+        antes = len(politica.flags())
+        assert antes == politica.cantidad_reglas(multiport=False)
+        politica.usar_multiport = True
+        flags = politica.flags()
+        assert len(flags) == politica.cantidad_reglas()
+        assert len(flags) < antes
+        # 1 rango origen x 4 listas destino, tcp y udp, subida y bajada
+        assert len(flags) == (1 * 4 + 1) * 2
+        subida = [x for x in flags if '--source-port 1000:1049' in x]
+        assert len(subida) == 4
+        assert Flag.PUERTOS_DESTINO + ' 2000,2002' in subida[0]
+        assert [x for x in flags if '--destination-port 1000:1049' in x]
+        assert [x for x in flags if '--source-port 53' in x]
+
+    def test_agrupar_redes(self):
+        '''
+        Prueba descartar las redes repetidas o contenidas en otras y unir las
+        redes hermanas.
+        '''
+        assert models.agrupar_redes([
+            '10.0.1.0/24', '10.0.0.0/16', '192.168.0.0/25',
+            '192.168.0.128/25', '192.168.1.0/24', '172.16.0.5/32',
+            '172.16.0.5', '172.16.0.4/32', '10.1.0.7/16',
+        ]) == ['10.0.0.0/15', '172.16.0.4/31', '192.168.0.0/23']
+        assert models.agrupar_redes(['0.0.0.0/0', '10.0.0.0/8']) == \
+            ['0.0.0.0/0']
+        assert models.agrupar_redes(['10.0.0.0/8', 'fe80::/10']) == \
+            ['10.0.0.0/8', 'fe80::/10']
+
+    def test_flags_agregacion(self):
+        '''
+        Prueba que al agrupar las redes de la politica se capturen con menos
+        prefijos y que se informe la cantidad eliminada.
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_ORIGEN: set(['10.0.0.0/25', '10.0.0.128/25',
+                                  '10.0.0.3/32']),
+            Param.IP_DESTINO: set(['8.8.8.8/32']),
+        })
+        politica = models.Politica(id_politica=92)
+        politica.objetivos = [objetivo]
+        despachante = Despachante(agregacion=True)
+        despachante.contexto([politica])
+        assert despachante.agrupacion == (4, 2)
+        assert politica.flags() == [
+            '--source 10.0.0.0/24 --destination 8.8.8.8/32'
+        ]
+
+    def test_flujo_flags(self):
+        '''
+        Prueba que los flags de las reglas se generen como un flujo de
+        registros compactos, que se puede recorrer mas de una vez.
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.MAC: set(['00:00:00:00:00:%02x' % i for i in range(20)]),
+            Param.TCP_DESTINO: set(range(1000, 1050)),
+            Param.IP_ORIGEN: set(['10.0.0.0/8']),
+        })
+        politica = models.Politica(id_politica=93, velocidad_bajada=1024)
+        politica.objetivos = [objetivo]
+        flujo = politica.iter_flags()
+        assert isinstance(flujo, models.Flujo)
+        assert len(flujo) == politica.cantidad_reglas() == 20 * 50 * 2
+        assert len(flujo) == 20 * 50 * 2
+        subida, bajada = flujo[0], flujo[20 * 50]
+        assert isinstance(subida, models.FlagsRegla)
+        assert subida[Flag.IP_ORIGEN] == '10.0.0.0/8'
+        assert Flag.IP_DESTINO not in subida
+        assert bajada[Flag.IP_DESTINO] == '10.0.0.0/8'
+        assert bajada.get(Flag.PUERTO_ORIGEN) == \
+            subida.get(Flag.PUERTO_DESTINO)
+        comunes = politica.flags_comunes(flujo)
+        assert comunes.pares() == (
+            (Flag.PROTOCOLO, 'tcp'),
+        )
+
+    @mock.patch('subprocess.Popen')
+    def test_despachar_incremental(self, mock_popen):
+        '''
+        Prueba que el despacho incremental aplique solo las diferencias con el
+        despacho anterior.
+        '''
+        mock_popen.return_value.wait.return_value = 0
+        directorio = tempfile.mkdtemp()
+        despachante = Despachante(incremental=True)
+        for nombre in ('SCRIPT_FILE', 'ESTADO_FILE', 'HUELLA_FILE',
+                       'BUENO_FILE'):
+            setattr(despachante, nombre, os.path.join(directorio, nombre))
+
+        def despachar():
+            mock_popen.reset_mock()
+            despachante.despachar()
+            if not mock_popen.called:
+                return None
+            with open(despachante.SCRIPT_FILE) as f:
+                return f.read()
+
+        with models.db.atomic() as transaction:
+            clase = models.ClaseTrafico.create(nombre='web')
+            puerto = models.Puerto.create(numero=80, protocolo=6)
+            models.ClasePuerto.create(clase=clase, puerto=puerto,
+                                      grupo=models.OUTSIDE)
+            politicas = [
+                models.Politica.create(nombre='restriccion'),
+                models.Politica.create(nombre='limitacion',
+                                       velocidad_bajada=512),
+                models.Politica.create(nombre='priorizacion', prioridad=7),
+            ]
+            for politica in politicas:
+                models.Objetivo.create(politica=politica, clase=clase,
+                                       tipo=models.Objetivo.DESTINO)
+            # primer despacho completo
+            script = despachar()
+            assert '$IPTABLES -F' in script
+            # sin cambios no se aplica nada
+            assert despachar() is None
+            # modifico una politica
+            politicas[1].velocidad_bajada = 1024
+            politicas[1].save()
+            script = despachar()
+            assert '$IPTABLES -F' not in script
+            assert 'qdisc' not in script
+            assert '$TC class del dev %s parent 1:9999 classid 1:2\n' % \
+                config.NETCOP['inside'] in script
+            assert 'ceil 1024kbit' in script
+            # el ultimo despacho correcto es la configuracion completa
+            bueno = despachante.leer_bueno()
+            assert bueno[-1].comando == [Despachante.IPTABLES_RESTORE]
+            lineas = [linea for paso in bueno if paso.lineas is not None
+                      for linea in paso.lineas]
+            assert '*filter' in lineas
+            assert [x for x in lineas if 'ceil 1024kbit' in x]
+            assert [x for x in lineas if x.endswith('-j REJECT')]
+            # las reglas se eliminan e insertan en la posicion que ocupan en
+            # la configuracion completa, antes de las de priorizacion, y la
+            # marca de cada politica es el classid de su clase
+            assert ['$IPTABLES -D FORWARD %d -t mangle' % i
+                    for i in (4, 3, 2, 1)] == \
+                [x for x in script.splitlines() if ' -D FORWARD' in x]
+            assert ('-I FORWARD 1 -t mangle -p tcp --destination-port 80 -j '
+                    'MARK --set-mark %d' % reglas.marca_clase(2)) in script
+            assert '-I FORWARD 4 -t mangle -p tcp --source-port 80 -j ' \
+                'RETURN' in script
+            assert '-A FORWARD' not in script
+            for numero in (1, 3):
+                assert '--set-mark %d\n' % reglas.marca_clase(numero) \
+                    not in script
+            assert 'REJECT' not in script
+            # la politica de priorizacion tiene reglas RETURN iguales a las de
+            # limitacion, se eliminan las suyas por su posicion
+            politicas[2].prioridad = 6
+            politicas[2].save()
+            script = despachar()
+            assert ['$IPTABLES -D FORWARD %d -t mangle' % i
+                    for i in (8, 7, 6, 5)] == \
+                [x for x in script.splitlines() if ' -D FORWARD' in x]
+            assert '-I FORWARD 8 -t mangle -p tcp --source-port 80 -j ' \
+                'RETURN' in script
+            # quito una politica y agrego otra, que ocupa su numero
+            politicas[0].delete_instance(recursive=True)
+            models.Politica.create(nombre='nueva', prioridad=1)
+            script = despachar()
+            # la regla de la politica quitada sigue a la de la interfaz lo
+            assert ['$IPTABLES -D FORWARD 2'] == \
+                [x for x in script.splitlines() if ' -D FORWARD' in x]
+            assert 'classid 1:1 htb' in script
+            for numero in (1, 2):
+                assert '--set-mark %d\n' % reglas.marca_clase(numero) \
+                    not in script
+            # si cambia el orden de las politicas sin cambios se aplica la
+            # configuracion completa
+            cargar = despachante.cargar_politicas
+            with mock.patch.object(despachante, 'cargar_politicas',
+                                   lambda guardar=True:
+                                   cargar(guardar)[::-1]):
+                assert '$IPTABLES -F' in despachar()
+            # con cadenas se reemplaza el contenido de la cadena sin mover el
+            # salto de la politica
+            despachante.cadenas = True
+            assert '$IPTABLES -F' in despachar()
+            politicas[1].velocidad_bajada = 2048
+            politicas[1].save()
+            script = despachar()
+            cadena = 'netcop-%d' % politicas[1].id_politica
+            assert '-A %s -t mangle' % cadena in script
+            assert '-D %s -t mangle' % cadena in script
+            assert '-j %s' % cadena not in script
+            assert '-N %s' % cadena not in script
+            transaction.rollback()
+        shutil.rmtree(directorio)
+
+    def test_script_cadenas(self):
+        '''
+        Prueba que con cadenas por politica las reglas de cada politica esten
+        en su propia cadena, con un unico salto desde FORWARD.
+        '''
+        objetivo_ip = Mock()
+        objetivo_ip.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_DESTINO: ['172.16.0.0/24'],
+            Param.MAC: ['10:00:00:00:00:00', '20:00:00:00:00:00'],
+        })
+        objetivo_puerto = Mock()
+        objetivo_puerto.obtener_parametros = lambda x: x.parametros.update({
+            Param.TCP_DESTINO: [80, 443],
+        })
+        restriccion = models.Politica(id_politica=101)
+        restriccion.objetivos = [objetivo_ip, objetivo_puerto]
+        limitacion = models.Politica(id_politica=102, velocidad_subida=512)
+        limitacion.objetivos = [objetivo_puerto]
+        script = Despachante(cadenas=True).generar_script([restriccion,
+                                                           limitacion])
+        assert '$IPTABLES -N netcop-101' in script
+        assert '$IPTABLES -t mangle -N netcop-102' in script
+        assert not [x for x in script if x.startswith('$IPTABLES -A FORWARD')
+                    and ('REJECT' in x or 'MARK' in x)]
+        # un salto por politica, con los flags comunes a sus reglas
+        saltos = [x for x in script if x.startswith('$IPTABLES -A FORWARD')
+                  and '-j netcop-' in x]
+        assert saltos == [
+            '$IPTABLES -A FORWARD -p tcp --destination 172.16.0.0/24 '
+            '-j netcop-101',
+            '$IPTABLES -A FORWARD -t mangle -p tcp -j netcop-102',
+        ]
+        assert len([x for x in script if x.startswith(
+            '$IPTABLES -A netcop-101 ')]) == 4
+        assert ('$IPTABLES -A netcop-102 -t mangle -p tcp --destination-port '
+                '80 -j ACCEPT') in script
+        # en formato iptables-restore se declaran las cadenas
+        restore = Despachante(cadenas=True, iptables_restore=True) \
+            .generar_script([restriccion, limitacion])
+        assert ':netcop-101 - [0:0]' in restore
+        assert ':netcop-102 - [0:0]' in restore
+        assert '-X' not in restore
+
+    def test_script_horario_kernel(self):
+        '''
+        Prueba que los rangos horarios se evaluen en el kernel con el modulo
+        time de iptables, con el mismo numero de dia que datetime.weekday().
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_DESTINO: ['172.16.0.0/24'],
+        })
+        politica = models.Politica(id_politica=101)
+        politica.objetivos = [objetivo]
+        politica.horarios = [
+            models.RangoHorario(dia=0, hora_inicial=time(8),
+                                hora_fin=time(12)),
+            models.RangoHorario(dia=2, hora_inicial=time(8),
+                                hora_fin=time(12)),
+            models.RangoHorario(dia=6, hora_inicial=time(20, 30),
+                                hora_fin=time(23, 59, 59)),
+        ]
+        despachante = Despachante(horario_kernel=True)
+        script = despachante.generar_script([politica])
+        reglas = [x for x in script if '-m time' in x]
+        assert reglas == [
+            '$IPTABLES -A FORWARD --destination 172.16.0.0/24 -m time '
+            '--kerneltz --weekdays Mon,Wed --timestart 08:00:00 '
+            '--timestop 11:59:59 -j REJECT',
+            '$IPTABLES -A FORWARD --destination 172.16.0.0/24 -m time '
+            '--kerneltz --weekdays Sun --timestart 20:30:00 '
+            '--timestop 23:59:58 -j REJECT',
+        ]
+        assert politica.cantidad_reglas() == 2
+        # el numero de dia coincide con el que se evalua en python
+        lunes = datetime(2016, 8, 15, 9, 0)
+        assert lunes in politica.horarios[0]
+        assert models.RangoHorario.nombre_dia(lunes.weekday()) == 'Mon'
+        # sin rangos validos la politica no genera reglas
+        politica.horarios = [models.RangoHorario(dia=0, hora_inicial=time(12),
+                                                 hora_fin=time(8))]
+        assert politica.flags() == []
+        # las politicas se despachan sin importar el horario y no hay cambios
+        # programados
+        with models.db.atomic() as transaction:
+            politica = models.Politica.create(nombre='politica1')
+            models.RangoHorario.create(politica=politica, dia=0,
+                                       hora_inicial=time(8),
+                                       hora_fin=time(12))
+            fecha = datetime(2016, 8, 16, 9, 0)
+            assert despachante.obtener_politicas(fecha) == [politica]
+            assert despachante.proximo_cambio(fecha) is None
+            assert Despachante().proximo_cambio(fecha) is not None
+            transaction.rollback()
+
+    def test_inverso(self):
+        '''
+        Prueba obtener las operaciones que deshacen los objetos de una
+        politica y los comandos que las aplican.
+        '''
+        regla = reglas.Regla(reglas.FILTER, 'FORWARD', [('-p', 'tcp')],
+                             reglas.REJECT)
+        cadena = reglas.Cadena(reglas.MANGLE, 'netcop-1')
+        filtro = reglas.Filtro('eth0', '1:', 0, 5, '1:1')
+        operaciones = [(reglas.Comentario('restriccion 1'), False),
+                       (regla, False), (cadena, False), (filtro, False)]
+        assert comandos.sh(comandos.inverso(operaciones)) == [
+            '$TC filter del dev eth0 parent 1: prio 0 protocol ip handle 5 fw',
+            '$IPTABLES -t mangle -X netcop-1',
+            '$IPTABLES -D FORWARD -p tcp -j REJECT',
+        ]
+        assert reglas.es_estructura(cadena)
+        assert reglas.es_estructura(reglas.Regla(reglas.FILTER, 'FORWARD', [],
+                                                 'netcop-1'))
+        assert not reglas.es_estructura(regla)
+
+    def test_reglas_json(self):
+        '''
+        Prueba que los objetos de la representacion intermedia se reconstruyan
+        a partir de su serializacion en JSON y generen los mismos comandos.
+        '''
+        conjunto = models.Conjunto('c1', models.Conjunto.RED, ['10.0.0.0/8'])
+        objetos = [
+            reglas.Regla(reglas.MANGLE, 'FORWARD',
+                         [(Flag.PROTOCOLO, 'tcp'), (Flag.IP_ORIGEN, conjunto),
+                          (Flag.PUERTOS_DESTINO, '80,443')],
+                         reglas.MARK, 7),
+            reglas.Clase('eth1', '1:9999', '1:2', '1kbit', '512kbit', 3),
+            reglas.Qdisc('eth1', 'root', '1:', 'htb default 9998'),
+        ]
+        for objeto in objetos:
+            datos = json.loads(json.dumps(objeto.a_json()))
+            copia = reglas.desde_json(datos)
+            assert copia.a_json() == datos
+            for borrar in (False, True):
+                assert comandos.sh([(copia, borrar)]) == \
+                    comandos.sh([(objeto, borrar)])
+        assert comandos.sh([(objetos[0], False)]) == [
+            '$IPTABLES -A FORWARD -t mangle -p tcp -m set --match-set '
+            'netcop-c1 src -m multiport --destination-ports 80,443 -j MARK '
+            '--set-mark 7'
+        ]
+
+    def test_script_nftables(self):
+        '''
+        Prueba que en modo nftables las reglas se carguen en una tabla de
+        nftables y los comandos de tc se mantengan.
+        '''
+        objetivo = Mock()
+        objetivo.obtener_parametros = lambda x: x.parametros.update({
+            Param.IP_DESTINO: ['172.16.0.0/24', '172.16.1.0/24'],
+            Param.TCP_DESTINO: [80, 81, 443],
+        })
+        restriccion = models.Politica(id_politica=101)
+        restriccion.objetivos = [objetivo]
+        limitacion = models.Politica(id_politica=102, velocidad_subida=512)
+        limitacion.objetivos = [objetivo]
+        despachante = Despachante(nftables=True, multiport=True,
+                                  incremental=True)
+        assert not despachante.incremental
+        script = despachante.generar_script([restriccion, limitacion])
+        assert not [x for x in script if x.startswith('$IPTABLES')]
+        assert "$NFT -f - <<'EOF'" in script
+        assert 'chain forward {' in script
+        assert ('ip daddr { 172.16.0.0/24, 172.16.1.0/24 } tcp dport '
+                '{ 80-81, 443 } reject') in script
+        assert ('ip daddr { 172.16.0.0/24, 172.16.1.0/24 } tcp dport '
+                '{ 80-81, 443 } meta mark set 65538') in script
+        assert 'iifname "lo" accept' in script
+        assert [x for x in script if x.startswith('$TC class add')]
+
+    def test_proximo_cambio(self):
+        '''
+        Prueba obtener el momento en que cambia el conjunto de politicas
+        activas por sus rangos horarios.
+        '''
+        # miercoles 17 de agosto de 2016, 10:00
+        fecha = datetime(2016, 8, 17, 10, 0)
+        despachante = Despachante()
+        with models.db.atomic() as transaction:
+            assert despachante.proximo_cambio(fecha) is None
+            politica1 = models.Politica.create(nombre='politica1')
+            politica2 = models.Politica.create(nombre='politica2')
+            # rangos contiguos, la politica sigue activa a las 11:00
+            models.RangoHorario.create(politica=politica1,
+                                       dia=fecha.weekday(),
+                                       hora_inicial=time(8, 0),
+                                       hora_fin=time(11, 0))
+            models.RangoHorario.create(politica=politica1,
+                                       dia=fecha.weekday(),
+                                       hora_inicial=time(11, 0),
+                                       hora_fin=time(13, 0))
+            models.RangoHorario.create(politica=politica2,
+                                       dia=fecha.weekday(),
+                                       hora_inicial=time(12, 30),
+                                       hora_fin=time(18, 0))
+            assert (despachante.proximo_cambio(fecha) ==
+                    datetime(2016, 8, 17, 12, 30))
+            assert (despachante.proximo_cambio(datetime(2016, 8, 17, 12, 30))
+                    == datetime(2016, 8, 17, 13, 0))
+            # luego del ultimo rango de la semana vuelve al primero
+            assert (despachante.proximo_cambio(datetime(2016, 8, 17, 20, 0))
+                    == datetime(2016, 8, 24, 8, 0))
+            transaction.rollback()
+
+    def test_demonio(self):
+        '''
+        Prueba que el demonio duerma hasta el momento exacto del proximo
+        cambio de politicas.
+        '''
+        ahora = [datetime(2016, 8, 17, 10, 0)]
+        esperas = list()
+
+        def dormir(segundos):
+            esperas.append(segundos)
+            ahora[0] += timedelta(seconds=segundos)
+
+        despachante = Mock()
+        despachante.proximo_cambio.return_value = datetime(2016, 8, 17, 10,
+                                                           12, 30)
+        demonio = Demonio(despachante, reloj=lambda: ahora[0], dormir=dormir)
+        demonio.ciclo()
+        assert despachante.despachar.called
+        assert ahora[0] == datetime(2016, 8, 17, 10, 12, 30)
+        assert esperas == [300, 300, 150]
+        # el proximo cambio se calcula con las politicas ya cargadas
+        despachante.proximo_cambio.assert_called_with(
+            politicas=despachante.cargadas
+        )
+        # si no hubo cambios se usa el proximo cambio guardado, sin cargar
+        # las politicas
+        despachante.reset_mock()
+        despachante.cargadas = None
+        despachante.leer_proximo.return_value = datetime(2016, 8, 17, 11)
+        assert demonio.despachar() == datetime(2016, 8, 17, 11)
+        assert not despachante.proximo_cambio.called
+
+    def test_demonio_notificaciones(self):
+        '''
+        Prueba que el demonio despache al recibir notificaciones de cambios,
+        agrupando las notificaciones recibidas dentro de la ventana.
+        '''
+        ahora = [datetime(2016, 8, 17, 10, 0)]
+        # una rafaga de tres notificaciones seguida de silencio
+        notificaciones = [False, True, True, True, False]
+        esperas = list()
+
+        def esperar(segundos):
+            esperas.append(segundos)
+            ahora[0] += timedelta(seconds=segundos)
+            return notificaciones.pop(0)
+
+        escucha = Mock()
+        escucha.esperar.side_effect = esperar
+        demonio = Demonio(Mock(), escucha=escucha, ventana=2,
+                          reloj=lambda: ahora[0])
+        demonio.esperar(None)
+        assert esperas == [300, 300, 2, 2, 2]
+        assert notificaciones == []
+
+        # si las notificaciones no se detienen se despacha igualmente
+        escucha.esperar.side_effect = lambda s: esperar(s) or True
+        notificaciones[:] = [True] * 20
+        del esperas[:]
+        demonio.agrupar()
+        assert len(esperas) == Demonio.MAX_VENTANAS
+
+    @mock.patch('select.select')
+    def test_escucha(self, mock_select):
+        '''
+        Prueba que la escucha instale los disparadores en todas las tablas
+        versionadas y que vuelva a conectarse y a escuchar el canal si se
+        pierde la conexion.
+        '''
+        conexiones = [Mock(notifies=[]), Mock(notifies=[])]
+        primera, segunda = conexiones
+        escucha = notificaciones.Escucha(conectar=lambda: conexiones.pop(0))
+        escucha.instalar()
+        ejecutadas = [c[0][0] for c in
+                      primera.cursor.return_value.execute.call_args_list]
+        assert ejecutadas[0] == notificaciones.FUNCION
+        for tabla in models.VersionTabla.TABLAS:
+            assert notificaciones.DISPARADOR % tabla in ejecutadas
+        assert 'cidr' in notificaciones.TABLAS
+        escucha.escuchar()
+        # notificacion recibida
+        mock_select.return_value = ([primera], [], [])
+        primera.poll.side_effect = lambda: primera.notifies.append(
+            Mock(payload='politica')
+        )
+        assert escucha.esperar(5)
+        assert primera.notifies == []
+        mock_select.return_value = ([], [], [])
+        assert not escucha.esperar(5)
+        # se pierde la conexion
+        mock_select.return_value = ([primera], [], [])
+        primera.poll.side_effect = psycopg2.OperationalError('sin conexion')
+        assert escucha.esperar(5)
+        assert primera.close.called
+        assert escucha.conexion is segunda
+        segunda.cursor.return_value.execute.assert_called_with(
+            'LISTEN %s' % notificaciones.CANAL
+        )
+        mock_select.return_value = ([], [], [])
+        assert not escucha.esperar(5)